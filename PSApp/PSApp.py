@@ -7,14 +7,21 @@ from PSAppVersion import get_psapp_version
 from PSAppDefaults import *
 from PSAppConnect import PSAppConnectionManager
 from PSAppReadPressure import PSAppReadPressureDialog
-from PSAppCalibrate import PSAppCalibrationWorker
+from PSAppCalibrate import PSAppCalibrationWorker, PSAppSpotCheckWorker
 from PSAppLoadDialog import PSAppLoadDialog
+from PSAppCalibrationModel import PSAppCalibrationModel
+from PSAppCalibrationStore import PSAppCalibrationStore, SPOT_CHECK_TOLERANCE, drift, spot_check_positions
+from PSAppDriftTracker import PSAppDriftTracker
 from PSAppCommInterface import PSAppCommInterface
+from PSAppCommStats import HISTOGRAM_EDGES
 from PSAppPlayback import PSAppPulsePlaybackWorker
+from PSAppDataBroker import PSAppDataBroker, PSAppDataReader
+from PSAppLivePlot import PSAppLivePlot
+from PSAppSignalMeter import format_signal_stats
 from PSAppSharedFunctions import PSAppExitCodes
 from serial.tools.list_ports import comports
 from time import sleep
-import re,copy
+import re,copy,bisect
 
 class MagicLabel(QLabel):
     """ When this label is double-clicked, it emits a signal letting us know...
@@ -132,6 +139,9 @@ class PSAppCheckConnectionStatus(QObject):
             found_lpi_objs = [False,False]
             i = 0
             for lpi_obj in self.lpi_objs:
+                # The emulator has no port to go missing
+                if lpi_obj is None:
+                    found_lpi_objs[i] = True
                 for cd in comports():
                     if (cd == lpi_obj):
                         found_lpi_objs[i] = True
@@ -155,10 +165,15 @@ class PSAppMainWindow(QMainWindow):
         # 'State' object will manage communication channel and other state information between the GUI
         # and the hardware (i.e., XMOS)
         self.ps_state = PSAppState()
-        self.timestamp = None
         self.calibration_attempts = 0
         self.max_calibration_attempts = 3
         self.parent = parent
+        # Calibrations from earlier sessions, by device/firmware/home; see PSAppCalibrationStore
+        self.cal_store = PSAppCalibrationStore(get_default_cal_store_path())
+        self.fw_version = None
+        self.spot_check_entry = None
+        # Key of a saved calibration the user said no to; see _offer_saved_calibration
+        self.declined_cal_key = None
 
         # Create central widget
         cwidget = QWidget()
@@ -271,8 +286,27 @@ class PSAppMainWindow(QMainWindow):
         st_box.setLineWidth(1)
         st_box.setFrameShape(QFrame.Box)
         self.wf_status = QLabel("Status: Idle")
+        # Sweep display:  the trace wraps around and overwrites itself, instead of being cleared
+        self.sweep_cb = QCheckBox("Sweep display")
+        self.sweep_cb.toggled.connect(lambda checked: self.live_plot.set_sweep(checked))
+        # Auto-correct:  when the pressures coming back during playback say the calibration has drifted,
+        # correct it and reload the table, instead of just saying so
+        self.drift_cb = QCheckBox("Auto-correct drift")
+        self.drift_cb.setToolTip("Keep the calibration up to date from the pressures measured during playback, and reload the table when it drifts.")
+        self.drift_cb.setChecked(get_default_cal_autocorrect())
+        self.drift_tracker = None
+        # How much the playback worker is handing to the GUI thread; updated once a second while playing
+        self.feed_stats_label = QLabel("")
+        self.feed_stats_label.setStyleSheet("color: gray; font-size: 8pt")
+        self.feed_stats_timer = QTimer()
+        self.feed_stats_timer.setInterval(1000)
+        self.feed_stats_timer.timeout.connect(self._update_feed_stats)
         st_layout = QHBoxLayout()
         st_layout.addWidget(self.wf_status)
+        st_layout.addStretch()
+        st_layout.addWidget(self.feed_stats_label)
+        st_layout.addWidget(self.drift_cb)
+        st_layout.addWidget(self.sweep_cb)
         st_box.setLayout(st_layout)
 
         # Create a frame to place the graphing object in to
@@ -341,6 +375,11 @@ class PSAppMainWindow(QMainWindow):
         cal_inc_layout.addWidget(cal_inc_label)
         cal_inc_layout.addWidget(self.cal_inc_le)
         cal_inc_layout.addWidget(cal_inc_limits)
+        # Adaptive calibration:  a coarse pass, then only the increments where the curve needs them
+        self.cal_adaptive_cb = QCheckBox("Adaptive")
+        self.cal_adaptive_cb.setToolTip("Calibrate coarsely first, then fill in only where the pressure curve bends; each reading is taken once the pressure has settled.")
+        self.cal_adaptive_cb.setChecked(get_default_cal_adaptive())
+        cal_inc_layout.addWidget(self.cal_adaptive_cb)
         ci_widget = QWidget()
         ci_widget.setLayout(cal_inc_layout)
         #
@@ -410,6 +449,51 @@ class PSAppMainWindow(QMainWindow):
         # And add the tab
         self.twidget.addTab(cfg_widget,"Config")
 
+        # Create 'diagnostics' widget:  how each command has fared over the configuration interface
+        # (see PSAppCommStats), and a histogram of round trip times for whichever one is selected.
+        # It's only kept up to date while the tab is showing.
+        self.comm_stats_columns = [("Command","command"),("Count","count"),("Failed","failures"),("Retries","retries"),("Busy","busy"),("Empty Reads","empty"),("Bad Echoes","mismatches"),("Mean (ms)","mean_ms"),("p50 (ms)","p50_ms"),("p99 (ms)","p99_ms"),("Max (ms)","max_ms"),("Echo Timeout (ms)","echo_timeout_ms")]
+        self.comm_stats_table = QTableWidget(0,len(self.comm_stats_columns))
+        self.comm_stats_table.setHorizontalHeaderLabels([c[0] for c in self.comm_stats_columns])
+        self.comm_stats_table.verticalHeader().setVisible(False)
+        self.comm_stats_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.comm_stats_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.comm_stats_table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.comm_stats_table.itemSelectionChanged.connect(self._select_comm_stats_row)
+        self.comm_stats_selected = "All"
+        self.comm_hist_plt = pg.PlotWidget()
+        self.comm_hist_plt.setLabel('left','Transactions')
+        self.comm_hist_plt.setLabel('bottom','Round Trip Time, up to (ms)')
+        nbins = len(HISTOGRAM_EDGES) + 1
+        self.comm_hist_plt.getAxis('bottom').setTicks([[(i,"{:g}".format(e)) for (i,e) in enumerate(HISTOGRAM_EDGES)] + [(nbins - 1,"more")]])
+        self.comm_hist = pg.BarGraphItem(x=list(range(nbins)),height=[0] * nbins,width=0.8,brush='r')
+        self.comm_hist_plt.addItem(self.comm_hist)
+        self.comm_stats_timer = QTimer()
+        self.comm_stats_timer.setInterval(1000)
+        self.comm_stats_timer.timeout.connect(self._update_comm_stats)
+        comm_stats_reset_button = QPushButton("Reset")
+        comm_stats_reset_button.setToolTip("Start counting again from zero.")
+        comm_stats_reset_button.clicked.connect(self._reset_comm_stats)
+        comm_stats_save_button = QPushButton("Save CSV")
+        comm_stats_save_button.setToolTip("Save the counts and histograms for every command to a CSV file.")
+        comm_stats_save_button.clicked.connect(self._save_comm_stats)
+        comm_stats_button_layout = QHBoxLayout()
+        comm_stats_button_layout.addStretch()
+        comm_stats_button_layout.addWidget(comm_stats_reset_button)
+        comm_stats_button_layout.addWidget(comm_stats_save_button)
+        comm_stats_button_widget = QWidget()
+        comm_stats_button_widget.setLayout(comm_stats_button_layout)
+        self.diag_widget = QWidget()
+        diag_layout = QVBoxLayout()
+        diag_layout.addWidget(self.comm_stats_table)
+        diag_layout.addWidget(self.comm_hist_plt)
+        diag_layout.addWidget(comm_stats_button_widget)
+        self.diag_widget.setLayout(diag_layout)
+
+        # And add the tab
+        self.twidget.addTab(self.diag_widget,"Diagnostics")
+        self.twidget.currentChanged.connect(self._comm_stats_tab_changed)
+
         # Create 'about' widget; there are labels for both application and firmware version, as well
         # as contact information.  We'll also have a button to begin the firmware update process,
         # which will be its own special app.  There are also magic buttons that can be conjured in
@@ -482,9 +566,14 @@ class PSAppMainWindow(QMainWindow):
         self.data_iface = None
         self.comm_interface = None
 
+        # Data interface reader thread/worker; everything else gets its data from the broker
+        self.data_thread = None
+        self.data_reader = None
+
         # Playback thread/worker
         self.playback_thread = None
         self.playback_worker = None
+        self.feed_meter = None
 
         # Launch the connection dialog
         self._launch_connect()
@@ -533,6 +622,31 @@ class PSAppMainWindow(QMainWindow):
         if fdialog.exec_():
             line_edit.setText(fdialog.selectedFiles()[0])
 
+    def _calibration_drift(self,drift):
+        """ The playback worker says the calibration has drifted.  Either just say so, or (with 'Auto-correct drift') fold the drift into the calibration and reload the table, the same way a change of settings is loaded.
+        """
+        if not(self.drift_tracker) or not(self.ps_state.get_state("playing")):
+            return
+        if not(self.drift_cb.isChecked()) or self.load_dlg:
+            self.wf_status.setText("Status: Playing; calibration has drifted by {:.1f} mmHg.".format(drift))
+            return
+        prev_ps_state = copy.deepcopy(self.ps_state)
+        (x,y) = self.drift_tracker.corrected_table()
+        try:
+            cal_model = PSAppCalibrationModel(x,y)
+        except ValueError:
+            return
+        self.ps_state.populate_pressure_table(x=x,y=y)
+        self.ps_state.set_state("cal_model",cal_model)
+        self.drift_tracker.rebase(cal_model)
+        self.wf_status.setText("Status: Correcting calibration drift of {:.1f} mmHg.".format(drift))
+        self.load_dlg = PSAppLoadDialog(self,prev_ps_state)
+        self.load_dlg.accepted.connect(self._load_complete)
+        self.load_dlg.rejected.connect(self._load_error)
+        self.load_dlg.new_parameter_value.connect(self._load_param_update)
+        self.load_dlg.setWindowModality(Qt.WindowModal)
+        self.load_dlg.show()
+
     def _check_config_tab(self):
         """ Go through the line edits and check that they all have valid states.  Also, check that the files supplied exist.
         """
@@ -555,11 +669,23 @@ class PSAppMainWindow(QMainWindow):
         self.plot_x = []
         self.plot_y = []
         self.plot.setData(self.plot_x,self.plot_y)
+        self.live_plot.clear()
         QApplication.processEvents()
 
+    def _comm_stats_tab_changed(self,index):
+        """ Only bother keeping the comm stats up to date while somebody's looking at them.
+        """
+        if (self.twidget.widget(index) is self.diag_widget):
+            self._update_comm_stats()
+            self.comm_stats_timer.start()
+        else:
+            self.comm_stats_timer.stop()
+
     def _confirm_pulse_table_end(self):
         """ Confirm that the pulse table thread has ended successfully.
         """
+        self.live_plot.stop()
+        self.feed_stats_timer.stop()
         try:
             self.playback_thread.quit()
             self.playback_thread.wait()
@@ -606,10 +732,23 @@ class PSAppMainWindow(QMainWindow):
         # value from the incorrect current value will result in a negative result.
         # Therefore, once the error is detected, we can just try the process again.
         # I'll put a message in the 'status' text box and then re-start the process.
-        if (self._eval_cal_results):
+        # (Now that the points go through PSAppCalibrationModel, a one-off bad point is just
+        # left out; it takes a run of them, or a curve that's all over the place, to fail.)
+        cal_model = self._eval_cal_results()
+        if cal_model:
             self.calibration_attempts = 0
             self.ps_state.populate_pressure_table(x=self.plot_x,y=self.plot_y)
+            self.ps_state.set_state("cal_model",cal_model)
             self.ps_state.set_state("calibrated",True)
+            key = self._get_cal_store_key()
+            if key:
+                # Not worth saving if we can't say what it was run with
+                try:
+                    self.cal_store.put(*key,int(self.cal_max_le.text()),int(self.cal_inc_le.text()),self.plot_x,self.plot_y,cal_model.quality)
+                    # What's saved now is this run, which is fine to spot check next time
+                    self.declined_cal_key = None
+                except ValueError:
+                    pass
             self.wf_status.setText("Status: Idle")
             QApplication.processEvents()
             self.cal_thread.quit()
@@ -636,13 +775,33 @@ class PSAppMainWindow(QMainWindow):
                 warn_dlg.setText("Could not perform calibration successfully after {} attempts.  Please check all pneumatic hoses and connections for issues.".format(self.max_calibration_attempts))
                 warn_dlg.exec()
 
+    def _end_spot_check(self):
+        """ The spot check of a saved calibration is done; if the readings are close enough to it, use it, otherwise run the whole calibration.
+        """
+        self.cal_thread.quit()
+        self.cal_thread.wait()
+        self.cal_worker = None
+        self.cal_thread = None
+        entry = self.spot_check_entry
+        off = drift(PSAppCalibrationStore.model(entry),self.plot_x,self.plot_y)
+        if (off <= SPOT_CHECK_TOLERANCE):
+            self._use_saved_calibration(entry)
+            self.wf_status.setText("Status: Saved calibration confirmed (within {:.1f} mmHg).".format(off))
+            self.exit_button.setEnabled(True)
+            self._set_widget_status()
+        else:
+            self.wf_status.setText("Status: Saved calibration is off by {:.1f} mmHg; running calibration procedure.".format(off))
+            QApplication.processEvents()
+            self._start_cal_procedure()
+
     def _eval_cal_results(self):
-        """ Check to make sure the points make sense.
+        """ Check to make sure the points make sense; the fitted model if they do, None if they don't.
         """
-        for i in range(1,len(self.plot_y)):
-            if ((self.plot_y[i] - self.plot_y[(i - 1)]) <= 0):
-                return False
-        return True
+        try:
+            cal_model = PSAppCalibrationModel(self.plot_x,self.plot_y)
+        except ValueError:
+            return None
+        return cal_model if cal_model.check() else None
 
     def _eval_param_entry(self,le):
         """ For the particular LineEdit that changed, see that the value makes sense.
@@ -689,14 +848,18 @@ class PSAppMainWindow(QMainWindow):
         if self.ps_state.get_state("playing"):
             self.play_button.setText("Play")
             self.ps_state.set_state("playing",False)
+            self.ps_state.clear_loaded()
             if (self.ps_state.get_state("play_mode") == PlayMode.PULSE_TABLE):
                 self.playback_worker.stop_playback()
+                self.live_plot.stop()
+                self.feed_stats_timer.stop()
                 self.wf_status.setText("Status:  Idle")
                 QApplication.processEvents()
                 self.playback_thread.quit()
                 self.playback_thread.wait()
                 self.playback_worker = None
                 self.playback_thread = None
+                self.drift_tracker = None
             else:
                 pass
                 #self.wf_worker.stop_playback()
@@ -712,13 +875,17 @@ class PSAppMainWindow(QMainWindow):
             if (self.play_type_toggle.value() == 0):
                 self.ps_state.set_state("play_mode",PlayMode.PULSE_TABLE)
                 self.playback_thread = QThread()
-                self.playback_worker = PSAppPulsePlaybackWorker(self.comm_interface,self.data_iface)
+                self.drift_tracker = self._new_drift_tracker()
+                self.playback_worker = PSAppPulsePlaybackWorker(self.comm_interface,self.data_iface,tracker=self.drift_tracker)
+                self.playback_worker.calibration_drift.connect(self._calibration_drift)
                 self.playback_worker.moveToThread(self.playback_thread)
-                self.playback_worker.new_data_point.connect(self._plot_new_datapoint)
+                self.playback_worker.new_data_points.connect(self._plot_new_datapoints)
                 self.playback_worker.bad_message_format.connect(self._bad_message_format_alert)
                 self.playback_worker.data_read_fail.connect(self._data_read_fail_alert)
                 self.playback_worker.finished.connect(self._confirm_pulse_table_end)
                 self.playback_thread.started.connect(self.playback_worker.run)
+                self.playback_thread.started.connect(self.live_plot.start)
+                self.playback_thread.started.connect(self._start_feed_stats)
                 self.load_dlg = PSAppLoadDialog(self)
                 self.load_dlg.accepted.connect(self._load_complete)
                 self.load_dlg.rejected.connect(self._load_error)
@@ -763,11 +930,37 @@ class PSAppMainWindow(QMainWindow):
             self.load_dlg.show()
 
     def _first_cal_procedure(self):
-        """ Change the status text appropriately, and then start the calibration procedure.
+        """ Change the status text appropriately, and then start the calibration procedure.  A saved calibration only gets spot checked if the user didn't turn it down when connecting.
         """
+        entry = self._get_saved_calibration()
+        if entry and (self._get_cal_store_key() != self.declined_cal_key):
+            self.wf_status.setText("Status: Checking saved calibration.")
+            self._start_cal_procedure(spot_check=entry)
+            return
         self.wf_status.setText("Status: Running calibration procedure.")
         self._start_cal_procedure()
 
+    def _get_cal_store_key(self):
+        """ What a calibration of the connected device gets saved under:  its USB serial number, firmware version and home position.  None if we don't know which device this is.
+        """
+        lpi = self.cfg_iface.get("lpi") if self.cfg_iface else None
+        serial = getattr(lpi,"serial_number",None)
+        if (serial is None) or (self.fw_version is None):
+            return None
+        try:
+            return (serial,self.fw_version,int(self.home_pos_le.text()))
+        except ValueError:
+            return None
+
+    def _get_saved_calibration(self):
+        key = self._get_cal_store_key()
+        if not key:
+            return None
+        try:
+            return self.cal_store.get(*key,cal_max=int(self.cal_max_le.text()))
+        except ValueError:
+            return None
+
     def _graceful_close(self,ec=PSAppExitCodes.EXIT.value):
         """ Shutdown any threads that might be running, close down communication channels, then close down.  Pop up a window indicating that we've received the message.
         """
@@ -794,6 +987,9 @@ class PSAppMainWindow(QMainWindow):
             except:
                 pass
 
+        # Stop reading the data interface before the port goes away
+        self._stop_data_reader()
+
         # Formally close the serial connections
         for x in [self.cfg_iface,self.data_iface]:
             if x:
@@ -812,10 +1008,12 @@ class PSAppMainWindow(QMainWindow):
         self.worker.stop()
         self.thread.quit()
         self.thread.wait()
+        self._stop_data_reader()
         # Update the connection text
         self.cs_label.setText("Connection status:  Not connected")
         self.ps_state.set_state("connected",False)
         self.ps_state.set_state("playing",False)
+        self.ps_state.clear_loaded()
         self.fw_version_label.setText("Pulse Simulator Firmware Version: ")
         try:
             self.load_dlg.close()
@@ -837,9 +1035,9 @@ class PSAppMainWindow(QMainWindow):
         try:
             val = str(int(val)).encode()
             self.cfg_iface["ser"].write(b'O'+val+b'\n')
-            rem = re.match(b'^OK',self.cfg_iface["ser"].readline())
-            if rem:
-                self.data_iface["ser"].readline()
+            # The reading that follows an 'OK' goes to the data broker, which throws it away if nobody
+            # is interested
+            self.cfg_iface["ser"].readline()
         except:
             pass
 
@@ -855,6 +1053,8 @@ class PSAppMainWindow(QMainWindow):
         self.plt.setXRange(0,10)
         self.plt.setYRange(0,250)
         self.plt.showGrid(x=True,y=True)
+        # During playback, the trace is drawn from here at a fixed frame rate rather than once per point
+        self.live_plot = PSAppLivePlot(self.plt,self.plot,window=get_default_plot_window(),fps=get_default_plot_fps())
 
     def _launch_connect(self):
         """ Launch a dialog to look for the correct COM ports, both configuration and data.
@@ -880,6 +1080,8 @@ class PSAppMainWindow(QMainWindow):
         """
         self.load_dlg = None
         self.wf_status.setText("Status: Playing")
+        if self.drift_tracker:
+            self.drift_tracker.restart_warmup()
         QApplication.processEvents()
 
     def _load_error(self):
@@ -887,6 +1089,7 @@ class PSAppMainWindow(QMainWindow):
         """
         self.load_dlg = None
         self.ps_state.set_state("playing",False)
+        self.ps_state.clear_loaded()
         self.wf_status.setText("Status: Idle")
         QApplication.processEvents()
 
@@ -896,24 +1099,46 @@ class PSAppMainWindow(QMainWindow):
         self.ps_state.set_state(param,val)
         self.sa_les[param].setText(str(val))
 
-    def _plot_new_datapoint(self,xy):
-        """ New set of datapoints has come in, plot them here.
+    def _new_drift_tracker(self):
+        """ Drift tracker for the pulse table that's about to be played, over the positions its pressure range takes in (with a bit to spare); None if there's no calibration model to track.
         """
-        # If no points are present yet, then then first point is going to define '0', and then all
-        # points will be added afterwards until we have 10 seconds worth of data.  Once we have 10
-        # seconds worth of data, we'll reset the plot data and start again.  Therefore, the first
-        # thing to do is to determine the current length of our data array.  Time reported should be
-        # in ms.
-        if not(len(self.plot_x)):
-            self.timestamp = xy[0]
-        new_time = xy[0] - self.timestamp
-        self.plot_x.append(new_time / 1000.0)
-        self.plot_y.append(xy[1])
-        self.plot.setData(self.plot_x,self.plot_y)
-        QApplication.processEvents()
-        if (new_time >= 10000):
-            self.plot_x = []
-            self.plot_y = []
+        cal_model = self.ps_state.get_state("cal_model")
+        if cal_model is None:
+            return None
+        (lo,hi) = cal_model.to_steps([self.ps_state.get_state("diastolic") - 10,self.ps_state.get_state("systolic") + 10])
+        return PSAppDriftTracker(cal_model,lo,hi)
+
+    def _offer_saved_calibration(self):
+        """ Just connected; if this device has been calibrated before (same firmware, same home position), ask whether to go ahead with that calibration instead of waiting for a new one.  Running calibration after a yes only spot checks it; after a no it runs the whole procedure.
+        """
+        self.declined_cal_key = None
+        entry = self._get_saved_calibration()
+        if not entry:
+            return
+        ask_dlg = QMessageBox()
+        ask_dlg.setText("This device was calibrated on {}.  Use that calibration?".format(PSAppCalibrationStore.describe(entry)))
+        ask_dlg.setInformativeText("Running calibration will check a few points against it, and only do the whole procedure again if it's off by more than {:.0f} mmHg.".format(SPOT_CHECK_TOLERANCE))
+        ask_dlg.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+        if (ask_dlg.exec() == QMessageBox.Yes):
+            self._use_saved_calibration(entry)
+            self.wf_status.setText("Status: Using saved calibration.")
+            self._set_widget_status()
+        else:
+            self.declined_cal_key = self._get_cal_store_key()
+
+    def _plot_new_datapoints(self,samples):
+        """ New batch of datapoints (an array of SAMPLE_DTYPE) has come in; hand it to the live plot, which redraws on its own timer.
+        """
+        if self.feed_meter:
+            self.feed_meter.delivered()
+        # Time reported should be in ms.  The plot takes care of where time '0' is and of clearing (or
+        # wrapping around) once there's 10 seconds worth of data.
+        self.live_plot.append(samples["tms"],samples["mmhg"])
+
+    def _reset_comm_stats(self):
+        if self.comm_interface:
+            self.comm_interface.reset_stats()
+        self._update_comm_stats()
 
     def _rp_comm_issue(self):
         """ Shutdown the dialog if communication breaks down.
@@ -922,6 +1147,31 @@ class PSAppMainWindow(QMainWindow):
         self.wf_status.setText("Status: Idle")
         QApplication.processEvents()
 
+    def _save_comm_stats(self):
+        """ Ask where to put the comm stats, and write them there as CSV.
+        """
+        if not self.comm_interface:
+            return
+        fdialog = QFileDialog()
+        fdialog.setDefaultSuffix(".csv")
+        fdialog.setNameFilter("CSV files (*.csv)")
+        fdialog.setAcceptMode(QFileDialog.AcceptSave)
+        if fdialog.exec_():
+            try:
+                self.comm_interface.dump_stats(fdialog.selectedFiles()[0])
+            except OSError as e:
+                warn_dlg = QMessageBox()
+                warn_dlg.setText("Couldn't save the comm stats: {}".format(e))
+                warn_dlg.exec()
+
+    def _select_comm_stats_row(self):
+        """ A different command has been picked in the comm stats; show its histogram.
+        """
+        rows = self.comm_stats_table.selectionModel().selectedRows()
+        if rows:
+            self.comm_stats_selected = self.comm_stats_table.item(rows[0].row(),0).text()
+            self._update_comm_stats()
+
     def _send_home_clicked(self):
         """ Callback for when the 'Send Home' button is clicked.
         """
@@ -941,10 +1191,9 @@ class PSAppMainWindow(QMainWindow):
             warn_dlg.setWindowTitle("Warning")
             warn_dlg.setText("'Send Home' command returned an error.")
             warn_dlg.exec()
-        if success:
-            # Clean out the data interface
-            xyz = self.data_iface["ser"].readline()
-        else:
+        # No need to clean out the data interface on success; the reading goes to the data broker, which
+        # throws it away if nobody is interested
+        if not success:
             rem = re.match(b'^ERR: Maximum step count',gohome_ret)
             if rem:
                 # We probably need to warn the user that we were unsuccessful in sending the unit home
@@ -968,6 +1217,7 @@ class PSAppMainWindow(QMainWindow):
         self.cal_max_le.insert("2000")
         self.cal_inc_le.clear()
         self.cal_inc_le.insert("25")
+        self.cal_adaptive_cb.setChecked(get_default_cal_adaptive())
         self.pt_le.clear()
         self.pt_le.insert(get_default_pulse_table_path())
         self.wf_le.clear()
@@ -1012,20 +1262,25 @@ class PSAppMainWindow(QMainWindow):
         play_button_enable &= (not(self.refresh_button.isEnabled() and not(self.ps_state.get_state("playing"))))
         self.play_button.setEnabled(play_button_enable)
 
-    def _start_cal_procedure(self):
-        """ We'll kick off a thread that will run the routine, and then pass the data back to us via signalling.
+    def _start_cal_procedure(self,spot_check=None):
+        """ We'll kick off a thread that will run the routine, and then pass the data back to us via signalling.  With 'spot_check' (a saved calibration), only a few points are read, to see whether it still holds.
         """
         # Disable the 'Exit' button so that I don't have to worry about this thread
         self.exit_button.setEnabled(False)
         self.cal_thread = QThread()
         xmin = int(self.home_pos_le.text())
         xmax = int(self.cal_max_le.text())
-        self.cal_worker = PSAppCalibrationWorker(self.comm_interface,self.data_iface,xmin,xmax,int(self.cal_inc_le.text()))
+        if spot_check:
+            self.spot_check_entry = spot_check
+            positions = spot_check_positions(PSAppCalibrationStore.model(spot_check),xmin,xmax)
+            self.cal_worker = PSAppSpotCheckWorker(self.comm_interface,self.data_iface,xmin,positions)
+        else:
+            self.cal_worker = PSAppCalibrationWorker(self.comm_interface,self.data_iface,xmin,xmax,int(self.cal_inc_le.text()),self.cal_adaptive_cb.isChecked())
         self.cal_worker.moveToThread(self.cal_thread)
         self.cal_thread.started.connect(self.cal_worker.run)
         self.cal_worker.new_reading.connect(self._update_calibration_plot)
         self.cal_worker.reading_error.connect(self._terminate_cal_with_error)
-        self.cal_worker.finished.connect(self._end_cal_procedure)
+        self.cal_worker.finished.connect(self._end_spot_check if spot_check else self._end_cal_procedure)
         self.plot_x = []
         self.plot_y = []
         self.plt.setXRange(xmin,xmax)
@@ -1050,6 +1305,13 @@ class PSAppMainWindow(QMainWindow):
         self.wf_status.setText("Status: Idle")
         self._set_widget_status()
 
+    def _start_feed_stats(self):
+        """ Start keeping an eye on how much the playback worker is sending over to us.
+        """
+        self.feed_meter = self.playback_worker.meter
+        self.feed_meter.get_stats()
+        self.feed_stats_timer.start()
+
     def _store_config_iface(self,ser_obj):
         """ Grab the information from connection manager dialog signal
         """
@@ -1057,10 +1319,27 @@ class PSAppMainWindow(QMainWindow):
         self.comm_interface = PSAppCommInterface(self.cfg_iface["ser"])
         self._update_connection_status()
 
+    def _stop_data_reader(self):
+        """ Shut down the data interface reader, if it's running.
+        """
+        if self.data_reader:
+            self.data_reader.stop()
+            self.data_thread.quit()
+            self.data_thread.wait()
+            self.data_reader = None
+            self.data_thread = None
+
     def _store_data_iface(self,ser_obj):
-        """ Grab the information from connection manager dialog signal
+        """ Grab the information from connection manager dialog signal.  From here on, the data interface is only ever read by one thread, which passes everything it gets to the broker in 'data_iface["broker"]'.
         """
+        self._stop_data_reader()
         self.data_iface = ser_obj
+        self.data_iface["broker"] = PSAppDataBroker()
+        self.data_thread = QThread()
+        self.data_reader = PSAppDataReader(self.data_iface,self.data_iface["broker"])
+        self.data_reader.moveToThread(self.data_thread)
+        self.data_thread.started.connect(self.data_reader.run)
+        self.data_thread.start()
         self._update_connection_status()
 
     def _terminate_cal_with_error(self):
@@ -1079,13 +1358,50 @@ class PSAppMainWindow(QMainWindow):
         self._set_widget_status()
 
     def _update_calibration_plot(self,vals):
-        """ Get the x,y points from the calibration worker thread and add them to the plotting instance.
+        """ Get the x,y points from the calibration worker thread and add them to the plotting instance.  They're kept in position order, since an adaptive calibration goes back to fill in gaps.
         """
-        self.plot_x.append(vals[0])
-        self.plot_y.append(vals[1])
+        i = bisect.bisect(self.plot_x,vals[0])
+        self.plot_x.insert(i,vals[0])
+        self.plot_y.insert(i,vals[1])
         self.plot.setData(self.plot_x,self.plot_y)
         QApplication.processEvents()
 
+    def _update_comm_stats(self):
+        """ Once a second while the 'Diagnostics' tab is showing:  the latest counts from the comm interface, one row per command with everything together at the bottom.
+        """
+        stats = self.comm_interface.stats() if self.comm_interface else dict()
+        # Along with how long the handshake is currently prepared to wait for each echo
+        timeouts = self.comm_interface.timeouts() if self.comm_interface else dict()
+        for key in stats:
+            est = timeouts.get(("echo",None if (key == "All") else key))
+            stats[key]["echo_timeout_ms"] = est["timeout_ms"] if est else None
+        keys = sorted([k for k in stats if (k != "All")]) + (["All"] if stats else [])
+        self.comm_stats_table.blockSignals(True)
+        self.comm_stats_table.setRowCount(len(keys))
+        for (row,key) in enumerate(keys):
+            for (col,(header,field)) in enumerate(self.comm_stats_columns):
+                val = key if (field == "command") else stats[key][field]
+                if val is None:
+                    text = ""
+                elif (val == float("inf")):
+                    text = "> {:g}".format(HISTOGRAM_EDGES[-1])
+                elif isinstance(val,float):
+                    text = "{:.2f}".format(val)
+                else:
+                    text = str(val)
+                self.comm_stats_table.setItem(row,col,QTableWidgetItem(text))
+            if (key == self.comm_stats_selected):
+                self.comm_stats_table.selectRow(row)
+        self.comm_stats_table.blockSignals(False)
+        hist = stats[self.comm_stats_selected]["histogram"] if (self.comm_stats_selected in stats) else [0] * (len(HISTOGRAM_EDGES) + 1)
+        self.comm_hist.setOpts(height=hist)
+
+    def _update_feed_stats(self):
+        """ Once a second during playback:  signals per second from the playback worker, and how far behind we are in handling them.
+        """
+        if self.feed_meter:
+            self.feed_stats_label.setText(format_signal_stats(self.feed_meter.get_stats()))
+
     def _update_connection_status(self):
         """ If this function gets called, the dialog should've ensured that we're connected, but do a check here anyway, and then the buttons should be enabled/disabled as required.
         """
@@ -1100,4 +1416,16 @@ class PSAppMainWindow(QMainWindow):
             vers = self.comm_interface.transaction(b'V',True)
             rem = re.match(b'^Version:\s+([0-9a-fA-F\+]+)',vers)
             if rem:
-                self.fw_version_label.setText("Pulse Simulator Firmware Version: {}".format(rem.group(1).decode()))
+                self.fw_version = rem.group(1).decode()
+                self.fw_version_label.setText("Pulse Simulator Firmware Version: {}".format(self.fw_version))
+                self._offer_saved_calibration()
+
+    def _use_saved_calibration(self,entry):
+        """ Make a saved calibration the current one.
+        """
+        self.ps_state.populate_pressure_table(x=list(entry["x"]),y=list(entry["y"]))
+        self.ps_state.set_state("cal_model",PSAppCalibrationStore.model(entry))
+        self.ps_state.set_state("calibrated",True)
+        self.plot_x = list(entry["x"])
+        self.plot_y = list(entry["y"])
+        self.plot.setData(self.plot_x,self.plot_y)
@@ -0,0 +1,572 @@
+#! python3
+
+from PyQt5.QtCore import QCoreApplication
+from PSAppEmulator import PSAppFirmwareEmulator, PSAppPlant
+from PSAppCommInterface import PSAppCommInterface
+from PSAppSampleParser import PSAppSampleParser
+from PSAppSharedFunctions import convert_mpsi_to_mmhg
+from PSAppDataBroker import PSAppDataBroker, PSAppDataReader
+from PSAppCalibrate import PSAppCalibrationWorker
+from PSAppLoadDialog import PSAppLoadWorker
+from PSAppState import PSAppState
+from time import perf_counter, sleep
+import numpy as np
+import argparse, copy, io, json, os, platform, re, shutil, struct, sys, tempfile, threading, time
+sys.path.append("./math")
+from PSAppTableCompiler import PSAppTableCompiler, compile_table, clear_cache
+from PSAppShaper import shape_pulse
+from PSAppCalibrationModel import PSAppCalibrationModel
+from PSAppCalibrationSweep import PSAppCalibrationSweep
+from PSAppDriftTracker import PSAppDriftTracker
+from PSAppDefaults import get_default_pulse_table_path, get_default_waveform_path
+# The scripts' (and the Kivy UI's) waveform handling lives up at the top of the repository
+sys.path.append("..")
+import waveform_compiler, waveform_io
+
+# Benchmarks for the host-side hot paths.  Everything here runs against the firmware emulator, so no
+# hardware is needed (nor a display).  Run from the 'PSApp' directory:
+#
+#     python PSAppBenchmark.py
+#
+# With '--json results.json', the results are saved as well as printed; keep one of those as a
+# baseline, and '--baseline results.json' on a later run reports anything that has got more than
+# '--tolerance' worse since (and exits with 1, so it can gate a build).  '--only' runs just the named
+# benchmarks; '--list' names them all.
+RESULTS_FORMAT = 1
+REGRESSION_TOLERANCE = 0.25
+# Heart rate (bpm) that the recorded waveform ('test_pulses.dat') was taken at; see kivy_ui.py
+RECORDED_HR = 42.252
+
+def _summarize(samples):
+    """ Turn a list of timings (in seconds) into a small dictionary of statistics, in microseconds.
+    """
+    us = np.array(samples) * 1e6
+    return {"n":len(us), "mean_us":float(np.mean(us)), "p50_us":float(np.percentile(us,50)), "p99_us":float(np.percentile(us,99)), "max_us":float(np.max(us))}
+
+def bench_transaction_latency(n=2000,gap=0.0,interface=PSAppCommInterface):
+    """ Per-transaction round trip through 'interface' (PSAppCommInterface, or anything that works the same way), against the emulator acting as a loopback device.  'gap' is a pause between transactions, which is closer to how parameter changes come in during playback (the worker has gone idle by the time the next one shows up).
+    """
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    emulator = PSAppFirmwareEmulator()
+    comm_interface = interface(emulator)
+    samples = list()
+    try:
+        for i in range(n):
+            if gap:
+                sleep(gap)
+            t0 = perf_counter()
+            comm_interface.transaction(b'H100')
+            samples.append(perf_counter() - t0)
+    finally:
+        comm_interface.stop()
+        emulator.close()
+    return _summarize(samples)
+
+def synthetic_stream(nlines,seed=0):
+    """ 'W' packets the way the firmware sends them during playback:  the table index, a millisecond timestamp going up in 20ms ticks, and a pressure in mPSI.
+    """
+    rng = np.random.default_rng(seed)
+    index = np.arange(nlines) % 257
+    tms = np.arange(nlines) * 20
+    mpsi = rng.integers(1000,3500,nlines)
+    return "".join(["W,{},{},{}\n".format(i,t,p) for (i,t,p) in zip(index.tolist(),tms.tolist(),mpsi.tolist())]).encode()
+
+def bench_parse_throughput(nlines=2000000,chunk=4096):
+    """ Lines per second through the old per-line path (readline, regex, convert, list) versus PSAppSampleParser fed 'chunk' bytes at a time, which is about what a read of everything waiting on the port gives back.
+    """
+    data = synthetic_stream(nlines)
+    res = dict()
+    # Old path, as it was in PSAppPulsePlaybackWorker.run
+    fh = io.BytesIO(data)
+    points = list()
+    t0 = perf_counter()
+    while True:
+        line = fh.readline()
+        if (len(line) == 0):
+            break
+        rem = re.match(b'^W,\d+,(\d+),(\d+)',line)
+        if rem:
+            points.append([int(rem.group(1)),convert_mpsi_to_mmhg(int(rem.group(2)))])
+    res["regex_lines_per_s"] = nlines / (perf_counter() - t0)
+    # Chunked parser
+    parser = PSAppSampleParser()
+    view = memoryview(data)
+    n = 0
+    t0 = perf_counter()
+    for i in range(0,len(data),chunk):
+        n += len(parser.feed(view[i:(i + chunk)]))
+    res["chunked_lines_per_s"] = nlines / (perf_counter() - t0)
+    res["speedup"] = res["chunked_lines_per_s"] / res["regex_lines_per_s"]
+    res["match"] = (n == len(points) == nlines) and (parser.get_malformed() == 0)
+    return res
+
+def bench_convert_mpsi(n=100000,seed=0):
+    """ mPSI to mmHg for 'n' readings:  one call per reading, as the workers used to do it, against one call on the whole array.
+    """
+    mpsi = np.random.default_rng(seed).integers(0,6000,n)
+    as_list = mpsi.tolist()
+    res = dict()
+    t0 = perf_counter()
+    old = [convert_mpsi_to_mmhg(val) for val in as_list]
+    res["loop_us"] = (perf_counter() - t0) * 1e6
+    t0 = perf_counter()
+    new = convert_mpsi_to_mmhg(mpsi)
+    res["array_us"] = (perf_counter() - t0) * 1e6
+    res["n"] = n
+    res["match"] = bool(np.allclose(old,new,rtol=0,atol=1e-9))
+    return res
+
+def bench_table_compile(n=200):
+    """ Cost per position table:  the old loop from PSAppLoadWorker.run, 'compile_table' on its own, and a PSAppTableCompiler answering from its cache.  Uses the pulse table that ships in 'res', against a made-up (but typically shaped) calibration.
+    """
+    fh = open(get_default_pulse_table_path(),'rb')
+    table = struct.unpack("256h",fh.read())
+    fh.close()
+    motor_locs = list(range(100,6001,50))
+    mmhg_readings = (250.0 * (1.0 - np.exp(-np.arange(len(motor_locs)) / 60.0)) / (1.0 - np.exp(-len(motor_locs) / 60.0))).tolist()
+    pairs = [(120 - (i % 40),80 - (i % 20)) for i in range(n)]
+    res = dict()
+    # Old path, as it was in PSAppLoadWorker.run
+    def old_positions(systolic,diastolic):
+        mx = np.array(motor_locs)
+        my = np.array(mmhg_readings)
+        mmhg_vals = []
+        delta = systolic - diastolic
+        table_span = max(table) - min(table)
+        for val in table:
+            mmhg_vals.append((int(val) - min(table)) / table_span * delta + diastolic)
+        positions = []
+        for i in range(len(mmhg_vals)):
+            positions.append(round(np.interp(mmhg_vals[i],my,mx)))
+        positions.append(positions[0])
+        return positions
+    t0 = perf_counter()
+    old = [old_positions(s,d) for (s,d) in pairs]
+    res["loop_us"] = (perf_counter() - t0) / n * 1e6
+    t0 = perf_counter()
+    new = [compile_table(table,s,d,motor_locs,mmhg_readings) for (s,d) in pairs]
+    res["vectorized_us"] = (perf_counter() - t0) / n * 1e6
+    clear_cache()
+    compiler = PSAppTableCompiler(table,motor_locs,mmhg_readings)
+    for (s,d) in pairs:
+        compiler.positions(s,d)
+    t0 = perf_counter()
+    for (s,d) in pairs:
+        compiler.positions(s,d)
+    res["cached_us"] = (perf_counter() - t0) / n * 1e6
+    res["match"] = (old == new)
+    return res
+
+def bench_shape_pulse(n=1000,seed=0):
+    """ Shaping a library of 'n' pulses:  the old point-by-point version of 'shape_pulse', one pulse at a time, against the array version with all of them in one call.  The pulses are the one that ships in 'res', shifted, scaled, offset and with noise added.
+    """
+    fh = open(get_default_pulse_table_path(),'rb')
+    table = np.array(struct.unpack("256h",fh.read()))
+    fh.close()
+    rng = np.random.default_rng(seed)
+    pulses = np.rint([np.roll(table,rng.integers(-10,10)) * rng.uniform(0.3,3.0) + rng.normal(0,rng.uniform(0,200),len(table)) + rng.integers(-2000,2000) for i in range(n)]).astype(np.int64)
+    res = dict()
+    # Old version, as it was in PSAppShaper
+    def old_shape_pulse(pts):
+        from math import floor, ceil
+        from statistics import mean
+        from copy import deepcopy
+        lpts = len(pts)
+        si = [0] * lpts
+        nsi = [0] * lpts
+        avg = floor(mean(pts))
+        for i in range(1,lpts):
+            nsi[i] = nsi[(i - 1)] + (pts[(i - 1)] - avg)
+        midpt = ceil(lpts/2.0)
+        for j in range(2):
+            fmin = min(nsi[1:20])
+            findex = nsi[1:20].index(fmin)
+            findex += 1
+            bmin = min(nsi[midpt:lpts])
+            bindex = nsi[midpt:lpts].index(bmin)
+            bindex += midpt
+            slope = (bmin - fmin) / (bindex - findex)
+            for i in range(lpts):
+                si[i] = nsi[i] - floor(i * slope) - nsi[findex]
+            nsi = deepcopy(si)
+        threshold = 500
+        rsi = deepcopy(nsi)
+        end = 0
+        i = len(rsi) - 1
+        while (i > 0):
+            if ((rsi[(i - 1)] - rsi[i]) < threshold):
+                end = i
+                break
+            i -= 1
+        new_slope = (rsi[end] - rsi[0]) / (256 - end)
+        for i in range((end + 1),len(rsi)):
+            rsi[i] = rsi[(i - 1)] - new_slope
+        rmin = min(rsi)
+        rindex = rsi.index(rmin)
+        for i in range(len(rsi)):
+            rsi[i] -= rsi[rindex]
+        rmax = max(rsi)
+        rscale = 8192.0 / rmax
+        for i in range(len(rsi)):
+            rsi[i] = round(rscale * rsi[i])
+        return rsi
+    as_lists = pulses.tolist()
+    t0 = perf_counter()
+    old = [old_shape_pulse(pts) for pts in as_lists]
+    res["loop_ms"] = (perf_counter() - t0) * 1e3
+    t0 = perf_counter()
+    new = shape_pulse(pulses)
+    res["batch_ms"] = (perf_counter() - t0) * 1e3
+    res["n"] = n
+    res["match"] = (old == new.tolist()) and (old_shape_pulse(table.tolist()) == shape_pulse(table))
+    return res
+
+def bench_resample_hr(rates=(50,60,75,90,120,150)):
+    """ The recorded waveform resampled from the heart rate it was taken at to each of 'rates' (what 'resample_HR' in the Kivy UI does):  per rate, the first time (nothing cached), again (from the cache), and with the anti-aliasing filter.
+    """
+    values = waveform_io.load_text(get_default_waveform_path(),cache=False)
+    res = dict()
+    waveform_compiler.clear_cache()
+    t0 = perf_counter()
+    for rate in rates:
+        waveform_compiler.resample_rate(values,RECORDED_HR,rate)
+    res["uncached_ms"] = (perf_counter() - t0) / len(rates) * 1e3
+    t0 = perf_counter()
+    for rate in rates:
+        waveform_compiler.resample_rate(values,RECORDED_HR,rate)
+    res["cached_us"] = (perf_counter() - t0) / len(rates) * 1e6
+    t0 = perf_counter()
+    for rate in rates:
+        waveform_compiler.resample_rate(values,RECORDED_HR,rate,True)
+    res["antialias_ms"] = (perf_counter() - t0) / len(rates) * 1e3
+    waveform_compiler.clear_cache()
+    res["points"] = len(values)
+    return res
+
+def bench_waveform_pipeline(rate=75,systolic=120,diastolic=80,factor=10,repeat=20):
+    """ The recorded waveform from file to motor positions, the way the Kivy UI plays it:  load the text file, resample it to 'rate', scale it to 'systolic'/'diastolic' and decimate it through a calibration to a position per tick.  Timed with the file being read for the first time ('cold', which parses it and writes the sidecar) and again ('warm', which maps the sidecar), best of 'repeat' each, since a single run is over in well under a millisecond.  Works on a copy of the file, so no sidecar is left behind.
+    """
+    steps = np.arange(1000,2001,25)
+    cal = PSAppCalibrationModel(steps,PSAppPlant(knee=0,volume=4500.0).true_mmhg(steps))
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir,os.path.basename(get_default_waveform_path()))
+    shutil.copy(get_default_waveform_path(),path)
+    res = dict()
+    try:
+        for name in ["cold","warm"]:
+            (total,load) = (list(),list())
+            for i in range(repeat):
+                if (name == "cold") and os.path.exists(waveform_io.sidecar_path(path)):
+                    os.remove(waveform_io.sidecar_path(path))
+                waveform_compiler.clear_cache()
+                t0 = perf_counter()
+                values = waveform_io.load_text(path)
+                t1 = perf_counter()
+                values = waveform_compiler.resample_rate(values,RECORDED_HR,rate)[:-20]
+                (lo,hi) = (values.min(),values.max())
+                mmhg = (values - lo) / (hi - lo) * (systolic - diastolic) + diastolic
+                (ys,stats) = waveform_compiler.compile_steps(mmhg,cal,factor)
+                total.append(perf_counter() - t0)
+                load.append(t1 - t0)
+            res[name + "_ms"] = min(total) * 1e3
+            res[name + "_load_ms"] = min(load) * 1e3
+        res["ticks"] = stats["length"]
+        res["maxstep"] = stats["maxstep"]
+    finally:
+        waveform_compiler.clear_cache()
+        shutil.rmtree(tmpdir,ignore_errors=True)
+    return res
+
+def bench_calibration_model(n=100000,seed=0):
+    """ A made-up calibration sweep (typically shaped, with some noise and a few bad readings) turned into positions:  straight through np.interp on the raw points, as it used to be done, against PSAppCalibrationModel.  Reports the time per 'n' lookups, the time to fit the model, and how far each is from the true curve (worst case, in steps).
+    """
+    rng = np.random.default_rng(seed)
+    steps = np.arange(100,3001,25.0)
+    def true_mmhg(s):
+        return 10.0 + 250.0 * (1.0 - np.exp(-(s - 100.0) / 1500.0))
+    readings = true_mmhg(steps) + rng.normal(0,0.4,len(steps))
+    bad = rng.choice(len(steps),3,replace=False)
+    readings[bad] += rng.choice([-1,1],3) * rng.uniform(10,40,3)
+    res = dict()
+    t0 = perf_counter()
+    model = PSAppCalibrationModel(steps,readings)
+    res["fit_ms"] = (perf_counter() - t0) * 1e3
+    mmhg = rng.uniform(model.quality["min_mmhg"],model.quality["max_mmhg"],n)
+    t0 = perf_counter()
+    raw = np.rint(np.interp(mmhg,readings,steps)).astype(np.int64)
+    res["raw_ms"] = (perf_counter() - t0) * 1e3
+    t0 = perf_counter()
+    fitted = model.positions(mmhg)
+    res["model_ms"] = (perf_counter() - t0) * 1e3
+    # Where the true curve puts each pressure
+    truth = 100.0 - 1500.0 * np.log(1.0 - (mmhg - 10.0) / 250.0)
+    res["raw_err"] = float(np.max(np.abs(raw - truth)))
+    res["model_err"] = float(np.max(np.abs(fitted - truth)))
+    res["nrejected"] = model.quality["nrejected"]
+    return res
+
+class SimulatedPlant(PSAppPlant):
+    """ The emulator's made-up finger and cuff (PSAppPlant), driven directly for calibration sweeps, on a virtual clock.  Moves take 'stride' seconds a step (the firmware's MIN_STRIDE_TIME), and every command costs 'latency' on top.
+    """
+    def __init__(self,home=1000,knee=300,width=60.0,volume=12000.0,tau=0.02,noise=0.2,stride=0.0008,latency=0.005,seed=0):
+        super(SimulatedPlant,self).__init__(home,knee,width,volume,tau,noise,seed)
+        self.stride = stride
+        self.latency = latency
+        self.clock = 0.0
+
+    def sleep(self,t):
+        self.wait(t)
+        self.clock += t
+
+    def read(self):
+        self.sleep(self.latency)
+        return self.sample()
+
+    def move(self,n):
+        self.pos += n
+        self.sleep(abs(n) * self.stride)
+        return self.read()
+
+    def go_home(self):
+        return self.move(self.home - self.pos)
+
+def bench_calibration_sweep(home=1000,cal_max=2000,cal_inc=25,seed=0):
+    """ The fixed calibration sweep (PSAppCalibrationWorker._run:  wait 100ms, move an increment, read) against the adaptive one, both on a SimulatedPlant.  Reports commands sent and (virtual) time taken by each, and the worst error of the model fitted to each against the true curve, in mmHg.
+    """
+    res = dict()
+    grid = np.arange(home,cal_max + 1)
+    plant = SimulatedPlant(home=home,seed=seed)
+    steps = [home]
+    mmhg = [plant.read()]
+    while (steps[-1] < cal_max):
+        plant.sleep(0.1)
+        mmhg.append(plant.move(cal_inc))
+        steps.append(steps[-1] + cal_inc)
+    res["fixed_commands"] = len(steps)
+    res["fixed_s"] = plant.clock
+    res["fixed_err"] = float(np.max(np.abs(PSAppCalibrationModel(steps,mmhg).to_mmhg(grid) - plant.true_mmhg(grid))))
+    plant = SimulatedPlant(home=home,seed=seed)
+    sweep = PSAppCalibrationSweep(home,cal_max,cal_inc)
+    res["adaptive_ok"] = sweep.run(plant.move,plant.read,plant.go_home)
+    res["adaptive_points"] = len(sweep.steps)
+    res["adaptive_commands"] = sweep.nmoves + sweep.nreads
+    res["adaptive_s"] = plant.clock
+    res["adaptive_err"] = float(np.max(np.abs(PSAppCalibrationModel(sweep.steps,sweep.mmhg).to_mmhg(grid) - plant.true_mmhg(grid))))
+    res["fixed_points"] = len(steps)
+    return res
+
+def bench_drift_tracker(minutes=5.0,leak=6.0,seed=0):
+    """ Five minutes of pulse table playback (95 +/- 15 mmHg at 75bpm, a sample per 20ms tick) on a SimulatedPlant that starts leaking after a minute, losing 'leak' mmHg over the rest.  Reports the time per sample through PSAppDriftTracker, when it flagged the drift (seconds in), and the worst error over the positions played of the calibration as it was, and as corrected by the tracker.
+    """
+    rng = np.random.default_rng(seed)
+    plant = SimulatedPlant(seed=seed)
+    sweep = PSAppCalibrationSweep(1000,3000,25)
+    sweep.run(plant.move,plant.read,plant.go_home)
+    model = PSAppCalibrationModel(sweep.steps,sweep.mmhg)
+    (lo,hi) = model.to_steps([70,130])
+    tracker = PSAppDriftTracker(model,lo,hi)
+    t = np.arange(int(minutes * 3000)) * 0.02
+    pos = model.positions(95 + 15 * np.sin(2 * np.pi * 1.25 * t))
+    offset = -leak * np.clip((t - 60) / (t[-1] - 60),0,1)
+    truth = plant.true_mmhg(pos)
+    # The pressure lags behind the motor a little, and is noisy
+    measured = truth - 0.3 * np.diff(truth,prepend=truth[0]) + offset + rng.normal(0,0.3,len(t))
+    res = {"flagged_s":None}
+    t0 = perf_counter()
+    for start in range(0,len(t),50):
+        tracker.update(pos[start:(start + 50)],measured[start:(start + 50)])
+        if tracker.check() and (res["flagged_s"] is None):
+            res["flagged_s"] = float(t[start])
+    res["per_sample_us"] = (perf_counter() - t0) / len(t) * 1e6
+    grid = np.arange(int(lo),int(hi))
+    now = plant.true_mmhg(grid) + offset[-1]
+    res["stale_err"] = float(np.max(np.abs(model.to_mmhg(grid) - now)))
+    res["corrected_err"] = float(np.max(np.abs(tracker.corrected_model().to_mmhg(grid) - now)))
+    return res
+
+class _BenchParent(object):
+    """ The parts of PSAppMainWindow that PSAppLoadWorker asks for.
+    """
+    def __init__(self,comm_interface,ps_state,cal_max):
+        self.comm_interface = comm_interface
+        self.ps_state = ps_state
+        self.cal_max = cal_max
+
+    def get_cal_max(self):
+        return str(self.cal_max)
+
+    def get_comm_interface(self):
+        return self.comm_interface
+
+    def get_ps_state(self):
+        return self.ps_state
+
+    def get_pulse_table_file(self):
+        return get_default_pulse_table_path()
+
+def bench_end_to_end(speed=1.0,home=1000,cal_max=2000,cal_inc=25,ramp=10):
+    """ Wall time of whole operations, through the comm interface, data reader and workers the app uses, against the firmware emulator running 'speed' times faster than real time:  the fixed and the adaptive calibration sweep, loading the pulse table from stopped until it's playing, and a ramp of 'ramp' mmHg systolic during playback.  Also how far each calibration is from the emulated cuff (worst case, in mmHg).  If one of them doesn't go through, it and everything after it come out False ('_ok') and None (everything else).
+    """
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    emulator = PSAppFirmwareEmulator(speed=speed)
+    comm_interface = PSAppCommInterface(emulator)
+    broker = PSAppDataBroker()
+    data_iface = {"ser":emulator.data_port,"broker":broker}
+    reader = PSAppDataReader(data_iface,broker)
+    threading.Thread(target=reader.run,daemon=True).start()
+    grid = np.arange(home,cal_max + 1)
+    res = dict()
+    for name in ["calibration","adaptive_calibration"]:
+        res.update({name + "_s":None,name + "_ok":False,name + "_points":None,name + "_err":None})
+    for name in ["load","ramp"]:
+        res.update({name + "_s":None,name + "_ok":False,name + "_steps":None})
+    try:
+        comm_interface.transaction(b'Z'+str(home).encode(),True,timeout=30)
+        for (name,adaptive) in [("calibration",False),("adaptive_calibration",True)]:
+            worker = PSAppCalibrationWorker(comm_interface,data_iface,home,cal_max,cal_inc,adaptive)
+            readings = list()
+            done = list()
+            worker.new_reading.connect(readings.append)
+            worker.finished.connect(lambda: done.append(True))
+            t0 = perf_counter()
+            worker.run()
+            res[name + "_s"] = perf_counter() - t0
+            res[name + "_ok"] = bool(done)
+            if not done:
+                return res
+            readings.sort()
+            model = PSAppCalibrationModel([r[0] for r in readings],[r[1] for r in readings])
+            res[name + "_points"] = len(readings)
+            res[name + "_err"] = float(np.max(np.abs(model.to_mmhg(grid) - emulator.plant.true_mmhg(grid))))
+        ps_state = PSAppState()
+        ps_state.populate_pressure_table(x=[int(s) for s in model.raw_steps],y=model.raw_mmhg.tolist())
+        ps_state.set_state("cal_model",model)
+        parent = _BenchParent(comm_interface,ps_state,cal_max)
+        prev_ps_state = None
+        for name in ["load","ramp"]:
+            if (name == "ramp"):
+                prev_ps_state = copy.deepcopy(ps_state)
+                ps_state.set_state("systolic",ps_state.get_state("systolic") + ramp)
+            worker = PSAppLoadWorker(parent,prev_ps_state)
+            steps = list()
+            worker.point_load_complete.connect(lambda: steps.append(True))
+            worker.point_load_fail.connect(lambda: steps.append(False))
+            t0 = perf_counter()
+            worker.run()
+            res[name + "_s"] = perf_counter() - t0
+            res[name + "_steps"] = len(steps)
+            res[name + "_ok"] = bool(steps) and all(steps)
+        comm_interface.transaction(b'S')
+    finally:
+        reader.stop()
+        comm_interface.stop()
+        emulator.close()
+    return res
+
+# Everything 'main' runs, in order:  the name, what to run, which of its results are worth holding
+# against a baseline (and which way is better:  LOWER for times and errors, HIGHER for rates), and a
+# line for the console.  The rest of each result is there for information, except that anything True
+# or False (outputs agree, operation went through) has to come out True.
+LOWER = -1
+HIGHER = 1
+BENCHMARKS = [
+    ("transaction_latency",bench_transaction_latency,{"p50_us":LOWER},
+        "Transaction latency, back-to-back: mean {mean_us:.1f}us, p50 {p50_us:.1f}us, p99 {p99_us:.1f}us, max {max_us:.1f}us ({n} samples)"),
+    ("transaction_latency_gap",lambda: bench_transaction_latency(n=400,gap=0.005),{"p50_us":LOWER},
+        "Transaction latency, idle gap 5ms: mean {mean_us:.1f}us, p50 {p50_us:.1f}us, p99 {p99_us:.1f}us, max {max_us:.1f}us ({n} samples)"),
+    ("parse_throughput",bench_parse_throughput,{"chunked_lines_per_s":HIGHER},
+        "Data interface parsing: regex {regex_lines_per_s:.0f} lines/s, chunked {chunked_lines_per_s:.0f} lines/s ({speedup:.1f}x), outputs agree: {match}"),
+    ("convert_mpsi",bench_convert_mpsi,{"array_us":LOWER},
+        "mPSI to mmHg, {n} readings: one at a time {loop_us:.0f}us, as an array {array_us:.0f}us, outputs agree: {match}"),
+    ("table_compile",bench_table_compile,{"vectorized_us":LOWER,"cached_us":LOWER},
+        "Position table: loop {loop_us:.0f}us, vectorized {vectorized_us:.0f}us, cached {cached_us:.1f}us per table, outputs agree: {match}"),
+    ("shape_pulse",bench_shape_pulse,{"batch_ms":LOWER},
+        "Pulse shaping, {n} pulses: loop {loop_ms:.0f}ms, batch {batch_ms:.1f}ms, outputs agree: {match}"),
+    ("resample_hr",bench_resample_hr,{"uncached_ms":LOWER,"cached_us":LOWER},
+        "Waveform resampling, {points} points: {uncached_ms:.2f}ms first time, {cached_us:.1f}us cached, {antialias_ms:.2f}ms anti-aliased"),
+    ("waveform_pipeline",bench_waveform_pipeline,{"cold_ms":LOWER,"warm_ms":LOWER},
+        "Waveform file to {ticks} ticks: {cold_ms:.1f}ms cold (load {cold_load_ms:.1f}ms), {warm_ms:.1f}ms warm (load {warm_load_ms:.2f}ms), max step {maxstep}"),
+    ("calibration_model",bench_calibration_model,{"fit_ms":LOWER,"model_ms":LOWER,"model_err":LOWER},
+        "Calibration lookups: raw points {raw_ms:.2f}ms, model {model_ms:.2f}ms (fit {fit_ms:.1f}ms); worst error {raw_err:.0f} steps raw, {model_err:.0f} steps model ({nrejected} readings rejected)"),
+    ("calibration_sweep",bench_calibration_sweep,{"adaptive_s":LOWER,"adaptive_err":LOWER},
+        "Calibration sweep, simulated plant: fixed {fixed_points} points, {fixed_commands} commands, {fixed_s:.2f}s, worst error {fixed_err:.2f}mmHg; adaptive {adaptive_points} points, {adaptive_commands} commands, {adaptive_s:.2f}s, worst error {adaptive_err:.2f}mmHg"),
+    ("drift_tracker",bench_drift_tracker,{"per_sample_us":LOWER,"corrected_err":LOWER},
+        "Drift tracking, 6mmHg leak: {per_sample_us:.1f}us per sample, flagged at {flagged_s}s; calibration off by {stale_err:.2f}mmHg as it was, {corrected_err:.2f}mmHg corrected"),
+    ("end_to_end",bench_end_to_end,{"calibration_s":LOWER,"adaptive_calibration_s":LOWER,"load_s":LOWER,"ramp_s":LOWER},
+        "End to end, emulated device: calibration {calibration_s:.2f}s (adaptive {adaptive_calibration_s:.2f}s), load {load_s:.2f}s, ramp {ramp_s:.2f}s over {ramp_steps} steps") ]
+
+def compare(results,baseline,tolerance=REGRESSION_TOLERANCE):
+    """ Everything in 'results' that has got worse since 'baseline' (both as saved by 'main'), as a list of lines for the console.  A compared result has to be more than 'tolerance' (a fraction) worse to count; anything that should have come out True and didn't always counts.  Benchmarks that aren't in both are left out.
+    """
+    worse = list()
+    for (name,fn,watch,summary) in BENCHMARKS:
+        (res,base) = (results.get(name),baseline.get(name))
+        if res is None:
+            continue
+        for (key,val) in res.items():
+            if (val is False):
+                worse.append("{}: {} came out False".format(name,key))
+        if base is None:
+            continue
+        for (key,better) in watch.items():
+            (val,ref) = (res.get(key),base.get(key))
+            if (val is None) or (ref is None):
+                continue
+            if (better == LOWER):
+                regressed = (val > ref * (1.0 + tolerance)) if ref else (val > 0)
+            else:
+                regressed = (val * (1.0 + tolerance) < ref)
+            if regressed:
+                change = "{:+.0f}%".format((val / ref - 1.0) * 100.0) if ref else "from 0"
+                worse.append("{}: {} {:.4g} against {:.4g} in the baseline ({})".format(name,key,val,ref,change))
+    return worse
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the host-side hot paths, against the firmware emulator.")
+    parser.add_argument("--only",nargs="+",metavar="NAME",help="run just these benchmarks")
+    parser.add_argument("--list",action="store_true",help="list the benchmarks and exit")
+    parser.add_argument("--json",metavar="FILE",help="save the results here")
+    parser.add_argument("--baseline",metavar="FILE",help="results saved by an earlier run, to compare against")
+    parser.add_argument("--tolerance",type=float,default=REGRESSION_TOLERANCE,help="how much worse (a fraction) a result can get before it counts (default %(default)s)")
+    args = parser.parse_args(argv)
+    names = [b[0] for b in BENCHMARKS]
+    if args.list:
+        print("\n".join(names))
+        return 0
+    for name in (args.only or []):
+        if name not in names:
+            parser.error("no benchmark called '{}'; --list shows them all".format(name))
+    results = dict()
+    for (name,fn,watch,summary) in BENCHMARKS:
+        if args.only and (name not in args.only):
+            continue
+        results[name] = fn()
+        try:
+            print(summary.format(**results[name]))
+        except (KeyError,TypeError,ValueError):
+            # Something didn't go through and left gaps; show what there is, and carry on
+            print("{} (incomplete): {}".format(name,", ".join(["{} {}".format(k,v) for (k,v) in sorted(results[name].items())])))
+    if args.json:
+        with open(args.json,'w') as fh:
+            json.dump({"format":RESULTS_FORMAT,
+                       "created":time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "host":platform.node(),
+                       "python":platform.python_version(),
+                       "numpy":np.__version__,
+                       "results":results},fh,indent=1)
+    baseline = dict()
+    if args.baseline:
+        with open(args.baseline,'r') as fh:
+            saved = json.load(fh)
+        if (saved.get("format") != RESULTS_FORMAT):
+            parser.error("'{}' isn't a results file from this version".format(args.baseline))
+        baseline = saved["results"]
+    worse = compare(results,baseline,args.tolerance)
+    for line in worse:
+        print("WORSE  " + line)
+    if args.baseline and not worse:
+        print("Nothing worse than the baseline (tolerance {:.0f}%)".format(args.tolerance * 100.0))
+    return 1 if worse else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,10 @@
 from PyQt5.QtCore import * 
 from PyQt5.QtGui import * 
 from PyQt5.QtWidgets import * 
-import re
+import re, sys
 from time import sleep
+sys.path.append("./math")
+from PSAppCalibrationSweep import PSAppCalibrationSweep, settle, sweep_grid
 from PSAppSharedFunctions import convert_mpsi_to_mmhg
 
 class PSAppCalibrationWorker(QObject):
@@ -11,8 +13,8 @@ class PSAppCalibrationWorker(QObject):
     new_reading = pyqtSignal(object)
     reading_error = pyqtSignal()
     finished = pyqtSignal()
-    def __init__(self,comm_interface,data_iface,home,cal_max,cal_inc):
-        """ Initialization function.
+    def __init__(self,comm_interface,data_iface,home,cal_max,cal_inc,adaptive=False,positions=None,settled=False):
+        """ Initialization function.  With 'adaptive', the sweep is done coarse first and then filled in where it needs it (see PSAppCalibrationSweep), instead of stopping at every increment.  Otherwise, it stops at 'positions' (in order, starting with home) if given, or else every 'cal_inc' from home to 'cal_max'; with 'settled', each of those readings is taken again until the pressure stops changing (see 'settle').
         """
         super(PSAppCalibrationWorker,self).__init__()
         self.comm_interface = comm_interface
@@ -20,20 +22,27 @@ class PSAppCalibrationWorker(QObject):
         self.current_pos = home
         self.range_max = cal_max
         self.step = cal_inc
+        self.adaptive = adaptive
+        self.positions = positions
+        self.settled = settled
+        self.sweep = None
+        self.readings = None
 
     def send_comm(self,comm,reply,mode_char=None):
-        """ The same procedure is run, but with different commands.
+        """ The same procedure is run, but with different commands.  The reading (if any) comes in through the data broker, which has been listening the whole time.
         """
         try:
-            cmd_ret = self.comm_interface.transaction(comm,True)
+            self.readings.clear()
+            cmd_ret = self.comm_interface.transaction(comm,True,deadline=10)
             rem = re.match(reply,cmd_ret)
             if not rem:
                 self.reading_error.emit()
                 return None
             if mode_char:
-                rem = re.match(mode_char+b',\d+,\d+,(\d+)',self.data_iface["ser"].readline())
-                if rem:
-                    return int(rem.group(1))
+                # Moves can take a while; give the reading time to show up
+                sample = self.readings.get(timeout=5)
+                if sample and (sample.mode == mode_char):
+                    return sample.mpsi
                 self.reading_error.emit()
                 return None
         except:
@@ -43,17 +52,56 @@ class PSAppCalibrationWorker(QObject):
     def run(self):
         """ Run through points...
         """
-        # Before running increment, run a plain read for the 'Home' point...
-        ret_val = self.send_comm(b'R',b'^OK',b'R')
-        if not ret_val:
-            return
-        self.new_reading.emit([self.current_pos,convert_mpsi_to_mmhg(ret_val)])
-        while (self.current_pos < self.range_max):
-            sleep(0.1)
-            ret_val = self.send_comm(b'I'+str(self.step).encode(),b'^OK',b'I')
-            if not ret_val:
+        self.readings = self.data_iface["broker"].subscribe(b'RI',maxlen=16)
+        try:
+            if self.adaptive:
+                self._run_adaptive()
+            else:
+                self._run()
+        finally:
+            self.data_iface["broker"].unsubscribe(self.readings)
+
+    def _run(self):
+        read = lambda: self._read_mmhg(b'R',b'R')
+        positions = self.positions if (self.positions is not None) else sweep_grid(self.current_pos,self.range_max,self.step).tolist()
+        for pos in positions:
+            # A plain read for the 'Home' point, and an increment for the rest
+            if (pos == self.current_pos):
+                reading = read()
+            else:
+                if not self.settled:
+                    sleep(0.1)
+                reading = self._read_mmhg(b'I'+str(pos - self.current_pos).encode(),b'I')
+            if self.settled:
+                (reading,nreads) = settle(reading,read)
+            if reading is None:
                 return
-            self.current_pos += self.step
-            self.new_reading.emit([self.current_pos,convert_mpsi_to_mmhg(ret_val)])
+            self.current_pos = pos
+            self.new_reading.emit([pos,reading])
+        self.send_comm(b'G',b'^OK',b'R')
+        self.finished.emit()
+
+    def _read_mmhg(self,comm,mode_char):
+        ret_val = self.send_comm(comm,b'^OK',mode_char)
+        return convert_mpsi_to_mmhg(ret_val) if ret_val else None
+
+    def _run_adaptive(self):
+        """ Same as '_run', but only stopping where it's needed, and moving on as soon as the pressure stops changing instead of after a fixed wait.  Readings come out of order (each pass starts again from home), so they're emitted as they come in and sorted out by whoever is listening.
+        """
+        self.sweep = PSAppCalibrationSweep(self.current_pos,self.range_max,self.step)
+        ok = self.sweep.run(lambda n: self._read_mmhg(b'I'+str(n).encode(),b'I'),
+                            lambda: self._read_mmhg(b'R',b'R'),
+                            lambda: self._read_mmhg(b'G',b'R'),
+                            lambda pos,mmhg: self.new_reading.emit([pos,mmhg]))
+        if not ok:
+            return
         self.send_comm(b'G',b'^OK',b'R')
         self.finished.emit()
+
+class PSAppSpotCheckWorker(PSAppCalibrationWorker):
+    """ Quick check of a saved calibration:  reads at just a few 'positions' (in order, starting with home), instead of the whole sweep.  Same signals as the calibration worker.
+    """
+    def __init__(self,comm_interface,data_iface,home,positions):
+        """ Initialization function.
+        """
+        super(PSAppSpotCheckWorker,self).__init__(comm_interface,data_iface,home,positions[-1],1,positions=positions,settled=True)
@@ -1,101 +1,295 @@
 from PyQt5.QtCore import *
-import re, queue
-from time import sleep
+import collections, concurrent.futures, re, threading
+from time import monotonic, sleep
 from PSAppSharedFunctions import PSCommException
+from PSAppCommStats import PSAppCommStats, new_tally
+from PSAppDefaults import get_default_comm_deadline
+from PSAppProtocol import BLOCK_CMD, BATCH_CMD, MAX_BATCH_LENGTH, PROBE_TIMEOUT, HandshakeRead, HandshakeWait, PSAppTimeoutEstimator, batch_body, handshake, is_batchable, pack_batch_frame
+
+class PSAppCommRequest(object):
+    """ One command on its way through the worker.  The reply goes into 'future', which is what 'transaction_async' hands back to the caller.
+    """
+    def __init__(self,cmd,read_response,timeout,payload,deadline=None):
+        """ Initialization function.  'deadline' is an absolute time (time.monotonic) by which the request has to be done; past that point it's failed rather than sent, and a handshake in progress stops retrying.
+        """
+        self.cmd = cmd
+        self.read_response = read_response
+        self.timeout = timeout
+        self.payload = payload
+        self.deadline = deadline
+        self.future = concurrent.futures.Future()
 
 class PSAppCommInterfaceWorker(QObject):
     """ Worker class for communication with the configuration interface on the Pulse Simulator hardware.
     """
-    def __init__(self,cfg_iface,request_queue,return_queue):
-        """ Initialization function.
+    def __init__(self,cfg_iface,keepalive=18.0,stats=None,timeouts=None):
+        """ Initialization function.  'keepalive' is how long the interface can sit idle before we send a version request ('V'); the firmware watchdog resets everything after 20 seconds of silence.  Every transaction is counted in 'stats' (a PSAppCommStats), if given, and handshake timeouts come from 'timeouts' (a PSAppTimeoutEstimator) if that's given.
         """
         super(PSAppCommInterfaceWorker,self).__init__()
         self.cfg_iface = cfg_iface
-        self.request_queue = request_queue
-        self.return_queue = return_queue
-        self.ngets = 0
+        self.keepalive = keepalive
+        self.stats = stats
+        self.timeouts = timeouts
+        self.cond = threading.Condition()
+        self.requests = collections.deque()
         self.is_running = False
+        self.stopped = False
 
     def run(self):
         """ Worker 'run' function
         """
-        self.is_running = True
-        # Sit in a loop, constantly seeing if a new request has come in.  Check this every 100ms.  If
-        # no new requests have been made after 18 seconds (180 loop iterations at 100ms apiece), then
-        # send a version request ('V').
-        while self.is_running:
-            try:
-                [cmd,read_response,timeout] = self.request_queue.get(timeout=0.1)
-                retq = True
-            except:
-                self.ngets += 1
-                if (self.ngets < 180):
-                    continue
-                self.ngets = 0
-                [cmd,read_response,timeout] = [b'V',True,0.5]
-                retq = False
-            match = False
-            self.cfg_iface.timeout = timeout
-            for i in range(10):
-                self.cfg_iface.write(cmd+b'\n')
-                ret = self.cfg_iface.readline()
-                while (len(ret) == 0):
-                    self.cfg_iface.write(cmd+b'\n')
-                    ret = self.cfg_iface.readline()
-                rem = re.match(b'^ERR: Busy',ret)
-                if (rem):
-                    continue
-                if (ret.rstrip() == cmd):
-                    self.cfg_iface.write(b'\n')
-                    match = True
+        with self.cond:
+            self.is_running = True
+        # Sleep until either a request comes in or the keepalive deadline passes, whichever happens
+        # first.  The deadline is pushed back every time anything goes out over the interface, so the
+        # 'V' only gets sent when the interface really has been quiet for that long.
+        deadline = monotonic() + self.keepalive
+        while True:
+            with self.cond:
+                while (self.is_running and not(self.requests)):
+                    remaining = deadline - monotonic()
+                    if (remaining <= 0):
+                        break
+                    self.cond.wait(remaining)
+                if not self.is_running:
                     break
+                request = self.requests.popleft() if self.requests else None
+            if request is None:
+                request = PSAppCommRequest(b'V',True,0.5,None,monotonic() + get_default_comm_deadline())
+            # Anything cancelled while it sat in the queue never goes out
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            if (request.deadline is not None) and (monotonic() > request.deadline):
+                if self.stats:
+                    self.stats.record_expired(request.cmd)
+                request.future.set_exception(PSCommException("Deadline passed before command could be sent, command = '{}'".format(request.cmd.decode())))
+                continue
+            try:
+                request.future.set_result(self._handshake(request.cmd,request.read_response,request.timeout,request.payload,request.deadline))
+            except PSCommException as e:
+                # Hand the failure back to whoever made the request; raising it here would only take
+                # down this thread and leave the caller waiting forever.
+                request.future.set_exception(e)
+            except Exception as e:
+                # Same goes for the serial port itself going away underneath us
+                request.future.set_exception(PSCommException("Communication failed, command = '{}': {}".format(request.cmd.decode(),e)))
+            deadline = monotonic() + self.keepalive
+        # Don't leave anybody hanging on a request that will never be sent
+        with self.cond:
+            self.stopped = True
+            while self.requests:
+                request = self.requests.popleft()
+                if request.future.set_running_or_notify_cancel():
+                    request.future.set_exception(PSCommException("Communication interface has been shut down."))
+
+    def submit(self,request):
+        """ Queue up a request and wake the worker; it goes out as soon as anything ahead of it is done.
+        """
+        with self.cond:
+            if self.stopped:
+                if request.future.set_running_or_notify_cancel():
+                    request.future.set_exception(PSCommException("Communication interface has been shut down."))
+                return
+            self.requests.append(request)
+            self.cond.notify()
+
+    def _handshake(self,cmd,read_response,timeout,payload,deadline=None):
+        """ Run a single command through the echo handshake (see 'handshake' in PSAppProtocol), doing the reads, writes and waits it asks for on the serial port.
+        """
+        tally = new_tally()
+        steps = handshake(cmd,read_response,payload,deadline,tally,timeout,self.timeouts)
+        line = None
+        error = False
+        t0 = monotonic()
+        try:
+            while True:
+                out = steps.send(line)
+                if isinstance(out,HandshakeRead):
+                    # Changing the timeout reconfigures a real port, so only when it has to
+                    if (self.cfg_iface.timeout != out.timeout):
+                        self.cfg_iface.timeout = out.timeout
+                    line = self.cfg_iface.readline()
+                elif isinstance(out,HandshakeWait):
+                    sleep(out.seconds)
+                    line = None
                 else:
-                    self.cfg_iface.write(b'!')
-            if not match:
-                raise PSCommException("Command handshake failed, command = '{}'".format(cmd.decode()))
-            else:
-                ret = ''
-                if read_response:
-                    for i in range(10):
-                        ret = self.cfg_iface.readline()
-                        if (len(ret) > 0):
-                            break
-                    if (len(ret) == 0):
-                        raise PSCommException("Read never returned a valid value.")
-                if retq:
-                    self.return_queue.put(ret)
+                    self.cfg_iface.write(out)
+                    line = None
+        except StopIteration as e:
+            return e.value
+        except Exception as e:
+            # Handshake failures are counted by the handshake itself
+            error = not isinstance(e,PSCommException)
+            raise
+        finally:
+            if self.stats:
+                self.stats.record(cmd,monotonic() - t0,tally,error)
 
     def shutdown(self):
-        self.is_running = False
+        with self.cond:
+            self.is_running = False
+            self.cond.notify()
 
 class PSAppCommInterface(QObject):
     """ Use a unified interface to talk to the configuration interface in firmware.  Communication seems to be spotty, so handshake between the firmware and this script to get rid of possible ambiguities."""
-    def __init__(self,cfg_iface):
-        """ Initialization function
+    def __init__(self,cfg_iface,deadline=None):
+        """ Initialization function.  'deadline' is how long (seconds) a transaction gets, at most, when the caller doesn't say; None means the default (see 'get_default_comm_deadline').
         """
         super(PSAppCommInterface,self).__init__()
         self.done = False
         self.cfg_iface = cfg_iface
-        self.request_queue = queue.Queue()
-        self.return_queue = queue.Queue()
+        self.deadline = get_default_comm_deadline() if (deadline is None) else deadline
+        # Commands that only newer firmware understands.  'None' means we don't know yet; the first
+        # attempt to use one settles it for the rest of the connection.
+        self.supported = {BLOCK_CMD:None, BATCH_CMD:None}
+        # Counts and round trip times of everything that goes over; see 'stats'
+        self.comm_stats = PSAppCommStats()
+        # Handshake timeouts, from how long things have been taking; see 'timeouts'
+        self.comm_timeouts = PSAppTimeoutEstimator()
+        # 'transaction_batch' makes several round trips of its own, so the async version of it runs
+        # here rather than on the caller's thread
+        self.batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._start()
+
+    def _start(self):
+        """ Bring up whatever actually moves requests over the interface; here, a worker on its own thread.
+        """
         self.comm_thread = QThread()
-        self.comm_worker = PSAppCommInterfaceWorker(self.cfg_iface,self.request_queue,self.return_queue)
+        self.comm_worker = PSAppCommInterfaceWorker(self.cfg_iface,stats=self.comm_stats,timeouts=self.comm_timeouts)
         self.comm_worker.moveToThread(self.comm_thread)
         self.comm_thread.started.connect(self.comm_worker.run)
         self.comm_thread.start()
 
+    def _shutdown(self):
+        self.comm_worker.shutdown()
+        self.comm_thread.quit()
+        self.comm_thread.wait()
+
+    def _send_batch(self,cmds,timeout):
+        """ Send a run of batchable commands as one 'P' frame.  Returns how many of them the firmware ran; the firmware stops at the first one it can't run from a batch, and nothing after that point has happened.
+        """
+        payload = pack_batch_frame(cmds)
+        header = BATCH_CMD+str(len(batch_body(cmds))).encode()
+        for i in range(3):
+            try:
+                probe = (self.get_supported(BATCH_CMD) is None)
+                cmd_ret = self.transaction(header,True,PROBE_TIMEOUT if probe else timeout,payload)
+            except PSCommException:
+                # Older firmware never echoes 'P'; nothing has been run, so the caller can just go one
+                # command at a time.
+                if (self.get_supported(BATCH_CMD) is None):
+                    self.set_supported(BATCH_CMD,False)
+                    return 0
+                raise
+            self.set_supported(BATCH_CMD,True)
+            rem = re.match(b'^OK:\s+Batch length\s+=\s+(\d+)',cmd_ret)
+            if rem:
+                return int(rem.group(1))
+            rem = re.match(b'^ERR:\s+Batch stopped at\s+=\s+(\d+)',cmd_ret)
+            if rem:
+                return int(rem.group(1))
+            # CRC, length or timeout errors mean the frame was thrown away as a whole; send it again
+        raise PSCommException("Batch transfer failed, last response = '{}'".format(cmd_ret.decode().rstrip()))
+
+    def dump_stats(self,path):
+        """ Write 'stats' out to 'path' as CSV.
+        """
+        self.comm_stats.write_csv(path)
+
+    def _get_deadline(self,deadline,timeout):
+        """ The caller's deadline, or if there isn't one, the interface's; but never less than the caller's timeout, which the caller is clearly prepared to wait.
+        """
+        return max(self.deadline,timeout) if (deadline is None) else deadline
+
+    def get_supported(self,cmd):
+        return self.supported.get(cmd)
+
     def is_done(self):
         return self.done
 
+    def reset_stats(self):
+        self.comm_stats.reset()
+
+    def set_deadline(self,deadline):
+        self.deadline = deadline
+
+    def set_supported(self,cmd,val):
+        self.supported[cmd] = val
+
+    def stats(self):
+        """ How every command has fared over the interface since the connection was made (or 'reset_stats'):  counts, retries, busy responses, empty reads, failures and round trip times, by command letter.  See 'PSAppCommStats.get_stats' for what's in it.
+        """
+        return self.comm_stats.get_stats()
+
+    def timeouts(self):
+        """ Smoothed round trip times, their variation and the timeouts worked out from them, by handshake phase and command letter; see 'PSAppTimeoutEstimator.get_estimates'.
+        """
+        return self.comm_timeouts.get_estimates()
+
     def stop(self):
+        self.batch_executor.shutdown()
         self.transaction(b'Q')
-        self.comm_worker.shutdown()
-        self.comm_thread.quit()
-        self.comm_thread.wait()
+        self._shutdown()
         self.done = True
 
-    def transaction(self,cmd,read_response=False,timeout=0.5):
+    def transaction_batch(self,cmds,timeout=0.5):
+        """ Run a sequence of commands with as few round trips as possible.  Each entry in 'cmds' is either a command, or a [cmd,read_response] pair; the return value is a list with one response per command, the same as 'transaction' would have given back.
+
+        Runs of simple commands (see BATCHABLE_CMDS) are written back to back in one 'P' frame and acknowledged together.  Anything the firmware refuses to run from a batch, and anything that needs its own response, is retried/sent through 'transaction', in order.  On firmware without 'P' this is the same as calling 'transaction' once per command.
+        """
+        requests = [[cmd,False] if isinstance(cmd,bytes) else list(cmd) for cmd in cmds]
+        responses = list()
+        i = 0
+        while (i < len(requests)):
+            # Gather up the longest run of commands that can share a frame
+            run = list()
+            nbytes = 0
+            if (self.get_supported(BATCH_CMD) is not False):
+                for [cmd,read_response] in requests[i:]:
+                    if read_response or not(is_batchable(cmd)) or ((nbytes + len(cmd) + 1) > MAX_BATCH_LENGTH):
+                        break
+                    run.append(cmd)
+                    nbytes += len(cmd) + 1
+            if (len(run) > 1):
+                ndone = self._send_batch(run,timeout)
+                responses += [''] * ndone
+                i += ndone
+                if (ndone == len(run)):
+                    continue
+            # Either a lone command, or the one the batch stopped at; send it the usual way
+            [cmd,read_response] = requests[i]
+            responses.append(self.transaction(cmd,read_response,timeout))
+            i += 1
+        return responses
+
+    def transaction_batch_async(self,cmds,timeout=0.5):
+        """ Same as 'transaction_batch', but returns a future for the list of responses right away.  Anything that depends on these commands having run (e.g. the 'E' after a load) shouldn't be sent until the future is done.
+        """
+        return self.batch_executor.submit(self.transaction_batch,cmds,timeout)
+
+    def transaction(self,cmd,read_response=False,timeout=0.5,payload=None,deadline=None):
         """ Originally, this command would just go through its paces, communicate with the firmware, and then return a value.  However, I've implemented a watchdog on the configuration interface so that if the app ever crashes or leaves the firmware in a weird state, the firmware should go ahead and reset itself.
+
+        If 'payload' is given, it's written to the interface as soon as the handshake for 'cmd' completes; this is how binary frames (e.g. 'K') get sent.  'timeout' is the longest any one read waits; reads are usually a good deal shorter than that, going by how long the same thing took before (see PSAppTimeoutEstimator).  Handshake failures are raised here as PSCommException.  This blocks until the reply is in; see 'transaction_async' for the non-blocking version.
+        """
+        deadline = self._get_deadline(deadline,timeout)
+        future = self.transaction_async(cmd,read_response,timeout,payload,deadline)
+        return self.wait_result(future,None if (deadline is None) else (deadline + timeout))
+
+    def transaction_async(self,cmd,read_response=False,timeout=0.5,payload=None,deadline=None):
+        """ Queue up a transaction and return right away with a 'concurrent.futures.Future' for the reply, so that the caller can get on with something else while the command is in flight.  Requests go out strictly in the order they were made.
+
+        'deadline' is how many seconds from now the caller is willing to wait (the interface's own deadline if not given); a request that hasn't gone out by then is failed without being sent, and one that's in progress stops retrying.  A request can also be dropped with 'future.cancel()', up until the worker picks it up.
+        """
+        request = PSAppCommRequest(cmd,read_response,timeout,payload,monotonic() + self._get_deadline(deadline,timeout))
+        self.comm_worker.submit(request)
+        return request.future
+
+    def wait_result(self,future,timeout=None):
+        """ Wait on a future from 'transaction_async' and return the reply.  If nothing shows up within 'timeout' seconds, the request is cancelled (if it hasn't gone out yet) and PSCommException is raised.
         """
-        self.request_queue.put([cmd,read_response,timeout])
-        return self.return_queue.get()
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise PSCommException("No reply within {} seconds.".format(timeout))
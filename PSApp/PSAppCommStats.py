@@ -0,0 +1,149 @@
+import bisect, csv, threading
+
+# What each command costs over the configuration interface.  The handshake quietly re-sends a command
+# when the firmware says it's busy, when the echo comes back wrong, or when nothing comes back at all;
+# none of that shows up to the caller except as time.  Every transaction is counted here, by command
+# letter, along with its round trip time (from the first write to the response, not counting time
+# spent waiting in the queue) and what it took to get through.
+#
+# Round trip times go into a histogram; these are the upper edges of its bins, in milliseconds, and
+# anything past the last one goes into one more bin at the end.
+HISTOGRAM_EDGES = [0.25,0.5,1,2,5,10,20,50,100,200,500,1000,2000,5000]
+# Everything the handshake tallies up as it goes (see 'handshake' in PSAppProtocol)
+TALLY_FIELDS = ["sends","busy","empty","mismatches","handshake_failures","response_failures"]
+# Columns of 'write_csv', before the histogram
+CSV_FIELDS = ["command","count","failures","handshake_failures","response_failures","errors","expired","retries","busy","empty","mismatches","mean_ms","p50_ms","p99_ms","max_ms"]
+
+def new_tally():
+    return dict([(k,0) for k in TALLY_FIELDS])
+
+def histogram_labels():
+    return ["<={}ms".format(e) for e in HISTOGRAM_EDGES] + [">{}ms".format(HISTOGRAM_EDGES[-1])]
+
+def histogram_percentile(hist,q):
+    """ Upper edge (ms) of the bin that the 'q'th (0 to 1) fraction of 'hist' falls in; None if it's empty, and infinity if it's the last bin.
+    """
+    n = sum(hist)
+    if not n:
+        return None
+    total = 0
+    for (i,count) in enumerate(hist):
+        total += count
+        if (total >= q * n):
+            break
+    return HISTOGRAM_EDGES[i] if (i < len(HISTOGRAM_EDGES)) else float("inf")
+
+class PSAppCommCounters(object):
+    """ Counters for one command.
+    """
+    def __init__(self):
+        """ Initialization function.
+        """
+        self.count = 0
+        self.errors = 0
+        self.expired = 0
+        self.tally = new_tally()
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.hist = [0] * (len(HISTOGRAM_EDGES) + 1)
+
+    def add(self,other):
+        self.count += other.count
+        self.errors += other.errors
+        self.expired += other.expired
+        for k in TALLY_FIELDS:
+            self.tally[k] += other.tally[k]
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms,other.max_ms)
+        self.hist = [a + b for (a,b) in zip(self.hist,other.hist)]
+
+    def summary(self):
+        """ Everything as a dictionary; see 'PSAppCommStats.get_stats'.
+        """
+        stats = dict()
+        stats["count"] = self.count
+        stats["failures"] = self.tally["handshake_failures"] + self.tally["response_failures"] + self.errors + self.expired
+        stats["errors"] = self.errors
+        stats["expired"] = self.expired
+        for k in TALLY_FIELDS:
+            stats[k] = self.tally[k]
+        # The first send of every transaction that got as far as being sent isn't a retry
+        stats["retries"] = max(0,self.tally["sends"] - (self.count - self.expired))
+        timed = sum(self.hist)
+        stats["mean_ms"] = (self.total_ms / timed) if timed else 0.0
+        stats["p50_ms"] = histogram_percentile(self.hist,0.5)
+        stats["p99_ms"] = histogram_percentile(self.hist,0.99)
+        stats["max_ms"] = self.max_ms
+        stats["histogram"] = list(self.hist)
+        return stats
+
+class PSAppCommStats(object):
+    """ Keeps count of every transaction through a comm interface, by command letter.  'record' is called from whichever thread runs the handshakes, the rest from anywhere.
+    """
+    def __init__(self):
+        """ Initialization function.
+        """
+        self.lock = threading.Lock()
+        self.commands = dict()
+
+    def _counters(self,cmd):
+        key = cmd[:1].decode(errors="replace")
+        if key not in self.commands:
+            self.commands[key] = PSAppCommCounters()
+        return self.commands[key]
+
+    def record(self,cmd,seconds,tally,error=False):
+        """ One transaction of 'cmd' is done:  it took 'seconds' from first write to last read, and 'tally' is what the handshake counted along the way.  'error' means it failed for some other reason than the handshake (e.g. the port went away).
+        """
+        ms = seconds * 1e3
+        with self.lock:
+            counters = self._counters(cmd)
+            counters.count += 1
+            if error:
+                counters.errors += 1
+            for k in TALLY_FIELDS:
+                counters.tally[k] += tally[k]
+            counters.total_ms += ms
+            counters.max_ms = max(counters.max_ms,ms)
+            counters.hist[bisect.bisect_left(HISTOGRAM_EDGES,ms)] += 1
+
+    def record_expired(self,cmd):
+        """ 'cmd' was never sent, since its deadline had passed by the time it came up.
+        """
+        with self.lock:
+            counters = self._counters(cmd)
+            counters.count += 1
+            counters.expired += 1
+
+    def get_stats(self):
+        """ Counters for every command seen so far, as a dictionary of dictionaries keyed by command letter, plus 'All' for everything together.  Each one has 'count' (transactions), 'failures' (of any kind, broken down into 'handshake_failures', 'response_failures', 'errors' and 'expired'), 'retries' (re-sends of the command, for whatever reason), 'busy', 'empty' (reads that timed out), 'mismatches' (wrong echo), the mean, median, 99th percentile and maximum round trip in ms, and 'histogram' (counts per bin of HISTOGRAM_EDGES).  The percentiles only go as fine as the histogram bins.
+        """
+        total = PSAppCommCounters()
+        stats = dict()
+        with self.lock:
+            for (key,counters) in self.commands.items():
+                stats[key] = counters.summary()
+                total.add(counters)
+        stats["All"] = total.summary()
+        return stats
+
+    def reset(self):
+        with self.lock:
+            self.commands = dict()
+
+    def write_csv(self,path):
+        """ Save 'get_stats' to 'path' as CSV:  one row per command, with 'All' last, and a column per histogram bin after the counters.
+        """
+        stats = self.get_stats()
+        with open(path,'w',newline='') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(CSV_FIELDS + histogram_labels())
+            for key in sorted([k for k in stats if (k != "All")]) + ["All"]:
+                row = dict(stats[key],command=key)
+                writer.writerow([row[f] for f in CSV_FIELDS] + row["histogram"])
+
+def format_comm_stats(stats):
+    """ One line summary of the 'All' entry of 'PSAppCommStats.get_stats', for showing to a human.
+    """
+    s = stats["All"]
+    return "{} transactions, {} failed, {} retries ({} busy, {} empty reads, {} bad echoes), mean {:.2f}ms, max {:.1f}ms".format(s["count"],s["failures"],s["retries"],s["busy"],s["empty"],s["mismatches"],s["mean_ms"],s["max_ms"])
@@ -3,7 +3,7 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import * 
 from serial.tools.list_ports import comports
 import serial
-import re
+import os, re
 
 XMOS_VID = 0x20B1
 XMOS_PID = 0x0401
@@ -17,21 +17,34 @@ class PSAppFindInterfaces(QObject):
     def __init__(self):
         super(PSAppFindInterfaces,self).__init__()
 
-    def run(self):
+    def _candidates(self):
+        """ Ports that might be ours, already open, along with their port info.  With PSAPP_EMULATOR set (to how many times faster than real time it should run), it's the two interfaces of the firmware emulator instead, and there's no port info.
+        """
+        if os.environ.get("PSAPP_EMULATOR"):
+            # Only pulled in when asked for; a real session never needs it
+            from PSAppEmulator import PSAppFirmwareEmulator
+            emulator = PSAppFirmwareEmulator(speed=float(os.environ["PSAPP_EMULATOR"]))
+            for ser in [emulator,emulator.data_port]:
+                ser.timeout = 0.5
+                yield (ser,None)
+            return
         # Look for comports with the XMOS VID/PID
+        for lpi in comports():
+            if (lpi.vid == XMOS_VID) and (lpi.pid == XMOS_PID):
+                # Odds are that this is one of our ports; open it and query it.
+                yield (serial.Serial(lpi.name,timeout=0.5),lpi)
+
+    def run(self):
         try:
-            for lpi in comports():
-                if (lpi.vid == XMOS_VID) and (lpi.pid == XMOS_PID):
-                    # Odds are that this is one of our ports; open it and query it.
-                    ser = serial.Serial(lpi.name,timeout=0.5)
-                    ser.write(b'?')
-                    # Now try to match the correct interface
-                    rem = re.match(b'^Interface:\s+(config|data)',ser.readline())
-                    if rem:
-                        if (rem.group(1) == b'config'):
-                            self.cfg_iface_found.emit({"ser":ser, "lpi":lpi})
-                        if (rem.group(1) == b'data'):
-                            self.data_iface_found.emit({"ser":ser, "lpi":lpi})
+            for (ser,lpi) in self._candidates():
+                ser.write(b'?')
+                # Now try to match the correct interface
+                rem = re.match(b'^Interface:\s+(config|data)',ser.readline())
+                if rem:
+                    if (rem.group(1) == b'config'):
+                        self.cfg_iface_found.emit({"ser":ser, "lpi":lpi})
+                    if (rem.group(1) == b'data'):
+                        self.data_iface_found.emit({"ser":ser, "lpi":lpi})
         except:
              pass
         self.parsing_finished.emit()
@@ -0,0 +1,220 @@
+from PyQt5.QtCore import *
+import collections, threading
+import numpy as np
+from time import monotonic
+from PSAppSampleParser import MALFORMED, SAMPLE_DTYPE, PSAppSampleParser, sample_from_row
+
+# What a subscription does when its queue is full and another sample comes in:
+#   * DROP_OLDEST throws away the oldest sample it's holding; right for anything that only cares
+#     about what's happening now (the plot, the pressure readout).
+#   * DROP_NEWEST throws away the incoming sample.
+#   * BLOCK holds up the reader until there's room.  Nothing is lost, but a subscriber that stops
+#     reading stalls everyone else, so only use it for things like a recorder that keeps up.
+DROP_OLDEST = 0
+DROP_NEWEST = 1
+BLOCK = 2
+
+class PSAppDataSubscription(object):
+    """ One consumer's view of the data interface:  a bounded queue of samples (rows of SAMPLE_DTYPE), optionally filtered down to some of the modes.  Samples are kept in the arrays they arrived in, and can be taken out one at a time ('get') or all at once ('get_batch').
+    """
+    def __init__(self,modes=None,maxlen=1024,policy=DROP_OLDEST):
+        """ Initialization function.  'modes' is a bytes string of mode characters (e.g. b'W'); None takes everything, including lines that didn't parse (mode MALFORMED).
+        """
+        self.modes = None if (modes is None) else np.array([modes[i:(i + 1)] for i in range(len(modes))],dtype="S1")
+        self.maxlen = maxlen
+        self.policy = policy
+        self.chunks = collections.deque()
+        self.count = 0
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def _trim(self,n,oldest):
+        """ Throw away 'n' samples, from the front of the queue if 'oldest', otherwise from the back.
+        """
+        self.dropped += n
+        self.count -= n
+        while (n > 0):
+            chunk = self.chunks[0] if oldest else self.chunks[-1]
+            if (len(chunk) <= n):
+                n -= len(chunk)
+                self.chunks.popleft() if oldest else self.chunks.pop()
+            elif oldest:
+                self.chunks[0] = chunk[n:]
+                n = 0
+            else:
+                self.chunks[-1] = chunk[:(len(chunk) - n)]
+                n = 0
+
+    def _wait(self,timeout):
+        deadline = None if (timeout is None) else (monotonic() + timeout)
+        while not(self.count) and not(self.closed):
+            remaining = None if (deadline is None) else (deadline - monotonic())
+            if (remaining is not None) and (remaining <= 0):
+                break
+            self.cond.wait(remaining)
+
+    def clear(self):
+        """ Throw away anything that's queued up; handy right before asking the firmware for a fresh reading.
+        """
+        with self.cond:
+            self.chunks.clear()
+            self.count = 0
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def drain(self):
+        """ Everything that's queued up, oldest first, without waiting.
+        """
+        return self.get_batch(0)
+
+    def filter(self,samples):
+        """ The rows of 'samples' that this subscription is interested in.
+        """
+        if self.modes is None:
+            return samples
+        return samples[np.isin(samples["mode"],self.modes)]
+
+    def get(self,timeout=None):
+        """ Next sample as a PSAppSample, or None if nothing shows up within 'timeout' seconds (or the subscription is closed).
+        """
+        with self.cond:
+            self._wait(timeout)
+            if not self.count:
+                return None
+            chunk = self.chunks[0]
+            if (len(chunk) == 1):
+                self.chunks.popleft()
+            else:
+                self.chunks[0] = chunk[1:]
+            self.count -= 1
+            self.cond.notify_all()
+            return sample_from_row(chunk[0])
+
+    def get_batch(self,timeout=None,count=None,period=None):
+        """ Everything that's queued up, as one SAMPLE_DTYPE array, waiting up to 'timeout' seconds for there to be anything at all.  Comes back empty on a timeout.  With a 'period', once the first sample is in, hang on for up to that many seconds more for 'count' of them (the whole queue, if no 'count'), so they come out in fewer, bigger batches.
+        """
+        with self.cond:
+            self._wait(timeout)
+            if self.count and period:
+                count = min(count or self.maxlen,self.maxlen)
+                deadline = monotonic() + period
+                while (self.count < count) and not(self.closed):
+                    remaining = deadline - monotonic()
+                    if (remaining <= 0):
+                        break
+                    self.cond.wait(remaining)
+            if (len(self.chunks) == 1):
+                samples = self.chunks[0]
+            elif self.chunks:
+                samples = np.concatenate(self.chunks)
+            else:
+                samples = np.zeros(0,dtype=SAMPLE_DTYPE)
+            self.chunks.clear()
+            self.count = 0
+            self.cond.notify_all()
+            return samples
+
+    def get_depth(self):
+        return self.count
+
+    def get_dropped(self):
+        return self.dropped
+
+    def put(self,samples):
+        """ Called by the broker, on whichever thread is feeding it, with samples that have already been through 'filter'.
+        """
+        with self.cond:
+            if (self.policy == BLOCK):
+                # Wait for room, unless the queue is empty; a batch bigger than the whole queue still
+                # has to go somewhere
+                while self.count and ((self.count + len(samples)) > self.maxlen) and not(self.closed):
+                    self.cond.wait()
+            if self.closed:
+                return
+            self.chunks.append(samples)
+            self.count += len(samples)
+            if (self.count > self.maxlen) and (self.policy != BLOCK):
+                self._trim(self.count - self.maxlen,self.policy == DROP_OLDEST)
+            self.cond.notify_all()
+
+class PSAppDataBroker(object):
+    """ Fans the data interface out to any number of subscribers.  Every line is parsed exactly once, on its way in, no matter how many consumers there are.
+    """
+    def __init__(self):
+        """ Initialization function.
+        """
+        self.lock = threading.Lock()
+        self.subscriptions = list()
+        # For anybody feeding us raw bytes (see 'publish_bytes')
+        self.parser = PSAppSampleParser()
+        self.nlines = 0
+        self.nmalformed = 0
+
+    def publish(self,samples):
+        """ Hand an array of SAMPLE_DTYPE (straight from a PSAppSampleParser) out to everybody who wants it.
+        """
+        if (len(samples) == 0):
+            return
+        self.nlines += len(samples)
+        self.nmalformed += int(np.count_nonzero(samples["mode"] == MALFORMED))
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for sub in subscriptions:
+            selected = sub.filter(samples)
+            if len(selected):
+                sub.put(selected)
+
+    def publish_bytes(self,data):
+        """ Raw bytes from the data interface, in whatever pieces they arrived in; partial lines are held on to until the rest shows up.
+        """
+        self.publish(self.parser.feed(data))
+
+    def subscribe(self,modes=None,maxlen=1024,policy=DROP_OLDEST):
+        """ Start receiving samples; see PSAppDataSubscription for the arguments.  Anything published before this call is not seen.
+        """
+        sub = PSAppDataSubscription(modes,maxlen,policy)
+        with self.lock:
+            self.subscriptions.append(sub)
+        return sub
+
+    def unsubscribe(self,sub):
+        with self.lock:
+            if sub in self.subscriptions:
+                self.subscriptions.remove(sub)
+        sub.close()
+
+class PSAppDataReader(QObject):
+    """ The one and only reader of the data interface.  It owns the port, so the timeout is set once here rather than being changed by whoever happens to be reading.  Each read takes whatever the port has waiting and decodes every complete line in it at once (see PSAppSampleParser) before handing the lot to 'broker'.
+    """
+    finished = pyqtSignal()
+    def __init__(self,data_iface,broker):
+        """ Initialization function.
+        """
+        super(PSAppDataReader,self).__init__()
+        self.data_iface = data_iface
+        self.broker = broker
+        # Short enough that 'stop' doesn't take long to have an effect
+        self.data_iface["ser"].timeout = 0.5
+        self.is_running = False
+
+    def run(self):
+        self.is_running = True
+        parser = PSAppSampleParser()
+        while self.is_running:
+            try:
+                samples = parser.read_from(self.data_iface["ser"])
+            except:
+                # The port has gone away; subscribers will see their reads time out, and the
+                # connection checker takes it from there
+                self.is_running = False
+                continue
+            self.broker.publish(samples)
+        self.finished.emit()
+
+    def stop(self):
+        self.is_running = False
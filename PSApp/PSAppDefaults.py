@@ -8,3 +8,30 @@ def get_default_pulse_table_path():
 
 def get_default_waveform_path():
     return "{0}{1}test_pulses.dat".format(get_default_res_path(),os.sep)
+
+def get_default_plot_fps():
+    return 30
+
+def get_default_plot_window():
+    return 10.0
+
+def get_default_signal_batch_size():
+    return 64
+
+def get_default_signal_batch_period():
+    return 0.02
+
+def get_default_ramp_budget():
+    return 5.0
+
+def get_default_cal_adaptive():
+    return False
+
+def get_default_cal_store_path():
+    return "{0}{1}.psapp_calibrations.json".format(os.path.expanduser("~"),os.sep)
+
+def get_default_cal_autocorrect():
+    return False
+
+def get_default_comm_deadline():
+    return 10.0
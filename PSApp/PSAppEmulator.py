@@ -0,0 +1,678 @@
+import heapq, math, os, re, threading
+import numpy as np
+from time import monotonic
+from PSAppProtocol import BLOCK_CMD, BATCH_CMD, LIVE_HR_CMD, LIVE_RR_CMD, PATCH_CMD, BATCHABLE_CMDS, MAX_BLOCK_LENGTH, MAX_BATCH_LENGTH, batch_frame_length, batch_param, block_frame_length, unpack_batch_frame, unpack_block_frame, unpack_patch_frame
+from PSAppSharedFunctions import PSCommException
+
+# Waveform calculator states; same values as 'ps_indicators.h'
+WF_IDLE = 0
+WF_LOAD = 1
+WF_END_LOAD = 2
+WF_PLAY_PT = 3
+WF_PLAY_WF = 4
+
+# Commands that are a single character followed by '\n', and commands that carry an integer parameter.
+# Both lists come straight out of 'handshake_cmd' in 'ps_config.xc'.
+NOPARAM_CMDS = b'EFGQRSTVW'
+PARAM_CMDS = b'BCHIYZ'
+
+# Timing, in ticks of the 100MHz XMOS timer, same as 'ps_indicators.h' and 'wf_calc.xc':  no step is
+# ever shorter than MIN_STEP_TIME, configuration moves (home, increment) go at MIN_STRIDE_TIME a step,
+# and playback works to a 20ms tick, after a 1s wait at the first point.  READ_TIME is about what a
+# reading from the pressure sensor takes over I2C.
+TIMER_HZ = 100000000
+MIN_STEP_TIME = 20000
+MIN_STRIDE_TIME = 80000
+TICK_TIME = 2000000
+PLAY_SETTLE_TIME = 100000000
+READ_TIME = 50000
+# The pressure sensor (MPRLS0300YG00001BB) gives 14b counts between these two for 0 to HSC_RANGE mPSI;
+# 'ps_data' turns them back into mPSI with integer arithmetic, so the emulator does the same.
+HSC_OUTPUT_MIN = 0x666
+HSC_OUTPUT_MAX = 0x3999
+HSC_RANGE = 30000
+MMHG_PER_PSI = 51.715
+# Bytes the host can leave unread on the data interface before writes to it start coming up short
+DATA_BUFFER_LIMIT = 65536
+# How often (real seconds) a paced clock catches up when nothing is due
+CLOCK_POLL = 0.05
+
+def _sine_tables():
+    """ Same tables as 'make_sine.py' writes into 'sine_table.xc':  respiration's effect on pressure (scaled by 8192) and on heart rate (scaled by 256), 256 points a breath, with the first point repeated on the end.
+    """
+    bp = list()
+    hr = list()
+    for i in range(256):
+        t = float(i) / 256.0 * math.pi * 2.0
+        bp.append(int(8192.0 * -0.04 * math.sin(t)))
+        hr.append(int(256.0 * (1.0 + 0.1 * math.sin(t))))
+    return (bp + bp[:1],hr + hr[:1])
+
+(SINE_TABLE_BP,SINE_TABLE_HR) = _sine_tables()
+
+def _table_range(pts):
+    """ Range of a table, the way 'calculate_mean_and_range' works it out (a flat or empty table has none).
+    """
+    if not pts:
+        return 0
+    (lo,hi) = (min(min(pts),0x1FFFFFFF),max(max(pts),0))
+    return (hi - lo) if (hi > lo) else 0
+
+def _lerp(table,index):
+    """ Entry 'index' (8.8 fixed point) of 'table', interpolated with integer arithmetic like 'wf_calc'.  Past the end of what was loaded reads as 0, which is what the firmware's buffer starts out holding.
+    """
+    (i,frac) = (index >> 8,index & 0xFF)
+    a = table[i] if (i < len(table)) else 0
+    b = table[i + 1] if ((i + 1) < len(table)) else 0
+    return (a * (256 - frac) + b * frac) >> 8
+
+class PSAppPlant(object):
+    """ A made-up finger and cuff:  pressure (mmHg) against motor position is slack up to 'knee' steps past 'home', and then goes like the gas law.  After a move, the pressure heads for the new value with time constant 'tau' (seconds), and every reading has 'noise' (mmHg) on top.
+    """
+    def __init__(self,home=1000,knee=300,width=60.0,volume=12000.0,tau=0.02,noise=0.2,seed=0):
+        """ Initialization function.  The motor starts out at 'home'.
+        """
+        self.home = home
+        self.knee = knee
+        self.width = width
+        self.volume = volume
+        self.tau = tau
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.pos = home
+        self.pressure = self.true_mmhg(home)
+
+    def true_mmhg(self,pos):
+        x = self.width * np.logaddexp(0.0,(np.asarray(pos,dtype=np.float64) - self.home - self.knee) / self.width)
+        return 760.0 * (self.volume / (self.volume - x) - 1.0)
+
+    def wait(self,t):
+        """ Let 't' seconds go by with the motor where it is.
+        """
+        self.pressure = self.true_mmhg(self.pos) + (self.pressure - self.true_mmhg(self.pos)) * np.exp(-t / self.tau)
+
+    def move_to(self,pos,t):
+        """ Go to 'pos', taking 't' seconds to get there.
+        """
+        self.pos = pos
+        self.wait(t)
+
+    def sample(self):
+        return float(self.pressure + self.rng.normal(0,self.noise))
+
+class PSAppEmulatedPort(object):
+    """ The parts of a 'serial.Serial' object that the app uses (read, readline, in_waiting, timeout and so on), on top of a buffer that the emulator fills.  'cond' is shared with the emulator, which notifies it whenever there's something new.
+    """
+    def __init__(self,cond):
+        """ Initialization function.
+        """
+        self.timeout = None
+        self.cond = cond
+        self.tx = bytearray()
+        self.cancelled = False
+
+    @property
+    def in_waiting(self):
+        with self.cond:
+            return len(self.tx)
+
+    def cancel_read(self):
+        """ Wake up anybody blocked in 'read', same as pyserial.
+        """
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+    def close(self):
+        pass
+
+    def read(self,size=1):
+        """ Return up to 'size' bytes, waiting (up to 'timeout') for at least one to show up.
+        """
+        with self.cond:
+            deadline = None if (self.timeout is None) else (monotonic() + self.timeout)
+            while (len(self.tx) == 0) and not(self.cancelled):
+                remaining = None if (deadline is None) else (deadline - monotonic())
+                if (remaining is not None) and (remaining <= 0):
+                    break
+                self.cond.wait(remaining)
+            self.cancelled = False
+            data = bytes(self.tx[:size])
+            del self.tx[:size]
+            return data
+
+    def readline(self):
+        """ Return the next line from the firmware, or b'' if nothing shows up before 'timeout' runs out.
+        """
+        with self.cond:
+            deadline = None if (self.timeout is None) else (monotonic() + self.timeout)
+            while (b'\n' not in self.tx):
+                remaining = None if (deadline is None) else (deadline - monotonic())
+                if (remaining is not None) and (remaining <= 0):
+                    return b''
+                self.cond.wait(remaining)
+            i = self.tx.index(b'\n') + 1
+            line = bytes(self.tx[:i])
+            del self.tx[:i]
+            return line
+
+    def reset_input_buffer(self):
+        with self.cond:
+            self.tx.clear()
+
+class PSAppDataPortEmulator(PSAppEmulatedPort):
+    """ The data interface ('src/ps_data.xc'):  readings come out of here as 'X,pos,tms,pressure' lines, and the only thing it listens for is '?'.
+    """
+    def write(self,data):
+        with self.cond:
+            self.tx += b'Interface: data\n' * bytes(data).count(b'?')
+            self.cond.notify_all()
+        return len(data)
+
+class PSAppFirmwareEmulator(PSAppEmulatedPort):
+    """ Pure-Python stand-in for the firmware (see 'src/ps_config.xc', 'src/ps_data.xc', 'src/wf_calc.xc' and 'src/measurement_mgr.xc'), driving a PSAppPlant.  This object is the configuration interface, and 'data_port' the data interface; both look enough like 'serial.Serial' objects that they can be handed straight to the rest of the app, so that it can be exercised without hardware attached.
+
+    Everything the firmware does takes time on the emulator's own clock, in timer ticks:  moves go at the firmware's step rates, playback runs on the 20ms tick, and R/G/I/Z/O keep it busy (anything sent meanwhile gets 'ERR: Busy.') until their reading has gone out.  With 'speed' set, the clock keeps up with real time on its own, 'speed' times as fast.  With 'speed' None it only moves when 'advance' is called, so a test can step through playback much faster than real time and get the same result every time.
+    """
+    def __init__(self,extensions=BLOCK_CMD+BATCH_CMD+LIVE_HR_CMD+LIVE_RR_CMD+PATCH_CMD,version=b'c80ee32a',plant=None,speed=1.0):
+        """ Initialization function.  'extensions' lists the commands beyond the original firmware that we understand; leave some out to behave like older firmware.  'plant' is what the motor pushes on (a PSAppPlant).
+        """
+        super(PSAppFirmwareEmulator,self).__init__(threading.Condition())
+        self.extensions = extensions
+        self.version = version
+        # By default, a cuff that's already snug at the app's default home position (1000), and gets to
+        # about 200mmHg at its default calibration maximum (2000)
+        self.plant = PSAppPlant(knee=0,volume=4500.0) if (plant is None) else plant
+        self.data_port = PSAppDataPortEmulator(self.cond)
+        self.rx = bytearray()
+        # Every completed command, in order, so that a caller can see what actually made it through
+        self.log = list()
+        self.ticks = 0
+        self.plant_ticks = 0
+        self.events = list()
+        self.nevents = 0
+        self._reset()
+        self.speed = speed
+        if speed:
+            (self.real0,self.ticks0) = (monotonic(),self.ticks)
+            threading.Thread(target=self._run_clock,daemon=True).start()
+
+    def _reset(self):
+        """ Same as a power-on reset of the firmware.  The motor stays where it is, but that's position 0 now.
+        """
+        self.pending = None
+        self.block_count = 0
+        self.block_cmd = None
+        self.batch_bytes = 0
+        self.wf_state = WF_IDLE
+        self.wf_pts = [list(),list()]
+        self.load_i = 0
+        self.pb_i = 1
+        self.playing = False
+        self.params = [dict(),dict()]
+        self.home = 0
+        # Anything that was going to happen doesn't any more
+        self.events = list()
+        self.busy = False
+        self.pb_stop = False
+        self.go_home = False
+        self.look_for_crossing = False
+        self.prev_ind = 0
+        self.wave_index = 0
+        self.resp_index = 0
+        self.currentp = 0
+        self.tnext = 0
+        self.range = 0
+        self.origin = int(self.plant.pos)
+        self.pos = 0
+        self.data_mode = None
+        self.index = 0
+        self.tms_start = None
+
+    def _run_clock(self):
+        """ Keep the clock up with real time (times 'speed'), waking up for whatever falls due next.
+        """
+        with self.cond:
+            while self.speed:
+                self._run_until(self._paced_ticks())
+                wait = CLOCK_POLL
+                if self.events:
+                    wait = min(wait,max(0.0,(self.events[0][0] - self.ticks) / (self.speed * TIMER_HZ)))
+                self.cond.wait(wait)
+
+    def _run_until(self,ticks):
+        """ Move the clock up to 'ticks', doing everything that falls due on the way, in order.
+        """
+        nevents = len(self.events)
+        while self.events and (self.events[0][0] <= ticks):
+            (self.ticks,n,event) = heapq.heappop(self.events)
+            event()
+        self.ticks = max(self.ticks,ticks)
+        if (nevents > 0):
+            self.cond.notify_all()
+
+    def _paced_ticks(self):
+        return self.ticks0 + int((monotonic() - self.real0) * self.speed * TIMER_HZ)
+
+    def _schedule(self,delay,event):
+        self.nevents += 1
+        heapq.heappush(self.events,(self.ticks + delay,self.nevents,event))
+
+    def advance(self,seconds):
+        """ Let 'seconds' go by on the emulator's clock.  Only for a clock that isn't paced ('speed' None).
+        """
+        with self.cond:
+            self._run_until(self.ticks + int(round(seconds * TIMER_HZ)))
+            self.cond.notify_all()
+
+    def close(self):
+        """ Stop the clock; nothing happens after this.
+        """
+        with self.cond:
+            self.speed = None
+            self.cond.notify_all()
+
+    def get_playing_table(self):
+        """ The table that the waveform calculator is currently playing back.
+        """
+        with self.cond:
+            return list(self.wf_pts[self.pb_i])
+
+    @property
+    def now(self):
+        """ Time on the emulator's clock, in seconds.
+        """
+        return self.ticks / TIMER_HZ
+
+    def write(self,data):
+        """ Bytes from the host; process as much as we can right away.
+        """
+        with self.cond:
+            if self.speed:
+                # Catch up first, so that the command lands at the right time
+                self._run_until(self._paced_ticks())
+            self.rx += data
+            self._process()
+            self.cond.notify_all()
+        return len(data)
+
+    def _respond(self,line):
+        self.tx += line
+
+    def _process(self):
+        """ Parse whatever is sitting in the receive buffer.  This follows the select loop in 'ps_config' one byte at a time.
+        """
+        while len(self.rx):
+            if (self.block_count > 0):
+                # Waiting on the binary frame after a 'K' or 'M' handshake
+                flen = block_frame_length(self.block_count)
+                if (len(self.rx) < flen):
+                    return
+                frame = bytes(self.rx[:flen])
+                del self.rx[:flen]
+                if (self.block_cmd == PATCH_CMD):
+                    self._receive_patch(frame)
+                else:
+                    self._receive_block(frame)
+                self.block_count = 0
+            elif (self.batch_bytes > 0):
+                # Waiting on the binary frame after a 'P' handshake
+                flen = batch_frame_length(self.batch_bytes)
+                if (len(self.rx) < flen):
+                    return
+                frame = bytes(self.rx[:flen])
+                del self.rx[:flen]
+                self._receive_batch(frame)
+                self.batch_bytes = 0
+            elif self.pending:
+                # Echo has gone out; waiting for '\n' (go ahead) or '!' (abort)
+                c = self.rx[:1]
+                del self.rx[:1]
+                if (c == b'\n'):
+                    (cmd,param) = self.pending
+                    self.pending = None
+                    if (cmd not in [BLOCK_CMD,BATCH_CMD,PATCH_CMD]):
+                        self.rx.clear()
+                    self._execute(cmd,param)
+                elif (c == b'!'):
+                    self.pending = None
+                    self.rx.clear()
+            elif self.busy:
+                # Every byte that comes in while a reading is on its way gets the same answer
+                del self.rx[:1]
+                self._respond(b'ERR: Busy.\n')
+            else:
+                cmd = bytes(self.rx[:1])
+                if (cmd == b'?'):
+                    del self.rx[:1]
+                    self._respond(b'Interface: config\n')
+                elif (cmd == b'O'):
+                    # Manual override; no handshake, it just goes
+                    if (b'\n' not in self.rx):
+                        return
+                    i = self.rx.index(b'\n')
+                    param = batch_param(self.rx[1:i])
+                    del self.rx[:(i + 1)]
+                    self.log.append((cmd,param))
+                    self._config_move('O',self.pos + param)
+                elif (cmd in NOPARAM_CMDS):
+                    if (len(self.rx) < 2):
+                        return
+                    ok = (self.rx[1:2] == b'\n')
+                    del self.rx[:2]
+                    if ok:
+                        self.pending = (cmd,None)
+                        self._respond(cmd+b'\n')
+                elif (cmd in PARAM_CMDS) or (cmd in self.extensions):
+                    if (b'\n' not in self.rx):
+                        return
+                    i = self.rx.index(b'\n')
+                    param = batch_param(self.rx[1:i])
+                    del self.rx[:(i + 1)]
+                    self.pending = (cmd,param)
+                    self._respond(cmd+str(param).encode()+b'\n')
+                else:
+                    # Unknown command; the firmware flushes its buffer
+                    self.rx.clear()
+
+    def _receive_block(self,frame):
+        try:
+            values = unpack_block_frame(frame)
+        except PSCommException as e:
+            self.rx.clear()
+            if re.search('CRC',str(e)):
+                self._respond(b'ERR: Block CRC mismatch\n')
+            else:
+                self._respond(b'ERR: Block length mismatch\n')
+            return
+        npts = 0
+        for val in values:
+            if (val > 0):
+                self._load_point(val)
+                npts += 1
+        self.log.append((BLOCK_CMD,len(values)))
+        self._respond("OK: Block length = {}\n".format(npts).encode())
+
+    def _receive_patch(self,frame):
+        try:
+            runs = unpack_patch_frame(frame)
+        except PSCommException as e:
+            self.rx.clear()
+            if re.search('CRC',str(e)):
+                self._respond(b'ERR: Block CRC mismatch\n')
+            elif re.search('malformed',str(e)):
+                self._respond(b'ERR: '+str(e).encode()+b'\n')
+            else:
+                self._respond(b'ERR: Block length mismatch\n')
+            return
+        if (self.wf_state not in [WF_PLAY_PT,WF_PLAY_WF]):
+            self._respond(b'ERR: Patch needs playback\n')
+            return
+        # Start from a copy of what's playing, parameters and all
+        self.wf_state = WF_LOAD
+        table = list(self.wf_pts[self.pb_i])
+        self.params[self.load_i] = dict(self.params[self.pb_i])
+        npts = 0
+        for (start,values) in runs:
+            for (i,val) in enumerate(values):
+                if ((start + i) < len(table)):
+                    table[start + i] = val
+                else:
+                    table += [0] * (start + i - len(table)) + [val]
+            npts += len(values)
+        self.wf_pts[self.load_i] = table
+        self.log.append((PATCH_CMD,npts))
+        self._respond("OK: Patch length = {}\n".format(npts).encode())
+
+    def _receive_batch(self,frame):
+        try:
+            cmds = unpack_batch_frame(frame)
+        except PSCommException as e:
+            self.rx.clear()
+            if re.search('CRC',str(e)):
+                self._respond(b'ERR: Batch CRC mismatch\n')
+            else:
+                self._respond(b'ERR: Batch length mismatch\n')
+            return
+        for (i,line) in enumerate(cmds):
+            cmd = line[:1]
+            if (len(cmd) == 0) or (cmd not in BATCHABLE_CMDS):
+                self._respond("ERR: Batch stopped at = {}\n".format(i).encode())
+                return
+            self._execute(cmd,batch_param(line[1:]))
+        self._respond("OK: Batch length = {}\n".format(len(cmds)).encode())
+
+    def _load_point(self,val):
+        if (self.wf_state == WF_LOAD) and (len(self.wf_pts[self.load_i]) < 1024):
+            self.wf_pts[self.load_i].append(val)
+
+    def _execute(self,cmd,param):
+        """ The command has made it through the handshake; act on it.
+        """
+        self.log.append((cmd,param))
+        if (cmd in [BLOCK_CMD,PATCH_CMD]):
+            if (param > 0) and (param <= MAX_BLOCK_LENGTH):
+                self.block_count = param
+                self.block_cmd = cmd
+            elif (param > 0):
+                self._respond(b'ERR: Block length mismatch\n')
+        elif (cmd == BATCH_CMD):
+            if (param > 0) and (param <= MAX_BATCH_LENGTH):
+                self.batch_bytes = param
+            elif (param > 0):
+                self._respond(b'ERR: Batch length mismatch\n')
+        elif (cmd == b'W'):
+            if (self.wf_state in [WF_IDLE,WF_PLAY_PT,WF_PLAY_WF]):
+                self.wf_state = WF_LOAD
+                self.wf_pts[self.load_i] = list()
+        elif (cmd == b'Y'):
+            if (param > 0):
+                self._load_point(param)
+        elif (cmd in [b'H',b'B',b'C']):
+            if (param > 0) and (self.wf_state in [WF_IDLE,WF_LOAD]):
+                self.params[self.load_i][cmd] = param
+        elif (cmd in [LIVE_HR_CMD,LIVE_RR_CMD]):
+            # Goes into both tables, whatever state we're in
+            if (param > 0):
+                for params in self.params:
+                    params[b'H' if (cmd == LIVE_HR_CMD) else b'B'] = param
+        elif (cmd == b'E'):
+            if (self.wf_state == WF_LOAD):
+                self.wf_state = WF_END_LOAD
+                self._respond("OK: Buffer length = {}\n".format(len(self.wf_pts[self.load_i])).encode())
+                if not self.playing:
+                    self.pb_i = self.load_i
+                    self.load_i = 1 - self.load_i
+                self.range = _table_range(self.wf_pts[self.pb_i])
+        elif (cmd == b'T'):
+            self._set_data_mode('W')
+            if (self.wf_state == WF_END_LOAD):
+                self.wf_state = WF_PLAY_PT
+                if self.playing:
+                    # Switches over at the next time round the table
+                    self.look_for_crossing = True
+                else:
+                    self._respond(b'OK: Waveform playback has begun, crossing_index = 1.\n')
+                    self.playing = True
+                    self.currentp = _lerp(self.wf_pts[self.pb_i],0)
+                    self.wave_index = self.params[self.pb_i].get(b'H',0)
+                    self.resp_index = self.params[self.pb_i].get(b'B',0)
+                    self.tnext = self.ticks + PLAY_SETTLE_TIME
+                    self._move(self.currentp,MIN_STRIDE_TIME,PLAY_SETTLE_TIME,self._playback_reading)
+        elif (cmd == b'S'):
+            # Nothing gets said when playback has wound down; that goes for the next reading too, if
+            # nothing was playing
+            self.pb_stop = True
+            self.wf_state = WF_IDLE
+            if self.playing:
+                self.playing = False
+                self.go_home = True
+        elif (cmd == b'R'):
+            self.busy = True
+            self._set_data_mode('R')
+            self._schedule(READ_TIME,self._read_only)
+        elif (cmd == b'G'):
+            self._config_move('R',self.home)
+        elif (cmd == b'I'):
+            if (param > 0):
+                self._config_move('I',self.pos + param)
+        elif (cmd == b'Z'):
+            if (param > 0):
+                self.home = param
+                # All the way back to the near limit first, and count from there
+                self.busy = True
+                self._set_data_mode('H')
+                self._plant_catch_up()
+                steps = abs(self.origin + self.pos)
+                self._schedule(steps * MIN_STRIDE_TIME,lambda: self._found_limit(steps))
+        elif (cmd == b'V'):
+            self._respond(b'Version: '+self.version+b'\n')
+        elif (cmd == b'Q'):
+            self._reset()
+
+    def _found_limit(self,steps):
+        self.plant.move_to(0,steps * MIN_STRIDE_TIME / TIMER_HZ)
+        self.plant_ticks = self.ticks
+        (self.origin,self.pos) = (0,0)
+        self._move(self.home,MIN_STRIDE_TIME,0,self._send_reading,True)
+
+    def _plant_catch_up(self):
+        self.plant.wait((self.ticks - self.plant_ticks) / TIMER_HZ)
+        self.plant_ticks = self.ticks
+
+    def _move(self,target,speed,settle,done,always=False):
+        """ What 'measurement_mgr' does with a position request:  step to 'target' at 'speed' (ticks a step), wait 'settle' ticks, take a reading and hand the position and reading (mPSI) to 'done'.  A negative 'settle' means no wait, but the position gets reported negative.  Same as the firmware, asking for where the motor already is does nothing at all, not even a reading, unless 'always' (a configuration move, which always comes with a reading).
+        """
+        if (target == self.pos) and not(always):
+            return
+        self._plant_catch_up()
+        move_ticks = abs(target - self.pos) * max(speed,MIN_STEP_TIME)
+        wait_ticks = max(settle,0) + READ_TIME
+        def arrive():
+            self.plant.move_to(self.origin + target,move_ticks / TIMER_HZ)
+            self.plant.wait(wait_ticks / TIMER_HZ)
+            self.plant_ticks = self.ticks
+            self.pos = target
+            done((-target) if (settle < 0) else target,self._measure())
+        self._schedule(move_ticks + wait_ticks,arrive)
+
+    def _measure(self):
+        """ A reading from the sensor, in mPSI, after going through the same integer arithmetic as the firmware.
+        """
+        mpsi = self.plant.sample() / MMHG_PER_PSI * 1000.0
+        counts = int(round(HSC_OUTPUT_MIN + mpsi * (HSC_OUTPUT_MAX - HSC_OUTPUT_MIN) / HSC_RANGE))
+        counts = min(max(counts,HSC_OUTPUT_MIN),0x3FFF)
+        return (counts - HSC_OUTPUT_MIN) * HSC_RANGE // (HSC_OUTPUT_MAX - HSC_OUTPUT_MIN)
+
+    def _read_only(self):
+        self._plant_catch_up()
+        self._send_reading(self.pos,self._measure())
+
+    def _config_move(self,mode,target):
+        self.busy = True
+        self._set_data_mode(mode)
+        self._move(target,MIN_STRIDE_TIME,0,self._send_reading,True)
+
+    def _set_data_mode(self,mode):
+        if (mode != 'W'):
+            self.tms_start = None
+        self.data_mode = mode
+
+    def _send_reading(self,pos,pressure):
+        """ What 'ps_data' does with a reading:  send it out the data interface, and let 'ps_config' know when it's done (or couldn't be sent).  Returns False if nobody was listening; the firmware would be stuck at this point, so whatever comes next doesn't happen.
+        """
+        mode = self.data_mode
+        if mode is None:
+            return False
+        if (mode in 'HIW'):
+            value = pos
+        else:
+            value = self.index
+            self.index += 1
+        tms = 0 if (self.tms_start is None) else ((self.ticks - self.tms_start) // (TIMER_HZ // 1000))
+        packet = "{},{},{},{}\n".format(mode,value,tms,pressure).encode()
+        room = max(0,DATA_BUFFER_LIMIT - len(self.data_port.tx))
+        self.data_port.tx += packet[:room]
+        if (room < len(packet)):
+            self._data_status(1)
+        if (mode == 'W'):
+            if (self.tms_start is None) and (self.data_mode == 'W'):
+                self.tms_start = self.ticks
+            if (pos < 0):
+                self._data_status(0)
+        else:
+            self._data_status(0)
+        return True
+
+    def _data_status(self,status):
+        """ 'ps_config' hearing back from 'ps_data'.
+        """
+        self._set_data_mode(None)
+        if (status > 0):
+            self._respond(b'ERR: Overflow detected, waveform playback will stop if playing.\n')
+        elif self.pb_stop:
+            self.pb_stop = False
+        else:
+            self._respond(b'OK: Data ready\n')
+        self.busy = False
+
+    def _playback_reading(self,pos,pressure):
+        if self._send_reading(pos,pressure):
+            self._mm_ready()
+
+    def _mm_ready(self):
+        """ The motor got where it was going; 'wf_calc' works out where it goes next.
+        """
+        if self.playing:
+            self._next_point()
+        elif self.go_home:
+            self.go_home = False
+            self._move(self.home,MIN_STRIDE_TIME,-1,self._playback_reading)
+
+    def _next_point(self):
+        """ One time round the playback loop in 'wf_calc':  the next point of the table (interpolated), with respiration added in, and the time left to the next tick to get there in.  If the motor doesn't need to move, the firmware waits a tick and goes round again.
+        """
+        self.tnext += TICK_TIME
+        ind = self.wave_index >> 8
+        if self.look_for_crossing and (self.prev_ind > ind):
+            self.pb_i = self.load_i
+            self.load_i = 1 - self.load_i
+            self.look_for_crossing = False
+            self._respond("OK: Waveform playback has begun, crossing_index = {}.\n".format(ind).encode())
+        self.prev_ind = ind
+        nextp = _lerp(self.wf_pts[self.pb_i],self.wave_index)
+        nextp += (_lerp(SINE_TABLE_BP,self.resp_index) * self.range) >> 13
+        rrhr = _lerp(SINE_TABLE_HR,self.resp_index)
+        params = self.params[self.pb_i]
+        self.wave_index = (self.wave_index + ((params.get(b'H',0) * rrhr) >> 8)) & 0xFFFF
+        self.resp_index = (self.resp_index + params.get(b'B',0)) & 0xFFFF
+        tstep = self.tnext - self.ticks
+        if (tstep <= 0):
+            # Running late; catch up
+            self.tnext = self.ticks + TICK_TIME
+            tstep = 0
+        deltap = nextp - self.currentp
+        self.currentp = nextp
+        if (deltap == 0):
+            self._schedule(TICK_TIME,self._mm_ready)
+        else:
+            self._move(nextp,tstep // abs(deltap),0,self._playback_reading)
+
+def open_ptys(emulator):
+    """ Put 'emulator' (a PSAppFirmwareEmulator) behind a pair of pseudo-terminals, for programs that want a device to open rather than an object; POSIX only.  Returns the names of the configuration and data devices.  Threads shuttle the bytes back and forth for as long as the program runs.
+    """
+    import pty, tty
+    names = list()
+    for port in [emulator,emulator.data_port]:
+        (master,slave) = pty.openpty()
+        tty.setraw(slave)
+        names.append(os.ttyname(slave))
+        def host_to_port(master=master,port=port):
+            while True:
+                port.write(os.read(master,4096))
+        def port_to_host(master=master,port=port):
+            while True:
+                os.write(master,port.read(4096))
+        threading.Thread(target=host_to_port,daemon=True).start()
+        threading.Thread(target=port_to_host,daemon=True).start()
+    return names
@@ -0,0 +1,106 @@
+from PyQt5.QtCore import *
+import numpy as np
+
+class PSAppLivePlot(QObject):
+    """ Live pressure trace during playback.  Samples go into preallocated arrays as they come in, which is cheap; the curve only gets redrawn when the timer goes off, so the GUI does the same amount of drawing no matter how fast the data shows up.
+
+    There are two ways of showing the data:
+        * 'Clear' (the default):  the trace starts at the left edge and grows to the right; once it reaches the end of the window, it's wiped and starts over.
+        * 'Sweep':  like a patient monitor.  The trace wraps around to the left edge and overwrites the old data in place, with a small gap just ahead of the newest point.
+    """
+    def __init__(self,plt,curve,window=10.0,fps=30,sample_period=0.02,sweep=False):
+        """ Initialization function.  'plt' is the PlotWidget and 'curve' the item on it that shows the trace; 'window' is the width of the display in seconds and 'sample_period' the time between points from the firmware (20ms).
+        """
+        super(PSAppLivePlot,self).__init__()
+        self.plt = plt
+        self.curve = curve
+        self.window = window
+        self.sample_period = sample_period
+        self.sweep = sweep
+        # A few extra slots, in case the firmware's timestamps aren't perfectly even
+        self.nslots = int(round(window / sample_period)) + 1
+        self.capacity = 2 * self.nslots
+        self.x = np.zeros(self.capacity)
+        self.y = np.zeros(self.capacity)
+        self.sweep_x = np.arange(self.nslots) * sample_period
+        self.sweep_y = np.full(self.nslots,np.nan)
+        # Blank this much ahead of the newest point in sweep mode, so it's clear where the trace is
+        self.sweep_gap = max(1,int(round(0.3 / sample_period)))
+        self.timer = QTimer()
+        self.timer.setInterval(int(round(1000.0 / fps)))
+        self.timer.timeout.connect(self._redraw)
+        self.clear()
+        # Only draw what's on screen, and thin out long windows to what the display can show
+        self.plt.setClipToView(True)
+        self.plt.setDownsampling(auto=True,mode='peak')
+
+    def _redraw(self):
+        """ Timer callback; push the data to the curve if anything changed since last time.
+        """
+        if not self.dirty:
+            return
+        self.dirty = False
+        if self.sweep:
+            self.curve.setData(self.sweep_x,self.sweep_y,connect='finite')
+        else:
+            self.curve.setData(self.x[:self.n],self.y[:self.n])
+
+    def append(self,tms,mmhg):
+        """ Add samples; 'tms' (timestamps from the firmware, in ms) and 'mmhg' can be single values or arrays.
+        """
+        tms = np.atleast_1d(np.asarray(tms,dtype=np.float64))
+        mmhg = np.atleast_1d(np.asarray(mmhg,dtype=np.float64))
+        if (len(tms) == 0):
+            return
+        if self.sweep:
+            if self.t0 is None:
+                self.t0 = tms[0]
+            slots = np.floor((tms - self.t0) / 1000.0 / self.sample_period).astype(np.int64) % self.nslots
+            self.sweep_y[slots] = mmhg
+            gap = (slots[-1] + 1 + np.arange(self.sweep_gap)) % self.nslots
+            self.sweep_y[gap] = np.nan
+        else:
+            i = 0
+            while (i < len(tms)):
+                if self.restart:
+                    self.n = 0
+                    self.t0 = None
+                    self.restart = False
+                if self.t0 is None:
+                    self.t0 = tms[i]
+                t = (tms[i:] - self.t0) / 1000.0
+                # Same as it always worked:  the point that reaches the end of the window is the last
+                # one on this trace, and the next one starts a fresh trace with its own time zero.
+                # The finished trace stays up until then.
+                full = np.flatnonzero(t >= self.window)
+                n = len(t) if (len(full) == 0) else (int(full[0]) + 1)
+                n = min(n,self.capacity - self.n)
+                self.x[self.n:(self.n + n)] = t[:n]
+                self.y[self.n:(self.n + n)] = mmhg[i:(i + n)]
+                self.n += n
+                i += n
+                self.restart = (self.x[self.n - 1] >= self.window) or (self.n == self.capacity)
+        self.dirty = True
+
+    def clear(self):
+        self.n = 0
+        self.t0 = None
+        self.sweep_y[:] = np.nan
+        self.restart = False
+        self.dirty = True
+
+    def set_fps(self,fps):
+        self.timer.setInterval(int(round(1000.0 / fps)))
+
+    def set_sweep(self,sweep):
+        self.sweep = sweep
+        self.clear()
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        """ Stop redrawing; the last frame stays up.
+        """
+        self._redraw()
+        self.timer.stop()
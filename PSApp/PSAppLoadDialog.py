@@ -3,11 +3,28 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import * 
 import re, struct, copy
 import numpy as np
-from time import sleep
+from time import sleep, monotonic
 from scipy.interpolate import interp1d
 import sys,os
 sys.path.append("./math")
 from PSAppShaper import shape_pulse
+from PSAppTableCompiler import PSAppTableCompiler, array_hash
+from PSAppRampPlanner import RAMP_PARAMS, PSAppRampPlan, PSAppRampProducer, plan_ramp
+from PSAppDefaults import get_default_ramp_budget
+from PSAppProtocol import BATCH_CMD, BLOCK_CMD, LIVE_HR_CMD, LIVE_RR_CMD, PATCH_CMD, PROBE_TIMEOUT, batch_body, block_frame_length, diff_runs, estimate_cost, handshake_length, pack_block_frame, pack_patch_frame, patch_words
+from PSAppSharedFunctions import PSCommException
+from PSAppState import RATE_FIELDS
+
+def rate_to_firmware(rate):
+    """ The value that gets sent over to the firmware for a heart rate or respiration rate is the index value for every 20ms interval.  So, the rates that are entered in as 'param/minute' need to be converted to the 20ms interval.
+    """
+    # Therefore, we multiply the entered value by:
+    #   * The length of the table, 256
+    #   * 256, because we're sending the value over in 'X.8' format
+    #   * 1/60, because we want to convert 'per minute' to 'per second'
+    #   * 1/50, because we want to convert 'per second' to 'per 20ms'
+    multiplier = 256 * 256.0 / 60.0 / 50.0
+    return round(rate * multiplier)
 
 class PSAppLoadWorker(QObject):
     finished = pyqtSignal()
@@ -16,7 +33,9 @@ class PSAppLoadWorker(QObject):
     point_load_fail = pyqtSignal()
     point_load_complete = pyqtSignal()
     table_read_error = pyqtSignal()
-    def __init__(self,parent,prev_ps_state):
+    def __init__(self,parent,prev_ps_state,ramp_budget=None):
+        """ Initialization function.  'ramp_budget' is roughly how long (in seconds) a change in parameters during playback is allowed to take; steps in between get skipped to make it.  None means the default, and 0 plays every step.
+        """
         super(PSAppLoadWorker,self).__init__()
         self.parent = parent
         self.ps_state = parent.get_ps_state()
@@ -27,6 +46,9 @@ class PSAppLoadWorker(QObject):
         self.table_init = None
         self.shaped_table = None
         self.shape = False
+        self.ramp_budget = get_default_ramp_budget() if (ramp_budget is None) else (ramp_budget or None)
+        self.plan = None
+        self.cal_max = None
 
     def stop(self):
         self.cancel_operation = True
@@ -53,21 +75,38 @@ class PSAppLoadWorker(QObject):
             # Take the pulse and shape it; details in the library file
             if self.shape:
                 self.shaped_table = shape_pulse(self.table_init)
+            # Also gotta send calibrated max position
+            self.cal_max = self.parent.get_cal_max()
+            self.ps_state.set_state("pulse_table_hash",array_hash(self.shaped_table if self.shape else self.table_init))
+            self.ps_state.set_state("cal_max",self.cal_max)
+            # If all that's changed since the last load is the heart rate and/or respiration rate,
+            # there's no need to send a new table; newer firmware can change those on the fly.
+            changed = self.ps_state.get_changed()
+            if self.ps_state.get_state("playing") and changed.issubset(RATE_FIELDS):
+                self.point_load_init.emit()
+                if self._update_rates(changed):
+                    self.ps_state.mark_loaded()
+                    self.point_load_complete.emit()
+                    for p in RATE_FIELDS:
+                        if p in changed:
+                            self.new_parameter_value.emit(p,self.ps_state.get_state(p))
+                    self.is_running = False
+                    continue
             pressure_table = self.ps_state.get_state("pressure_table")
-            motor_locs = np.array(pressure_table["x"])
-            mmhg_readings = np.array(pressure_table["y"])
+            # Everything that goes into the position table, other than the pressures themselves, is
+            # fixed for the whole load
+            table_compiler = PSAppTableCompiler(self.shaped_table if self.shape else self.table_init,pressure_table["x"],pressure_table["y"],self.ps_state.get_state("cal_model"))
 
             # Second thing to do is to figure out how many loads we're going to do.  If
-            # we're currently not playing, then we only do one load.  If we're playing,
-            # figure out the maximum number of steps that we need to take, and figure out when/where
-            # to update other parameters
-            loop = 1
+            # we're currently not playing, then we only do one load.  If we're playing, work out
+            # every step between the old parameters and the new ones (see PSAppRampPlanner), and
+            # what they come to in positions, before anything goes over.
             writes = dict()
             goals = dict()
-            params = ["systolic","diastolic","heart_rate","respiration_rate"]
-            for p in params:
+            for p in RAMP_PARAMS:
                 writes[p] = self.ps_state.get_state(p)
-            deltas = dict()
+                goals[p] = writes[p]
+            budget = None
 
             # New, October 12:  Adjust the width of the pulse based on changes in the pressure
             # parameters.  As pressure parameters increase, we should expect the waveform to
@@ -79,93 +118,208 @@ class PSAppLoadWorker(QObject):
                 self.ps_state.set_state("pressure_defaults",{"systolic":self.ps_state.get_state("systolic"),"diastolic":self.ps_state.get_state("diastolic")})
 
             if (self.ps_state.get_state("playing")):
-                for p in params:
+                for p in RAMP_PARAMS:
                     writes[p] = int(self.prev_ps_state.get_state(p))
                     goals[p] = int(self.ps_state.get_state(p))
-                    deltas[p] = goals[p] - writes[p]
-                    if deltas[p]:
-                        writes[p] += abs(deltas[p]) / deltas[p]
-                for key in deltas.keys():
-                    if (abs(deltas[key]) > loop):
-                        loop = int(abs(deltas[key]))
+                # Skip steps if need be, to get there in a reasonable amount of time
+                budget = self.ramp_budget
             else:
                 self.ps_state.set_state("playing",True)
                 self.ps_state.set_state("pressure_defaults",{"systolic":self.ps_state.get_state("systolic"),"diastolic":self.ps_state.get_state("diastolic")})
-            for j in range(loop):
-                if not self.cancel_operation:
-                    self.point_load_init.emit()
-                    mmhg_vals = []
-                    delta = writes["systolic"] - writes["diastolic"]
-                    #table = self._modify_table(writes["systolic"],writes["diastolic"])
-                    table = self.table_init
-                    if self.shape:
-                        table = self.shaped_table
-                    table_span = max(table) - min(table)
-                    for val in table:
-                        mmhg_vals.append((int(val) - min(table)) / table_span * delta + writes["diastolic"])
-                    # Take the pressure values and convert them to positions
-                    positions = []
-                    for i in range(len(mmhg_vals)):
-                        positions.append(round(np.interp(mmhg_vals[i],mmhg_readings,motor_locs)))
-                    # Wrap-around
-                    positions.append(positions[0])
-                    # Write the data to XMOS
-                    try:
-                        # Indicate that we're loading a new waveform
-                        self.comm_interface.transaction(b'W')
-                        # Attach a new heart rate and respiration rate. The value that gets sent over to the
-                        # firmware is the index value for every 20ms interval.  So, the rates that are entered
-                        # in as 'param/minute' need to be converted to the 20ms interval.  Therefore, we multiply
-                        # the entered value by:
-                        #   * The length of the table, 256
-                        #   * 256, because we're sending the value over in 'X.8' format
-                        #   * 1/60, because we want to convert 'per minute' to 'per second'
-                        #   * 1/50, because we want to convert 'per second' to 'per 20ms'
-                        multiplier = 256 * 256.0 / 60.0 / 50.0
-                        hr = writes["heart_rate"] * multiplier
-                        self.comm_interface.transaction(b'H'+str(round(hr)).encode())
-                        rr = writes["respiration_rate"] * multiplier
-                        self.comm_interface.transaction(b'B'+str(round(rr)).encode())
-                        # Also gotta send calibrated max position
-                        cal_max = self.parent.get_cal_max()
-                        self.comm_interface.transaction(b'C'+cal_max.encode())
-                        for pos in positions:
-                            self.comm_interface.transaction(("Y{}".format(pos)).encode())
-                        cmd_ret = self.comm_interface.transaction(b'E',True)
-                        rem = re.match(b'^OK:\s+Buffer length\s+=\s+(\d+)',cmd_ret)
-                        if rem:
-                            # Check to make sure that the returned length is the same as what we believe we
-                            # wrote
-                            if (int(rem.group(1)) != len(positions)):
-                                self.point_load_fail.emit()
-                                self.is_running = False
-                                continue
-                            # Tell the firmware to switch over to the new data
-                            tret = self.comm_interface.transaction(b'T',read_response=True,timeout=5)
-                            res = re.match(b'^OK:\s+Waveform playback has begun',tret)
-                            if not res:
-                                self.point_load_fail.emit()
-                                self.is_running = False
-                                continue
-                    except:
-                        self.point_load_fail.emit()
-                        self.is_running = False
-                        continue
-                    # If we've made it to this point, then we check to see if need to update parameters,
-                    # and do so accordingly.
-                    self.point_load_complete.emit()
-                    if ((j + 1) < loop):
-                        for p in params:
-                            if (deltas[p]):
-                                m = int(loop / deltas[p])
-                                if not ((j + 1) % m):
-                                    if (writes[p] != goals[p]):
-                                        writes[p] += abs(deltas[p]) / deltas[p]
-                                        self.new_parameter_value.emit(p,writes[p])
+                # Nothing's playing, so there's nothing to patch
+                self.ps_state.set_state("loaded_table",None)
+            params = plan_ramp(writes,goals)
+            #table = self._modify_table(writes["systolic"],writes["diastolic"])
+            self.plan = PSAppRampPlan(params,table_compiler.positions_array(params[:,0],params[:,1]),budget)
+            # Until this is all the way through, there's no telling exactly what's playing
+            self.ps_state.clear_loaded()
+            producer = PSAppRampProducer(self.plan,self._prepare_step)
+            producer.start()
+            while not self.cancel_operation:
+                try:
+                    step = producer.get()
+                except Exception:
+                    # Couldn't work out the positions for a step
+                    self.ps_state.set_state("loaded_table",None)
+                    self.point_load_fail.emit()
+                    break
+                if step is None:
+                    # Made it all the way through; that's what's playing now
+                    self.ps_state.mark_loaded()
+                    break
+                (i,(header,positions)) = step
+                t0 = monotonic()
+                self.point_load_init.emit()
+                if not self._load_table(header,positions):
+                    self.ps_state.set_state("loaded_table",None)
+                    self.point_load_fail.emit()
+                    break
+                self.ps_state.set_state("loaded_table",{"header":header,"positions":positions})
+                self.plan.record_step(monotonic() - t0)
+                # If we've made it to this point, then we let everybody know about any parameters
+                # that have changed.
+                self.point_load_complete.emit()
+                for (k,p) in enumerate(RAMP_PARAMS):
+                    if (params[i,k] != writes[p]):
+                        writes[p] = float(params[i,k])
+                        self.new_parameter_value.emit(p,writes[p])
+            producer.stop()
             self.is_running = False
         sleep(0.1)
         self.finished.emit()
 
+    def _load_table(self,header,positions):
+        """ Get a new table playing:  either patch the differences into the one that's playing now (see '_patch_cost'), or, if that's not possible or not worth it, send the whole thing.  Returns False if anything went wrong along the way.
+        """
+        loaded = self.ps_state.get_state("loaded_table")
+        if loaded and (self.comm_interface.get_supported(PATCH_CMD) is not False):
+            runs = diff_runs(loaded["positions"],positions)
+            # A patch carries the parameters over from what's playing; only send the ones that changed
+            params = [cmd for cmd in header[1:] if cmd not in loaded["header"]]
+            if (self._patch_cost(runs,params) < self._full_cost(header,positions)):
+                patched = self._patch_positions(runs,positions)
+                if patched is False:
+                    return False
+                if patched:
+                    try:
+                        if params:
+                            self.comm_interface.transaction_batch(params)
+                    except:
+                        return False
+                    return self._switch_over(positions)
+        # Indicate that we're loading a new waveform, along with the parameters that go with it;
+        # these all go over together in one batch, and the table follows once the firmware is ready
+        # for it.
+        load_header = self.comm_interface.transaction_batch_async(header)
+        return self._load_positions(load_header,positions)
+
+    def _batch_cost(self,cmds):
+        """ Handshakes and bytes for sending 'cmds' through 'transaction_batch'.
+        """
+        if not cmds:
+            return (0,0)
+        if (self.comm_interface.get_supported(BATCH_CMD) is False):
+            return (len(cmds),sum([handshake_length(cmd) for cmd in cmds]))
+        body = batch_body(cmds)
+        return (1,handshake_length(BATCH_CMD+str(len(body)).encode()) + len(body) + 4)
+
+    def _full_cost(self,header,positions):
+        (handshakes,nbytes) = self._batch_cost(header)
+        if (self.comm_interface.get_supported(BLOCK_CMD) is False):
+            (more_handshakes,more_bytes) = self._batch_cost([("Y{}".format(pos)).encode() for pos in positions])
+        else:
+            (more_handshakes,more_bytes) = (1,handshake_length(BLOCK_CMD+str(len(positions)).encode()) + block_frame_length(len(positions)))
+        return estimate_cost(handshakes + more_handshakes,nbytes + more_bytes)
+
+    def _patch_cost(self,runs,params):
+        (handshakes,nbytes) = self._batch_cost(params)
+        nwords = max(3,len(patch_words(runs)))
+        return estimate_cost(handshakes + 1,nbytes + handshake_length(PATCH_CMD+str(nwords).encode()) + block_frame_length(nwords))
+
+    def _load_positions(self,load_header,positions):
+        """ Upload a position table (once the header has gone through) and switch the firmware over to it.  Returns False if anything went wrong along the way.
+        """
+        try:
+            # The table can't go over until the firmware is in load mode
+            self.comm_interface.wait_result(load_header)
+            self._upload_positions(positions)
+        except:
+            return False
+        return self._switch_over(positions)
+
+    def _patch_positions(self,runs,positions):
+        """ Send just the runs of the table that have changed ('M'), on top of a copy of what's playing.  Returns True if that went through, None if the firmware wouldn't take it (older firmware, or it isn't playing after all), in which case nothing has changed and a full load is still fine, and False if the link failed.
+        """
+        if not runs:
+            # Nothing to patch, but it's still the way into load mode; rewrite the first entry
+            runs = [(0,[positions[0]])]
+        words = patch_words(runs)
+        supported = self.comm_interface.get_supported(PATCH_CMD)
+        try:
+            cmd_ret = self.comm_interface.transaction(PATCH_CMD+str(len(words)).encode(),True,PROBE_TIMEOUT if (supported is None) else 0.5,pack_patch_frame(runs))
+        except PSCommException:
+            # No echo at all; older firmware
+            if (supported is None):
+                self.comm_interface.set_supported(PATCH_CMD,False)
+                return None
+            return False
+        self.comm_interface.set_supported(PATCH_CMD,True)
+        return True if re.match(b'^OK:\s+Patch length',cmd_ret) else None
+
+    def _switch_over(self,positions):
+        """ End the load ('E'), check that the firmware ended up with as many points as we meant it to, and start it playing ('T').
+        """
+        try:
+            cmd_ret = self.comm_interface.transaction(b'E',True)
+            rem = re.match(b'^OK:\s+Buffer length\s+=\s+(\d+)',cmd_ret)
+            if rem:
+                # Check to make sure that the returned length is the same as what we believe we
+                # wrote
+                if (int(rem.group(1)) != len(positions)):
+                    return False
+                # Tell the firmware to switch over to the new data
+                tret = self.comm_interface.transaction(b'T',read_response=True,timeout=5)
+                res = re.match(b'^OK:\s+Waveform playback has begun',tret)
+                if not res:
+                    return False
+        except:
+            return False
+        return True
+
+    def _prepare_step(self,i):
+        """ Everything that has to go over for step 'i' of the plan (runs on the ramp producer's thread):  the header commands and the position table.
+        """
+        params = dict(zip(RAMP_PARAMS,self.plan.params[i]))
+        # Attach a new heart rate and respiration rate
+        hr = rate_to_firmware(params["heart_rate"])
+        rr = rate_to_firmware(params["respiration_rate"])
+        header = [b'W',b'H'+str(hr).encode(),b'B'+str(rr).encode(),b'C'+self.cal_max.encode()]
+        return (header,self.plan.positions[i].tolist())
+
+    def _update_rates(self,changed):
+        """ Change the heart rate and/or respiration rate of what's playing, without a new table:  one command apiece.  Returns False if the firmware doesn't know how (older firmware never echoes these), in which case it's a full load as usual.
+        """
+        for (p,cmd) in [("heart_rate",LIVE_HR_CMD),("respiration_rate",LIVE_RR_CMD)]:
+            if p not in changed:
+                continue
+            supported = self.comm_interface.get_supported(cmd)
+            if (supported is False):
+                return False
+            try:
+                self.comm_interface.transaction(cmd+str(rate_to_firmware(self.ps_state.get_state(p))).encode(),False,PROBE_TIMEOUT if (supported is None) else 0.5)
+                self.comm_interface.set_supported(cmd,True)
+            except PSCommException:
+                if (self.comm_interface.get_supported(cmd) is None):
+                    self.comm_interface.set_supported(cmd,False)
+                return False
+        # The playing table has taken on the new rates; a patch on top of it keeps them
+        loaded = self.ps_state.get_state("loaded_table")
+        if loaded:
+            hr = b'H'+str(rate_to_firmware(self.ps_state.get_state("heart_rate"))).encode()
+            rr = b'B'+str(rate_to_firmware(self.ps_state.get_state("respiration_rate"))).encode()
+            loaded["header"] = [hr if (cmd[:1] == b'H') else (rr if (cmd[:1] == b'B') else cmd) for cmd in loaded["header"]]
+        return True
+
+    def _upload_positions(self,positions):
+        """ Send the position table over to the firmware.  Newer firmware takes the whole table as a single binary frame ('K'), which costs one handshake instead of one per point; older firmware doesn't know that command, so we fall back to sending one 'Y' per point (batched, where the firmware allows it).
+        """
+        supported = self.comm_interface.get_supported(BLOCK_CMD)
+        if (supported is not False):
+            try:
+                cmd_ret = self.comm_interface.transaction(BLOCK_CMD+str(len(positions)).encode(),True,PROBE_TIMEOUT if (supported is None) else 0.5,pack_block_frame(positions))
+                # Any answer at all means the firmware knows the command.  If it took the frame, we're
+                # done (the 'E' check will catch a short count); if it rejected the frame (CRC, length,
+                # timeout), nothing was loaded, so it's safe to go the long way round.
+                self.comm_interface.set_supported(BLOCK_CMD,True)
+                if re.match(b'^OK:\s+Block length',cmd_ret):
+                    return
+            except PSCommException:
+                # No echo at all; this is older firmware, so don't bother trying again on this
+                # connection.  If the command has worked before, just treat it as a one-off failure.
+                if (self.comm_interface.get_supported(BLOCK_CMD) is None):
+                    self.comm_interface.set_supported(BLOCK_CMD,False)
+        self.comm_interface.transaction_batch([("Y{}".format(pos)).encode() for pos in positions])
+
     def _modify_table(self,systolic,diastolic):
         # Modify this parameter to change the amount of truncation/extension
         scale = 3
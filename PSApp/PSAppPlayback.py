@@ -6,50 +6,62 @@ import numpy as np
 from time import sleep
 from PSAppSharedFunctions import convert_mpsi_to_mmhg
 from PSAppState import *
+from PSAppDefaults import get_default_signal_batch_size, get_default_signal_batch_period
+from PSAppDataBroker import DROP_OLDEST
+from PSAppSignalMeter import PSAppSignalMeter
 
 class PSAppPulsePlaybackWorker(QObject):
     """ Routine for running calibration on the system.
     """
-    new_data_point = pyqtSignal(object)
+    new_data_points = pyqtSignal(object)
     bad_message_format = pyqtSignal()
     data_read_fail = pyqtSignal()
+    calibration_drift = pyqtSignal(float)
     finished = pyqtSignal()
-    def __init__(self,comm_interface,data_iface):
+    def __init__(self,comm_interface,data_iface,batch_size=None,batch_period=None,tracker=None):
+        """ Initialization function.  Waveform points go out through 'new_data_points' in batches (an array of SAMPLE_DTYPE), once there are 'batch_size' of them or 'batch_period' seconds after the first one came in, whichever happens first.  If there's a 'tracker' (PSAppDriftTracker), every point also goes to it, and 'calibration_drift' goes out (with the drift, in mmHg) when the calibration looks to have moved.
+        """
         super(PSAppPulsePlaybackWorker,self).__init__()
         self.comm_interface = comm_interface
         self.data_iface = data_iface
-        self.data_iface["ser"].timeout = 3
+        self.batch_size = batch_size if batch_size else get_default_signal_batch_size()
+        self.batch_period = batch_period if batch_period else get_default_signal_batch_period()
+        self.meter = PSAppSignalMeter()
+        self.tracker = tracker
         self.keep_playing = False
 
     def run(self):
+        # Waveform points come in through the data broker.  The plot only cares about the latest
+        # data, so if we ever fall behind, the oldest points get dropped.
+        samples = self.data_iface["broker"].subscribe(maxlen=512,policy=DROP_OLDEST)
         # Sit in a loop grabbing data until we're told otherwise
         self.keep_playing = True
         while self.keep_playing:
-            try:
-                data = self.data_iface["ser"].readline()
-                rem = re.match(b'^W,\d+,(\d+),(\d+)',data)
-                if rem:
-                    mmhg_reading = convert_mpsi_to_mmhg(int(rem.group(2)))
-                    self.new_data_point.emit([int(rem.group(1)),mmhg_reading])
-                else:
-                    self.bad_message_format.emit()
-                    self.keep_playing = False
-            except:
+            batch = samples.get_batch(timeout=3,count=self.batch_size,period=self.batch_period)
+            waveform = (batch["mode"] == b'W')
+            if waveform.any():
+                self.meter.emitted(int(np.count_nonzero(waveform)),samples.get_depth(),samples.get_dropped())
+                self.new_data_points.emit(batch[waveform])
+                if self.tracker:
+                    points = batch[waveform]
+                    drift = self.tracker.update(points["pos"],points["mmhg"])
+                    if self.tracker.check():
+                        self.calibration_drift.emit(drift)
+            # Nothing at all for the whole timeout means the data interface has gone quiet; anything
+            # other than waveform points means the firmware isn't playing back any more.
+            if (len(batch) == 0) and self.keep_playing:
                 self.data_read_fail.emit()
                 self.keep_playing = False
+            elif not(waveform.all()) and self.keep_playing:
+                self.bad_message_format.emit()
+                self.keep_playing = False
 
         # If we're outside of this loop, we've been told to stop playback.  In order to do this,
-        # send the command to the firmware, and then read data from the data interface until we get
-        # a timeout.
+        # send the command to the firmware, and then wait for the data to stop coming in.
         self.comm_interface.transaction(b'S')
-        self.data_iface["ser"].timeout = 1
-        while True:
-            try:
-                res = self.data_iface["ser"].readline()
-                if (len(res) == 0):
-                    break
-            except:
-                break
+        while len(samples.get_batch(timeout=1)):
+            pass
+        self.data_iface["broker"].unsubscribe(samples)
         self.finished.emit()
 
     def stop_playback(self):
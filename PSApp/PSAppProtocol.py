@@ -0,0 +1,387 @@
+import binascii, collections, random, re, struct, threading
+from time import monotonic
+from PSAppSharedFunctions import PSCommException
+
+# Commands understood by newer firmware only; older firmware throws these away without echoing them,
+# which is how the comm interface figures out whether they can be used.
+BLOCK_CMD = b'K'
+BATCH_CMD = b'P'
+# Heart rate and respiration rate changes that take effect during playback, without loading a new table
+LIVE_HR_CMD = b'J'
+LIVE_RR_CMD = b'U'
+# Partial table load:  only the entries that differ from the table that's playing
+PATCH_CMD = b'M'
+
+# Older firmware never echoes the commands above, so the first attempt at one uses a short timeout;
+# otherwise finding out costs several seconds of re-sends.
+PROBE_TIMEOUT = 0.1
+
+# Largest table the firmware will accept in a single frame (see MAX_BLOCK_LENGTH in 'ps_indicators.h'),
+# and largest batch of command lines, in bytes (MAX_BATCH_LENGTH)
+MAX_BLOCK_LENGTH = 1024
+MAX_BATCH_LENGTH = 2048
+
+# Rough costs, for weighing one way of getting a table over against another:  a handshake round trip
+# (which is mostly the USB polling interval), and a byte on the wire.
+HANDSHAKE_COST = 1e-3
+BYTE_COST = 1e-5
+
+# How long the handshake waits for a line is worked out the way TCP works out its retransmission
+# timeout (RFC 6298):  a smoothed round trip time and how much it varies are kept for each kind of
+# exchange, and the timeout is the one plus RTT_K times the other, but never less than MIN_TIMEOUT.
+# On a healthy link an echo is back in a millisecond or two, so one that's gone missing is noticed
+# that quickly rather than after the caller's timeout; the caller's timeout is still the longest any
+# single read waits, and what's used until there's something to go on.  Every read that comes back
+# empty doubles the wait, up to the caller's timeout again.  Echoes take about as long whatever the
+# command, so a command that hasn't been seen yet goes by all the others; responses don't.  The
+# estimate only covers the wait for a line to start:  a line that's part way in when it runs out
+# gets the caller's whole timeout to finish.  The floor is there because a USB CDC port can sit on a
+# packet for a good few milliseconds, and a timeout that's cut that fine keeps going off for nothing.
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+RTT_K = 4.0
+MIN_TIMEOUT = 0.1
+ECHO = "echo"
+RESPONSE = "response"
+# When the firmware says it's busy, wait a random time (up to BUSY_BACKOFF, doubling with every busy
+# response up to MAX_BUSY_BACKOFF) before sending again, instead of asking again straight away; a
+# device that's in the middle of a move isn't kept busy answering, and retries don't fall into step.
+BUSY_BACKOFF = 0.005
+MAX_BUSY_BACKOFF = 0.25
+# Busy responses to put up with when there's a deadline (without one, they count as ordinary tries).
+# At the paces above this is around 4s of asking, more than the longest move (seeking home from the
+# far end) keeps the firmware busy; firmware that's busy for longer than that is stuck.
+MAX_BUSY_RETRIES = 40
+# Lines that aren't the echo (or a busy response) to read past before giving up on the echo
+MAX_STRAY_LINES = 4
+# Besides bytes to write, these are what 'handshake' asks of whoever is running it:  the next line,
+# within 'timeout' seconds, or a pause of 'seconds' before carrying on.
+HandshakeRead = collections.namedtuple("HandshakeRead","timeout")
+HandshakeWait = collections.namedtuple("HandshakeWait","seconds")
+
+# Commands that the firmware will run from inside a batch.  Everything else either produces a
+# response of its own or kicks off motor activity, so it has to go through the normal handshake.
+BATCHABLE_CMDS = b'WYHBC'
+
+def crc16_ccitt(data,crc=0xFFFF):
+    """ CRC-16/CCITT over 'data'; the firmware calculates the same thing byte by byte in 'crc16_update'.
+    """
+    return binascii.crc_hqx(bytes(data),crc)
+
+def _pack_frame(count,body):
+    """ Every frame is laid out the same way, little-endian:  a 16b count, the body, then a 16b CRC over everything before it.
+    """
+    head = struct.pack("<H",count) + body
+    return head + struct.pack("<H",crc16_ccitt(head))
+
+def _unpack_frame(frame,unit):
+    """ Check the length and CRC of a frame whose body is 'count' items of 'unit' bytes apiece; returns the count and the body.
+    """
+    if (len(frame) < 4):
+        raise PSCommException("Frame is too short ({} bytes).".format(len(frame)))
+    (count,) = struct.unpack("<H",frame[:2])
+    if (len(frame) != (unit * count + 4)):
+        raise PSCommException("Frame length mismatch, count = {}, frame = {} bytes.".format(count,len(frame)))
+    (crc,) = struct.unpack("<H",frame[-2:])
+    if (crc != crc16_ccitt(frame[:-2])):
+        raise PSCommException("Frame CRC mismatch.")
+    return (count,bytes(frame[2:-2]))
+
+def pack_block_frame(values):
+    """ Build the binary frame that follows a 'K<count>' handshake:  one signed 16b value per entry.
+    """
+    if (len(values) > MAX_BLOCK_LENGTH):
+        raise PSCommException("Block of {} entries exceeds the maximum of {}.".format(len(values),MAX_BLOCK_LENGTH))
+    return _pack_frame(len(values),struct.pack("<{}h".format(len(values)),*[int(v) for v in values]))
+
+def unpack_block_frame(frame):
+    """ Inverse of 'pack_block_frame'; checks the length and CRC and returns the list of values.
+    """
+    (count,body) = _unpack_frame(frame,2)
+    return list(struct.unpack("<{}h".format(count),body))
+
+def block_frame_length(count):
+    """ Number of bytes in a frame carrying 'count' entries.
+    """
+    return 2 * count + 4
+
+def diff_runs(old,new,merge_gap=2):
+    """ Where 'new' differs from 'old' (same length), as a list of (start,values) runs.  Every run costs two extra words (start and length), so runs that are within 'merge_gap' entries of each other are sent as one, unchanged entries and all.
+    """
+    runs = list()
+    n = len(new)
+    i = 0
+    while (i < n):
+        if (old[i] == new[i]):
+            i += 1
+            continue
+        start = i
+        end = i
+        i += 1
+        while (i < n) and ((i - end) <= (merge_gap + 1)):
+            if (old[i] != new[i]):
+                end = i
+            i += 1
+        runs.append((start,[int(v) for v in new[start:(end + 1)]]))
+        i = end + 1
+    return runs
+
+def estimate_cost(handshakes,nbytes):
+    """ About how long (in seconds) it takes to get 'nbytes' across with 'handshakes' handshakes; only good for comparisons.
+    """
+    return handshakes * HANDSHAKE_COST + nbytes * BYTE_COST
+
+def handshake_length(cmd):
+    """ Bytes on the wire for the handshake alone:  the command and '\n', its echo, and the go-ahead.
+    """
+    return 2 * (len(cmd) + 1) + 1
+
+def pack_patch_frame(runs):
+    """ Build the frame that follows an 'M<count>' handshake:  a block frame (see 'pack_block_frame') of start index, run length, then the run's values, for each run.  'count' is the number of entries in it, i.e. len(patch_words(runs)).
+    """
+    return pack_block_frame(patch_words(runs))
+
+def patch_words(runs):
+    words = list()
+    for (start,values) in runs:
+        words += [start,len(values)] + list(values)
+    return words
+
+def unpack_patch_frame(frame):
+    """ Inverse of 'pack_patch_frame'; checks the frame and the runs in it and returns the runs.
+    """
+    words = unpack_block_frame(frame)
+    runs = list()
+    i = 0
+    while (i < len(words)):
+        if ((i + 2) > len(words)):
+            raise PSCommException("Patch malformed at = {}".format(i))
+        (start,n) = words[i:(i + 2)]
+        values = words[(i + 2):(i + 2 + n)]
+        if (start < 0) or (n <= 0) or ((start + n) > MAX_BLOCK_LENGTH) or (len(values) != n) or (min(values) <= 0):
+            raise PSCommException("Patch malformed at = {}".format(i))
+        runs.append((start,values))
+        i += 2 + n
+    return runs
+
+def batch_body(cmds):
+    """ Body of a batch frame:  the commands, each terminated by '\\n', exactly as they'd be sent one at a time.
+    """
+    return b''.join([cmd+b'\n' for cmd in cmds])
+
+def pack_batch_frame(cmds):
+    """ Build the binary frame that follows a 'P<nbytes>' handshake.  Here the count is a byte count.
+    """
+    body = batch_body(cmds)
+    if (len(body) > MAX_BATCH_LENGTH):
+        raise PSCommException("Batch of {} bytes exceeds the maximum of {}.".format(len(body),MAX_BATCH_LENGTH))
+    return _pack_frame(len(body),body)
+
+def unpack_batch_frame(frame):
+    """ Inverse of 'pack_batch_frame'; returns the list of commands.
+    """
+    (count,body) = _unpack_frame(frame,1)
+    return body.split(b'\n')[:-1]
+
+def batch_frame_length(nbytes):
+    """ Number of bytes in a frame carrying 'nbytes' worth of command lines.
+    """
+    return nbytes + 4
+
+def batch_param(line):
+    """ Integer parameter of a command line, by the same rules as 'readint' in the firmware:  digits accumulate and a '-' anywhere makes the result negative.
+    """
+    d = 0
+    for c in bytes(line):
+        if (c >= 0x30) and (c <= 0x39):
+            d = d * 10 + (c - 0x30)
+    return -d if (b'-' in line) else d
+
+def is_batchable(cmd):
+    return (len(cmd) > 0) and (cmd[:1] in BATCHABLE_CMDS)
+
+class PSAppTimeoutEstimator(object):
+    """ Smoothed round trip time and its variation for every kind of exchange in the handshake (ECHO or RESPONSE, by command letter), and the timeouts that come from them.  Shared by everything that runs handshakes over one interface.
+    """
+    def __init__(self,min_timeout=MIN_TIMEOUT):
+        """ Initialization function.
+        """
+        self.min_timeout = min_timeout
+        self.lock = threading.Lock()
+        # [srtt,rttvar,samples] by (phase,command letter); (ECHO,None) is every echo together
+        self.estimates = dict()
+
+    def get_estimates(self):
+        """ Where the estimates stand, as a dictionary keyed by (phase,command letter) of dictionaries with 'srtt_ms', 'rttvar_ms', 'timeout_ms' and 'samples'.
+        """
+        with self.lock:
+            return dict([((phase,None if (letter is None) else letter.decode(errors="replace")),{"srtt_ms":srtt * 1e3,"rttvar_ms":rttvar * 1e3,"timeout_ms":self._timeout(srtt,rttvar) * 1e3,"samples":n}) for ((phase,letter),(srtt,rttvar,n)) in self.estimates.items()])
+
+    def reset(self):
+        with self.lock:
+            self.estimates = dict()
+
+    def sample(self,phase,cmd,rtt):
+        """ 'cmd' took 'rtt' seconds to come back in 'phase'.  Only round trips that can't be mistaken for the answer to an earlier send belong here (Karn's algorithm).
+        """
+        keys = [(phase,cmd[:1])] + ([(phase,None)] if (phase == ECHO) else [])
+        with self.lock:
+            for key in keys:
+                est = self.estimates.get(key)
+                if est is None:
+                    self.estimates[key] = [rtt,0.5 * rtt,1]
+                else:
+                    est[1] = (1.0 - RTT_BETA) * est[1] + RTT_BETA * abs(est[0] - rtt)
+                    est[0] = (1.0 - RTT_ALPHA) * est[0] + RTT_ALPHA * rtt
+                    est[2] += 1
+
+    def _timeout(self,srtt,rttvar):
+        return max(self.min_timeout,srtt + RTT_K * rttvar)
+
+    def timeout(self,phase,cmd,ceiling):
+        """ How long to wait for 'cmd' in 'phase', at most 'ceiling'; 'ceiling' itself if there's nothing to go on yet.
+        """
+        with self.lock:
+            est = self.estimates.get((phase,cmd[:1]))
+            if (est is None) and (phase == ECHO):
+                est = self.estimates.get((phase,None))
+            if est is None:
+                return ceiling
+            return min(ceiling,self._timeout(est[0],est[1]))
+
+def handshake(cmd,read_response=False,payload=None,deadline=None,tally=None,timeout=0.5,estimator=None):
+    """ The echo handshake for a single command, without any I/O of its own, so that it can be stepped through against a real port, the emulator, or a script of replies in a test.  It's a generator:  it yields bytes to be written, a HandshakeRead when it wants the next line (send back b'' if nothing comes within its timeout), or a HandshakeWait for a pause, and it returns the response.  If there's a payload (i.e., a binary frame), it goes out right after the handshake completes.
+
+    Each read waits as long as 'estimator' (a PSAppTimeoutEstimator) says, if there is one, and never more than 'timeout'; the round trips that go well are fed back into it.  Busy responses are retried after a random pause that grows each time, up to MAX_BUSY_RETRIES of them with a deadline.  Retries stop once 'deadline' (time.monotonic) has passed, and no read or pause goes much past it either.
+
+    If 'tally' is given (a dictionary, see 'new_tally' in PSAppCommStats), what happened along the way gets added to it:  every time the command was sent, busy responses, reads that came back empty, echoes that didn't match, and which part failed, if one did.
+    """
+    if tally is None:
+        tally = dict()
+    def count(key):
+        tally[key] = tally.get(key,0) + 1
+    def expired():
+        return (deadline is not None) and (monotonic() > deadline)
+    def clip(wait):
+        # Don't wait past the deadline, but don't ask for a read that can't wait at all either (that
+        # can hand back half a line)
+        return wait if (deadline is None) else min(wait,max(MIN_TIMEOUT,deadline - monotonic()))
+    def read_line(wait):
+        # A serial port hands back whatever it has when the wait runs out, which can be the start of
+        # a line; give the rest of it as long as the caller allows, rather than count it as a mismatch
+        line = yield HandshakeRead(clip(wait))
+        if (len(line) > 0) and not(line.endswith(b'\n')):
+            line += yield HandshakeRead(clip(timeout))
+        return line
+    match = False
+    nbusy = 0
+    attempts = 0
+    # A line that turned up behind the busy responses to the last send, still to be looked at
+    pending = None
+    while (attempts < 10):
+        if pending is not None:
+            # It could be this send's echo or anything else, so it goes through the same checks as a
+            # first reply would; there's no telling which send it answers, so it isn't timed
+            (ret,pending) = (pending,None)
+            nempty = 1
+        else:
+            if expired():
+                break
+            wait = estimator.timeout(ECHO,cmd,timeout) if estimator else timeout
+            count("sends")
+            yield cmd+b'\n'
+            t0 = monotonic()
+            ret = yield from read_line(wait)
+            waited = wait
+            # Firmware that doesn't know a command never echoes it, so don't wait on it forever:  give
+            # it one more try, and after that keep trying only until the waits add up to 'timeout'
+            nempty = 0
+            while ((len(ret) == 0) and (nempty < 10) and ((nempty == 0) or (waited < timeout))):
+                count("empty")
+                if expired():
+                    break
+                # Either the command got lost or the link is slower than it has been; send it again,
+                # and give it longer
+                wait = min(2.0 * wait,timeout)
+                count("sends")
+                yield cmd+b'\n'
+                ret = yield from read_line(wait)
+                waited += wait
+                nempty += 1
+            if (len(ret) == 0) and not(expired()):
+                count("empty")
+            if (len(ret) == 0):
+                break
+        # Something else can get there ahead of the echo (e.g. the 'OK: Data ready' from a move that's
+        # just finished); read past a few of those before deciding the echo isn't coming.  If it was
+        # given up on straight away, it'd be the answer to the next try, and that try's echo would be
+        # taken for the response.
+        nstray = 0
+        while (nstray < MAX_STRAY_LINES) and (len(ret) > 0) and (ret.rstrip() != cmd) and not(re.match(b'^ERR: Busy',ret)):
+            count("mismatches")
+            nstray += 1
+            ret = yield from read_line(wait)
+        if (len(ret) == 0):
+            # Nothing behind it after all; call off whatever the firmware might be holding, and go again
+            yield b'!'
+            attempts += 1
+            continue
+        # After a re-send, there's no telling which send this is the answer to, so don't time it
+        rtt = (monotonic() - t0) if (nempty == 0) else None
+        rem = re.match(b'^ERR: Busy',ret)
+        if (rem):
+            count("busy")
+            if estimator and (rtt is not None):
+                estimator.sample(ECHO,cmd,rtt)
+            yield HandshakeWait(clip(random.uniform(0.0,min(MAX_BUSY_BACKOFF,BUSY_BACKOFF * (2 ** nbusy)))))
+            nbusy += 1
+            # Every byte that gets to a busy firmware is answered on its own, so the rest of this send
+            # has 'ERR: Busy.'s of its own on the way; clear them out, or the next try takes them as its
+            # answers and the firmware ends up running a pile of re-sends.  The first line that isn't
+            # one is kept for the next time round.
+            for j in range(len(cmd)):
+                ret = yield from read_line(wait)
+                if not(re.match(b'^ERR: Busy',ret)):
+                    if (len(ret) > 0):
+                        pending = ret
+                    break
+            # A move can keep the firmware busy for seconds, so with a deadline, keep asking (at that
+            # pace) until it passes or MAX_BUSY_RETRIES runs out; without one, this counts as one of the
+            # ten tries
+            if deadline is None:
+                attempts += 1
+            elif (nbusy >= MAX_BUSY_RETRIES):
+                break
+            continue
+        if (ret.rstrip() == cmd):
+            if estimator and (rtt is not None):
+                estimator.sample(ECHO,cmd,rtt)
+            yield b'\n'
+            match = True
+            break
+        else:
+            count("mismatches")
+            yield b'!'
+            attempts += 1
+    if not match:
+        count("handshake_failures")
+        raise PSCommException("Command handshake failed, command = '{}'".format(cmd.decode()))
+    if payload:
+        yield payload
+    ret = ''
+    if read_response:
+        # Nothing gets sent again here, so every response can be timed, however many reads it took
+        wait = estimator.timeout(RESPONSE,cmd,timeout) if estimator else timeout
+        t0 = monotonic()
+        for i in range(10):
+            ret = yield from read_line(wait)
+            if (len(ret) > 0) or expired():
+                break
+            count("empty")
+            wait = min(2.0 * wait,timeout)
+        if (len(ret) == 0):
+            count("response_failures")
+            raise PSCommException("Read never returned a valid value.")
+        if estimator:
+            estimator.sample(RESPONSE,cmd,monotonic() - t0)
+    return ret
@@ -1,52 +1,72 @@
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
-from time import sleep
+from time import sleep, monotonic
 import re
+import numpy as np
 from PSAppSharedFunctions import convert_mpsi_to_mmhg
+from PSAppSignalMeter import PSAppSignalMeter, format_signal_stats
 
 class PSAppReadPressureWorker(QObject):
     """ Class that actually does the work for updating the pressure readout text.
     """
-    new_reading = pyqtSignal(object)
+    new_readings = pyqtSignal(object)
     reading_error = pyqtSignal()
     comm_error = pyqtSignal()
     finished = pyqtSignal()
-    def __init__(self,comm_interface,data_iface):
+    def __init__(self,comm_interface,data_iface,batch_size=64,batch_period=0.5):
+        """ Initialization function.  Readings (in mmHg) go out through 'new_readings' as an array, once there are 'batch_size' of them or 'batch_period' seconds after the first one, whichever comes first.  The readout is only updated every couple of seconds, so there's no point in sending them across one at a time.
+        """
         super(PSAppReadPressureWorker,self).__init__()
         self.comm_interface = comm_interface
         self.data_iface = data_iface
-        self.data_iface["ser"].timeout = 1
+        self.batch_size = batch_size
+        self.batch_period = batch_period
+        self.meter = PSAppSignalMeter()
         self.is_running = False
 
+    def _flush(self,pending):
+        if pending:
+            self.meter.emitted(len(pending))
+            self.new_readings.emit(np.array(pending))
+            del pending[:]
+
     def run(self):
         self.is_running = True
+        # Readings come in through the data broker; only 'R' packets are any use to us
+        readings = self.data_iface["broker"].subscribe(b'R',maxlen=16)
+        pending = list()
+        first = None
         while (self.is_running):
             success = False
+            # Anything still queued up came from before this request
+            readings.clear()
             try:
-                cmd_result = self.comm_interface.transaction(b'R',True).rstrip()
+                cmd_result = self.comm_interface.transaction(b'R',True,deadline=2).rstrip()
                 rem = re.match(b'^OK',cmd_result)
                 success = True if rem else False
             except:
                 self.comm_error.emit()
                 success = False
             if success:
-                try:
-                    res = self.data_iface["ser"].readline()
-                    rem = re.match(b'^R,\d+,\d+,(\d+)',res.rstrip())
-                    if rem:
-                        iret = int(rem.group(1))
-                        if (iret > 0):
-                        # Must convert mPSI to mmHg
-                            self.new_reading.emit(convert_mpsi_to_mmhg(iret))
-                    else:
-                        self.reading_error.emit()
-                except:
-                    self.comm_error.emit()
-                    self.is_running = False
+                # The reading shows up right behind the 'OK'; it may already be waiting for us
+                sample = readings.get(timeout=1)
+                if sample:
+                    iret = sample.mpsi
+                    if (iret > 0):
+                    # Must convert mPSI to mmHg
+                        if not pending:
+                            first = monotonic()
+                        pending.append(convert_mpsi_to_mmhg(iret))
+                else:
+                    self.reading_error.emit()
             else:
                 self.reading_error.emit()
+            if pending and ((len(pending) >= self.batch_size) or ((monotonic() - first) >= self.batch_period)):
+                self._flush(pending)
             sleep(0.1)
+        self._flush(pending)
+        self.data_iface["broker"].unsubscribe(readings)
         self.finished.emit()
 
     def stop(self):
@@ -93,7 +113,7 @@ class PSAppReadPressureDialog(QDialog):
         self.worker = PSAppReadPressureWorker(comm_interface,data_iface)
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.run)
-        self.worker.new_reading.connect(self._update_pressure_reading)
+        self.worker.new_readings.connect(self._update_pressure_readings)
         self.worker.reading_error.connect(self._indicate_read_error)
         self.worker.comm_error.connect(self._indicate_comm_error)
         self.thread.start()
@@ -131,6 +151,8 @@ class PSAppReadPressureDialog(QDialog):
         else:
             self.current_pressure.setText("ERR")
             self.prime_button.setEnabled(False)
+        # How busy the worker is keeping us, for anybody who hovers over the readout
+        self.current_pressure.setToolTip("Readings: {}".format(format_signal_stats(self.worker.meter.get_stats())))
         QApplication.processEvents()
         self.press_readings = list()
 
@@ -174,10 +196,11 @@ class PSAppReadPressureDialog(QDialog):
         self.worker.finished.connect(lambda: self._wait_for_thread_exit(True))
         self.worker.stop()
 
-    def _update_pressure_reading(self,val):
-        """ Add the value to the press_readings.  Start up the timer if it hasn't been started yet.
+    def _update_pressure_readings(self,vals):
+        """ Add the values to the press_readings.  Start up the timer if it hasn't been started yet.
         """
-        self.press_readings.append(val)
+        self.worker.meter.delivered()
+        self.press_readings.extend(vals.tolist())
         if not(self.timer.isActive()):
             self.timer.start()
 
@@ -0,0 +1,169 @@
+import numpy as np
+import re
+from collections import namedtuple
+from PSAppSharedFunctions import convert_mpsi_to_mmhg
+
+# One row per line from the data interface ('<mode>,<position or index>,<time in ms>,<pressure in mPSI>',
+# see 'ps_data.xc'), with the pressure already converted to mmHg.  Lines that don't parse come out as
+# a row with mode MALFORMED and zeros everywhere else, so the rows stay in the order they arrived.
+SAMPLE_DTYPE = np.dtype([("mode","S1"),("pos","i8"),("tms","i8"),("mpsi","i8"),("mmhg","f8")])
+MALFORMED = b'?'
+DATA_MODES = b'RIHOW'
+
+# A single row, for consumers that take one sample at a time.  The mode says what produced it:  'H'ome,
+# 'R'ead, 'I'ncrement, 'O'ffset or 'W'aveform.
+PSAppSample = namedtuple("PSAppSample",["mode","pos","tms","mpsi","mmhg"])
+
+# Anything longer than this can't be a real packet (three numbers of up to 10 digits apiece, plus the
+# mode, commas and '\r'); it also keeps the numbers well clear of overflowing 64b integers.
+MAX_LINE_LENGTH = 40
+
+# Below this many lines, the fixed cost of the numpy calls is more than the work itself (which is the
+# usual case during playback:  a line every 20ms), so go line by line.  Same rules either way.
+SMALL_BATCH = 16
+DATA_LINE = re.compile(b'^([RIHOW]),(\d+),(\d+),(\d+)\r?$')
+
+NL = 0x0A
+CR = 0x0D
+COMMA = 0x2C
+SPACE = 0x20
+
+def parse_lines(chunk):
+    """ Decode a block of complete lines (it has to end in '\\n') into an array of SAMPLE_DTYPE, all in one go instead of a regex per line.  A line is good if it's a mode character and three unsigned decimal numbers, separated by commas, with nothing else but an optional '\\r' at the end.
+    """
+    if (bytes(chunk[:(SMALL_BATCH * MAX_LINE_LENGTH)]).count(b'\n') < SMALL_BATCH):
+        return _parse_few_lines(chunk)
+    arr = np.frombuffer(chunk,dtype=np.uint8)
+    nl = np.flatnonzero(arr == NL)
+    nlines = len(nl)
+    out = np.zeros(nlines,dtype=SAMPLE_DTYPE)
+    if (nlines == 0):
+        return out
+    starts = np.empty(nlines,dtype=np.intp)
+    starts[0] = 0
+    starts[1:] = nl[:-1] + 1
+    lens = nl - starts
+    # Which line every byte belongs to
+    line_id = np.zeros(len(arr),dtype=np.intp)
+    line_id[starts[1:]] = 1
+    line_id = np.cumsum(line_id)
+
+    is_digit = (arr >= 0x30) & (arr <= 0x39)
+    is_comma = (arr == COMMA)
+    # A '\r' is fine, but only right in front of the '\n'
+    cr_ok = np.zeros(len(arr),dtype=bool)
+    cr_ok[nl[lens > 0] - 1] = (arr[nl[lens > 0] - 1] == CR)
+    # The mode character sits at the start of the line, followed by a comma
+    first = arr[np.minimum(starts,len(arr) - 1)]
+    second = arr[np.minimum(starts + 1,len(arr) - 1)]
+    stray = ~(is_digit | is_comma | cr_ok | (arr == NL))
+    stray[starts] = False
+    # Every comma has to be followed by at least one digit (no empty fields)
+    next_digit = np.zeros(len(arr),dtype=bool)
+    next_digit[:-1] = is_digit[1:]
+    good = (lens >= 7) & (lens <= MAX_LINE_LENGTH)
+    good &= np.isin(first,np.frombuffer(DATA_MODES,dtype=np.uint8)) & (second == COMMA)
+    good &= (np.bincount(line_id[is_comma],minlength=nlines) == 3)
+    good &= (np.bincount(line_id[stray],minlength=nlines) == 0)
+    good &= (np.bincount(line_id[is_comma & ~next_digit],minlength=nlines) == 0)
+
+    # Now that only good lines are left, blank out the mode characters and commas and let numpy pull
+    # out the numbers; there are exactly three per line.
+    ngood = int(np.count_nonzero(good))
+    out["mode"] = MALFORMED
+    if ngood:
+        keep = good[line_id]
+        text = arr.copy()
+        text[starts] = SPACE
+        text[is_comma] = SPACE
+        vals = np.fromstring(text[keep].tobytes(),dtype=np.int64,sep=' ').reshape(ngood,3)
+        rows = out[good]
+        rows["mode"] = first[good].view("S1")
+        rows["pos"] = vals[:,0]
+        rows["tms"] = vals[:,1]
+        rows["mpsi"] = vals[:,2]
+        rows["mmhg"] = convert_mpsi_to_mmhg(vals[:,2])
+        out[good] = rows
+    return out
+
+def _parse_few_lines(chunk):
+    """ 'parse_lines' for a handful of lines.
+    """
+    lines = bytes(chunk).split(b'\n')[:-1]
+    out = np.zeros(len(lines),dtype=SAMPLE_DTYPE)
+    for (i,line) in enumerate(lines):
+        rem = DATA_LINE.match(line) if (len(line) <= MAX_LINE_LENGTH) else None
+        if rem:
+            mpsi = int(rem.group(4))
+            out[i] = (rem.group(1),int(rem.group(2)),int(rem.group(3)),mpsi,convert_mpsi_to_mmhg(mpsi))
+        else:
+            out[i]["mode"] = MALFORMED
+    return out
+
+class PSAppSampleParser(object):
+    """ Chunked reader/decoder for the data interface.  Bytes go into a preallocated buffer, every complete line in it is decoded at once (see 'parse_lines'), and whatever partial line is left over is carried on to the next read.
+    """
+    def __init__(self,bufsize=65536):
+        """ Initialization function.
+        """
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.nbuf = 0
+        self.nlines = 0
+        self.nmalformed = 0
+
+    def _consume(self):
+        """ Decode all of the complete lines in the buffer and shift the leftover to the front.
+        """
+        last = self.buf.rfind(b'\n',0,self.nbuf)
+        if (last < 0):
+            if (self.nbuf == len(self.buf)):
+                # A whole buffer without a line ending; that's no packet, so throw it away
+                self.nbuf = 0
+                self.nlines += 1
+                self.nmalformed += 1
+                return np.array([(MALFORMED,0,0,0,0.0)],dtype=SAMPLE_DTYPE)
+            return np.zeros(0,dtype=SAMPLE_DTYPE)
+        samples = parse_lines(self.view[:(last + 1)])
+        rem = self.nbuf - (last + 1)
+        self.buf[:rem] = self.buf[(last + 1):self.nbuf]
+        self.nbuf = rem
+        self.nlines += len(samples)
+        self.nmalformed += int(np.count_nonzero(samples["mode"] == MALFORMED))
+        return samples
+
+    def feed(self,data):
+        """ Add bytes from wherever (e.g. a pty, or a test) and return the samples that are now complete.
+        """
+        chunks = list()
+        data = memoryview(data)
+        while len(data):
+            n = min(len(data),len(self.buf) - self.nbuf)
+            self.buf[self.nbuf:(self.nbuf + n)] = data[:n]
+            self.nbuf += n
+            data = data[n:]
+            chunks.append(self._consume())
+        if (len(chunks) == 1):
+            return chunks[0]
+        return np.concatenate(chunks) if chunks else np.zeros(0,dtype=SAMPLE_DTYPE)
+
+    def get_malformed(self):
+        return self.nmalformed
+
+    def read_from(self,ser):
+        """ Read whatever the port has waiting (or block for up to its timeout for the first byte, if nothing is) straight into the buffer, and return the samples that are now complete.
+        """
+        n = max(1,min(ser.in_waiting,len(self.buf) - self.nbuf))
+        if hasattr(ser,"readinto"):
+            n = ser.readinto(self.view[self.nbuf:(self.nbuf + n)])
+        else:
+            data = ser.read(n)
+            n = len(data)
+            self.buf[self.nbuf:(self.nbuf + n)] = data
+        self.nbuf += (n or 0)
+        return self._consume()
+
+def sample_from_row(row):
+    """ One row of a SAMPLE_DTYPE array as a PSAppSample.
+    """
+    return PSAppSample(bytes(row["mode"]),int(row["pos"]),int(row["tms"]),int(row["mpsi"]),float(row["mmhg"]))
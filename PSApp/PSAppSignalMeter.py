@@ -0,0 +1,60 @@
+import threading
+from time import monotonic
+
+class PSAppSignalMeter(object):
+    """ Keeps track of how hard a worker is leaning on the GUI thread's event loop:  how many signals (batches) per second it sends across, how many samples are in them, and how many have been sent but not yet handled on the other side.  The worker calls 'emitted' for every batch and the slot on the GUI thread calls 'delivered'.
+    """
+    def __init__(self):
+        """ Initialization function.
+        """
+        self.lock = threading.Lock()
+        self.nemitted = 0
+        self.ndelivered = 0
+        self.depth = 0
+        self.dropped = 0
+        self._restart()
+
+    def _restart(self):
+        self.start = monotonic()
+        self.nsignals = 0
+        self.nsamples = 0
+        self.max_pending = 0
+        self.max_depth = 0
+
+    def delivered(self):
+        with self.lock:
+            self.ndelivered += 1
+
+    def emitted(self,nsamples,depth=0,dropped=0):
+        """ A batch of 'nsamples' is about to go out; 'depth' is how many samples are still waiting in the worker's own queue (e.g. its broker subscription), and 'dropped' how many that queue has thrown away so far.
+        """
+        with self.lock:
+            self.nemitted += 1
+            self.nsignals += 1
+            self.nsamples += nsamples
+            self.depth = depth
+            self.dropped = dropped
+            self.max_pending = max(self.max_pending,self.nemitted - self.ndelivered)
+            self.max_depth = max(self.max_depth,depth)
+
+    def get_stats(self):
+        """ Rates since the last call (or since this was created), plus where the queues stand right now.  Starts a new interval.
+        """
+        with self.lock:
+            elapsed = max(monotonic() - self.start,1e-6)
+            stats = dict()
+            stats["signals_per_s"] = self.nsignals / elapsed
+            stats["samples_per_s"] = self.nsamples / elapsed
+            stats["mean_batch"] = (self.nsamples / self.nsignals) if self.nsignals else 0.0
+            stats["pending"] = self.nemitted - self.ndelivered
+            stats["max_pending"] = self.max_pending
+            stats["depth"] = self.depth
+            stats["max_depth"] = self.max_depth
+            stats["dropped"] = self.dropped
+            self._restart()
+        return stats
+
+def format_signal_stats(stats):
+    """ One line summary of 'PSAppSignalMeter.get_stats', for showing to a human.
+    """
+    return "{:.0f} signals/s, {:.0f} samples/s ({:.1f} per signal), pending {} (max {}), queued {} (max {}), dropped {}".format(stats["signals_per_s"],stats["samples_per_s"],stats["mean_batch"],stats["pending"],stats["max_pending"],stats["depth"],stats["max_depth"],stats["dropped"])
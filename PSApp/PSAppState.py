@@ -1,9 +1,16 @@
 from enum import IntEnum
+import copy
 
 class PlayMode(IntEnum):
     PULSE_TABLE = 0
     WAVEFORM = 1
 
+# Everything that goes into what the firmware is playing.  After a load, these are remembered, so that the
+# next load can tell what actually changed and only send that.
+LOAD_FIELDS = ["systolic","diastolic","heart_rate","respiration_rate","pressure_table","pulse_table_hash","cal_max"]
+# The ones that can be changed during playback without loading a new table
+RATE_FIELDS = ["heart_rate","respiration_rate"]
+
 class PSAppState(object):
     """ Tracks the state of the interaction between the GUI and the firmware running on the pulse simulator hardware (i.e., the XMOS microcontroller).
     """
@@ -21,15 +28,42 @@ class PSAppState(object):
         self.state["respiration_rate"] = 10
         self.state["play_mode"] = PlayMode.PULSE_TABLE
         self.state["pressure_table"] = {"x":list(),"y":list()}
+        # PSAppCalibrationModel fitted to the pressure table, once it's been checked
+        self.state["cal_model"] = None
         self.state["pulse_table"] = {"x":list(),"y":list()}
         self.state["pressure_defaults"] = None
+        # Hash of the contents of the pulse table file that was last read
+        self.state["pulse_table_hash"] = None
+        self.state["cal_max"] = None
+        # What the firmware is playing right now, as it was sent ('header' commands and 'positions'), if
+        # we know for sure; partial loads are worked out against this
+        self.state["loaded_table"] = None
+        self.loaded = None
 
     def clear_pressure_table(self):
         self.state["pressure_table"] = {"x":list(),"y":list()}
+        self.state["cal_model"] = None
+
+    def clear_loaded(self):
+        """ Forget what was loaded (playback has stopped, the connection has gone, or a load is part way through); the next load sends everything.
+        """
+        self.loaded = None
+
+    def get_changed(self):
+        """ Which of LOAD_FIELDS have changed since the last successful load (all of them, if there hasn't been one).
+        """
+        if self.loaded is None:
+            return set(LOAD_FIELDS)
+        return set([key for key in LOAD_FIELDS if (self.state[key] != self.loaded[key])])
 
     def get_state(self,key):
         return self.state[key]
 
+    def mark_loaded(self):
+        """ The firmware is now playing exactly what's in here.
+        """
+        self.loaded = copy.deepcopy(dict([(key,self.state[key]) for key in LOAD_FIELDS]))
+
     def populate_pressure_table(self,x=None,y=None):
         """ Special function to quickly populate the pressure table.
         """
@@ -0,0 +1,166 @@
+import numpy as np
+
+# The calibration sweep gives pressure (mmHg) against motor position, one reading per increment.  The
+# readings are noisy, the odd one is way off, and nothing guarantees they go up every time; looking
+# positions up straight from them means a search through the raw points on every call, and a bad point
+# bends every table made from it.  The model throws out readings that are way off, fits a curve that
+# only ever goes up, and keeps the inverse (mmHg to position) as a dense table, so turning pressures
+# into positions is a bit of arithmetic and two array lookups.
+LUT_RESOLUTION = 0.05
+# Readings further than this many (robust) standard deviations from their neighbours get thrown out
+OUTLIER_THRESHOLD = 5.0
+# ...but never for being less than this far off (mmHg), so a very smooth sweep doesn't lose good points
+OUTLIER_FLOOR = 0.5
+
+def local_prediction(y,half=3,x=None):
+    """ What each of 'y' ought to be, going by the 'half' points either side of it (or the nearest 2*'half' points, at the ends):  the local curvature is the median of how much the slope changes from one pair of neighbours to the next, the slope at the point is the median of the slopes between neighbours once that curvature is allowed for, and the prediction is the median of what each neighbour says once both are taken out.  Medians all round, so one bad point can't drag its neighbours' predictions off with it.  'x' is where the points are (in order); without it, they're taken as evenly spaced.
+    """
+    y = np.asarray(y,dtype=np.float64)
+    n = len(y)
+    if (n < 3):
+        return y.copy()
+    x = np.arange(n,dtype=np.float64) if (x is None) else np.asarray(x,dtype=np.float64)
+    width = 2 * min(half,(n - 1) // 2) + 1
+    i = np.arange(n)
+    starts = np.clip(i - (width // 2),0,n - width)
+    windows = np.lib.stride_tricks.sliding_window_view(y,width)[starts]
+    xwindows = np.lib.stride_tricks.sliding_window_view(x,width)[starts]
+    offsets = np.arange(width)[None,:] - (i - starts)[:,None]
+    # Two readings at the same position say nothing about the slope
+    dx = np.diff(xwindows,axis=1)
+    mid = 0.5 * (xwindows[:,1:] + xwindows[:,:-1])
+    with np.errstate(divide='ignore',invalid='ignore'):
+        slopes = np.where(dx > 0,np.diff(windows,axis=1) / dx,np.nan)
+        dmid = np.diff(mid,axis=1)
+        curvatures = np.where(dmid > 0,np.diff(slopes,axis=1) / dmid,np.nan)
+    # A straight line would be a long way off wherever the curve bends (right past home, on every
+    # cuff), so the curvature is taken out as well
+    curvatures[~(~np.isnan(curvatures)).any(axis=1)] = 0.0
+    curvature = np.nanmedian(curvatures,axis=1)
+    slopes[~(~np.isnan(slopes)).any(axis=1)] = 0.0
+    dist = xwindows - x[:,None]
+    # Each slope between neighbours is the slope halfway between them; bring it back to the point itself
+    slope = np.nanmedian(slopes - curvature[:,None] * (mid - x[:,None]),axis=1)
+    detrended = windows - slope[:,None] * dist - 0.5 * curvature[:,None] * dist ** 2
+    # Leave the point itself out
+    neighbours = detrended[offsets != 0].reshape(n,width - 1)
+    return np.median(neighbours,axis=1)
+
+def edge_prediction(y,x=None):
+    """ What each of 'y' ought to be going by a straight line through the two points just before it, and through the two just after it (NaN where there aren't two), as a pair of arrays.
+    """
+    y = np.asarray(y,dtype=np.float64)
+    n = len(y)
+    x = np.arange(n,dtype=np.float64) if (x is None) else np.asarray(x,dtype=np.float64)
+    before = np.full(n,np.nan)
+    after = np.full(n,np.nan)
+    if (n < 3):
+        return (before,after)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        slopes = np.diff(y) / np.diff(x)
+    before[2:] = y[1:-1] + slopes[:-1] * (x[2:] - x[1:-1])
+    after[:-2] = y[1:-1] - slopes[1:] * (x[1:-1] - x[:-2])
+    return (before,after)
+
+def find_outliers(y,threshold=OUTLIER_THRESHOLD,floor=OUTLIER_FLOOR,x=None):
+    """ Which of 'y' (readings in sweep order, at positions 'x' if they aren't evenly spaced) are way off from their neighbours, as a boolean array.  'Way off' is measured against the median absolute deviation of the residuals, so a few bad points can't hide themselves by inflating the spread.  The first and last readings are never thrown out.
+    """
+    y = np.asarray(y,dtype=np.float64)
+    resid = y - local_prediction(y,x=x)
+    mad = np.median(np.abs(resid - np.median(resid))) if len(y) else 0.0
+    limit = max(threshold * 1.4826 * mad,floor)
+    outliers = np.abs(resid) > limit
+    # Where the curve goes round a sharp corner (e.g. a cuff that's slack up to a point), neighbours on
+    # one side of it say nothing about the other, and a good reading on the corner looks way off from
+    # both together.  It only counts if it's way off from each side on its own, too.
+    (before,after) = edge_prediction(y,x)
+    with np.errstate(invalid='ignore'):
+        outliers &= ~(np.abs(y - before) <= limit) & ~(np.abs(y - after) <= limit)
+    # Home is where every table starts from, and at the ends there's only one side to go by
+    if len(y):
+        outliers[[0,-1]] = False
+    return outliers
+
+def isotonic_fit(y,w=None):
+    """ Closest non-decreasing sequence to 'y' (weighted least squares, weights 'w'), by pooling adjacent violators.  Returns the fitted values, and the blocks they were pooled into as (start,end) index pairs.
+    """
+    y = np.asarray(y,dtype=np.float64)
+    w = np.ones(len(y)) if (w is None) else np.asarray(w,dtype=np.float64)
+    # Each block on the stack is [weighted mean, total weight, start index]
+    blocks = list()
+    for i in range(len(y)):
+        blocks.append([y[i],w[i],i])
+        while (len(blocks) > 1) and (blocks[-2][0] >= blocks[-1][0]):
+            (v,wt,start) = blocks.pop()
+            prev = blocks[-1]
+            total = prev[1] + wt
+            prev[0] = (prev[0] * prev[1] + v * wt) / total
+            prev[1] = total
+    bounds = [(b[2],(blocks[i + 1][2] if (i + 1) < len(blocks) else len(y))) for (i,b) in enumerate(blocks)]
+    fit = np.empty(len(y))
+    for (b,(start,end)) in zip(blocks,bounds):
+        fit[start:end] = b[0]
+    return (fit,bounds)
+
+class PSAppCalibrationModel(object):
+    """ Pressure against motor position, from a calibration sweep:  'to_mmhg' for positions to pressures, 'to_steps' (and 'positions', rounded) for the other way round.  Both take single values or arrays.  Outside the range of the sweep, the ends are held, same as np.interp.
+    """
+    def __init__(self,steps,mmhg,resolution=LUT_RESOLUTION,threshold=OUTLIER_THRESHOLD):
+        """ Initialization function.  'steps' and 'mmhg' are the sweep ('pressure_table' x and y in PSAppState); 'resolution' is the spacing (mmHg) of the inverse table.
+        """
+        steps = np.asarray(steps,dtype=np.float64)
+        mmhg = np.asarray(mmhg,dtype=np.float64)
+        if (len(steps) != len(mmhg)):
+            raise ValueError("Calibration has {} positions but {} readings.".format(len(steps),len(mmhg)))
+        order = np.argsort(steps,kind='stable')
+        self.raw_steps = steps[order]
+        self.raw_mmhg = mmhg[order]
+        self.rejected = find_outliers(self.raw_mmhg,threshold,x=self.raw_steps)
+        keep = ~self.rejected
+        (fit,blocks) = isotonic_fit(self.raw_mmhg[keep])
+        kept_steps = self.raw_steps[keep]
+        # One knot per pooled block, so the curve goes strictly up and can be turned around
+        self.x = np.array([kept_steps[start:end].mean() for (start,end) in blocks])
+        self.y = np.array([fit[start] for (start,end) in blocks])
+        if (len(self.x) < 2):
+            raise ValueError("Calibration never goes up; can't make a curve from it.")
+        self.resolution = resolution
+        self.lut_mmhg0 = self.y[0]
+        n = int(np.ceil((self.y[-1] - self.y[0]) / resolution)) + 1
+        self.lut = np.interp(self.lut_mmhg0 + resolution * np.arange(n),self.y,self.x)
+        self.lut_positions = np.rint(self.lut).astype(np.int64)
+        resid = self.raw_mmhg[keep] - fit
+        self.quality = {
+            "npoints":len(self.raw_steps),
+            "nrejected":int(np.count_nonzero(self.rejected)),
+            "nknots":len(self.x),
+            "rms":float(np.sqrt(np.mean(resid ** 2))),
+            "max_residual":float(np.max(np.abs(resid))),
+            "min_mmhg":float(self.y[0]),
+            "max_mmhg":float(self.y[-1]) }
+
+    @classmethod
+    def from_pressure_table(cls,pressure_table,**kwargs):
+        return cls(pressure_table["x"],pressure_table["y"],**kwargs)
+
+    def check(self,max_reject_fraction=0.1,max_rms=2.0):
+        """ Whether the sweep looks good enough to use:  not too many readings thrown out, and the rest close to the fitted curve.
+        """
+        q = self.quality
+        return (q["nrejected"] <= max(1,max_reject_fraction * q["npoints"])) and (q["rms"] <= max_rms)
+
+    def positions(self,mmhg):
+        """ Whole motor positions (as integers) for pressures:  the nearest entry in the inverse table, already rounded.  The table is fine enough that this is never more than a step away from rounding 'to_steps'.
+        """
+        i = np.rint((np.asarray(mmhg,dtype=np.float64) - self.lut_mmhg0) / self.resolution).astype(np.int64)
+        return self.lut_positions[np.clip(i,0,len(self.lut_positions) - 1)]
+
+    def to_mmhg(self,steps):
+        return np.interp(steps,self.x,self.y)
+
+    def to_steps(self,mmhg):
+        """ Motor position for a pressure, from the inverse table:  straight to the right entry, and linear between it and the next one.
+        """
+        u = np.clip((np.asarray(mmhg,dtype=np.float64) - self.lut_mmhg0) / self.resolution,0,len(self.lut) - 1)
+        i = np.minimum(u.astype(np.int64),len(self.lut) - 2)
+        return self.lut[i] + (u - i) * (self.lut[i + 1] - self.lut[i])
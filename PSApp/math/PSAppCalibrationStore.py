@@ -0,0 +1,101 @@
+import json, os, time
+import numpy as np
+from PSAppCalibrationModel import PSAppCalibrationModel
+
+# Calibrations kept on disk between sessions, so a device that was calibrated last time doesn't have
+# to sweep the whole range again before it can do anything.  Each one is filed under the device's USB
+# serial number, the firmware version it was running and the home position it was swept from; change
+# any of those, and it's a different calibration.  Along with the sweep itself, each entry has the
+# time it was taken and the model's quality numbers.
+#
+# A saved calibration is checked before it's trusted:  a handful of positions across the range are
+# measured again, and if any of them is more than SPOT_CHECK_TOLERANCE (mmHg) off from the saved
+# curve, the whole sweep gets done again.
+STORE_FORMAT = 1
+SPOT_CHECK_POINTS = 4
+SPOT_CHECK_TOLERANCE = 3.0
+
+def calibration_key(serial,firmware,home):
+    return "{}|{}|{}".format(serial,firmware,int(home))
+
+def spot_check_positions(model,home,cal_max,n=SPOT_CHECK_POINTS):
+    """ 'n' whole-step positions, evenly spread (in order) from home to 'cal_max', or as much of that as the calibration covers.
+    """
+    lo = max(home,model.x[0])
+    hi = min(cal_max,model.x[-1])
+    return [int(p) for p in np.unique(np.rint(np.linspace(lo,hi,n)))]
+
+def drift(model,steps,mmhg):
+    """ How far (mmHg, worst case) readings 'mmhg' at 'steps' are from what 'model' says they should be.
+    """
+    return float(np.max(np.abs(np.asarray(mmhg,dtype=np.float64) - model.to_mmhg(steps))))
+
+class PSAppCalibrationStore(object):
+    """ Saved calibrations, in a JSON file at 'path'.  The file is read once, when this is created, and written (in full) every time something is saved; a missing or unreadable file is the same as an empty one.
+    """
+    def __init__(self,path):
+        """ Initialization function.
+        """
+        self.path = path
+        self.entries = dict()
+        try:
+            with open(path,'r') as fh:
+                contents = json.load(fh)
+            if (contents.get("format") == STORE_FORMAT):
+                self.entries = contents["calibrations"]
+        except (OSError,ValueError,KeyError,AttributeError):
+            pass
+
+    def get(self,serial,firmware,home,cal_max=None):
+        """ Saved calibration for this device, firmware and home position (a dictionary:  'x', 'y', 'cal_max', 'cal_inc', 'timestamp' and 'quality'), or None if there isn't one.  With 'cal_max', one that doesn't reach that far doesn't count.
+        """
+        if None in [serial,firmware]:
+            return None
+        entry = self.entries.get(calibration_key(serial,firmware,home))
+        if entry and (cal_max is not None) and (entry["cal_max"] < cal_max):
+            return None
+        return entry
+
+    def put(self,serial,firmware,home,cal_max,cal_inc,steps,mmhg,quality):
+        """ Save a calibration ('steps' and 'mmhg', from a sweep up to 'cal_max' in 'cal_inc' increments, and the 'quality' of the model fitted to it), replacing whatever was there for this device, firmware and home position.  Nothing is saved without a serial number and firmware version, since there'd be no telling which device it came from.
+        """
+        if None in [serial,firmware]:
+            return
+        self.entries[calibration_key(serial,firmware,home)] = {
+            "serial":serial,
+            "firmware":firmware,
+            "home":int(home),
+            "cal_max":int(cal_max),
+            "cal_inc":int(cal_inc),
+            "timestamp":time.time(),
+            "x":[int(x) for x in steps],
+            "y":[float(y) for y in mmhg],
+            "quality":quality }
+        self.save()
+
+    def remove(self,serial,firmware,home):
+        if self.entries.pop(calibration_key(serial,firmware,home),None) is not None:
+            self.save()
+
+    def save(self):
+        """ Write the store out; to a temporary file first, so a half-written one is never left behind.  If it can't be written, carry on without it.
+        """
+        tmp = "{}.{}.tmp".format(self.path,os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),exist_ok=True)
+            with open(tmp,'w') as fh:
+                json.dump({"format":STORE_FORMAT,"calibrations":self.entries},fh,indent=1)
+            os.replace(tmp,self.path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @staticmethod
+    def model(entry):
+        return PSAppCalibrationModel(entry["x"],entry["y"])
+
+    @staticmethod
+    def describe(entry):
+        """ One line for the user about a saved calibration:  when it was taken, and how good it was.
+        """
+        return "{} ({} points, {:.2f} mmHg RMS)".format(time.strftime("%Y-%m-%d %H:%M",time.localtime(entry["timestamp"])),entry["quality"]["npoints"],entry["quality"]["rms"])
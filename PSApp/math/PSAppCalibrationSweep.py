@@ -0,0 +1,127 @@
+import bisect
+import numpy as np
+from PSAppCalibrationModel import find_outliers
+
+# The fixed calibration sweep stops at every increment between home and the maximum, and waits the same
+# amount of time at each one.  Most of the curve is close to a straight line, so most of those stops
+# add nothing.  The adaptive sweep makes a coarse pass first (every 'coarse'th increment), works out
+# where straight lines between those points would be off by more than 'tol' mmHg (from the curvature),
+# or where a reading doesn't sit with its neighbours, and goes back for just the increments in there.
+# Every pass goes up from home, same as the fixed sweep, so each point is always approached from the
+# same side.  Instead of a fixed wait, the pressure is read again until two readings in a row agree.
+SETTLE_TOLERANCE = 0.5
+SETTLE_MAX_READS = 8
+
+def settle(reading,read,tol=SETTLE_TOLERANCE,max_reads=SETTLE_MAX_READS):
+    """ Keep calling 'read()' until it comes back within 'tol' of the reading before ('reading' to start with), or 'max_reads' times.  Returns the last reading (None if a read failed) and how many reads it took.
+    """
+    for i in range(max_reads):
+        if reading is None:
+            return (None,i)
+        latest = read()
+        if (latest is not None) and (abs(latest - reading) <= tol):
+            return (latest,i + 1)
+        reading = latest
+    return (reading,max_reads)
+
+def sweep_grid(home,cal_max,cal_inc):
+    """ Every position the fixed sweep stops at:  home, then every 'cal_inc' steps until 'cal_max' is reached (or passed).
+    """
+    n = max(0,int(np.ceil((cal_max - home) / cal_inc)))
+    return home + cal_inc * np.arange(n + 1)
+
+def refine_positions(steps,mmhg,grid,tol=0.5):
+    """ Positions from 'grid' to go back for, in between the ones that have been measured ('steps', in order, with readings 'mmhg').  Each gap gets enough new points that a straight line across each piece is within 'tol' of the curve (going by the curvature at either end of the gap), and the gaps either side of a reading that's well off from its neighbours (more than 'tol', and more than the readings' own noise) get at least one.
+    """
+    steps = np.asarray(steps,dtype=np.float64)
+    mmhg = np.asarray(mmhg,dtype=np.float64)
+    n = len(steps)
+    if (n < 3):
+        return np.zeros(0,dtype=np.asarray(grid).dtype)
+    h = np.diff(steps)
+    slopes = np.diff(mmhg) / h
+    # Second derivative at each point (held at the ends), and the worst of the two ends of each gap
+    curvature = np.empty(n)
+    curvature[1:-1] = 2.0 * np.diff(slopes) / (steps[2:] - steps[:-2])
+    curvature[0] = curvature[1]
+    curvature[-1] = curvature[-2]
+    curvature = np.maximum(np.abs(curvature[:-1]),np.abs(curvature[1:]))
+    # A straight line over a gap of 'h' is off by up to curvature * h^2 / 8
+    pieces = np.maximum(1,np.ceil(h * np.sqrt(curvature / (8.0 * tol)))).astype(np.int64)
+    # Readings off from their neighbours by more than 'tol', or by more than the noise explains if that's bigger
+    suspect = find_outliers(mmhg,3.0,tol,x=steps)
+    pieces[suspect[:-1] | suspect[1:]] = np.maximum(pieces[suspect[:-1] | suspect[1:]],2)
+    grid = np.asarray(grid)
+    new = list()
+    for i in np.flatnonzero(pieces > 1):
+        inside = grid[(grid > steps[i]) & (grid < steps[i + 1])]
+        if len(inside):
+            targets = steps[i] + h[i] * np.arange(1,pieces[i]) / pieces[i]
+            new.append(inside[np.abs(inside[:,None] - targets[None,:]).argmin(axis=0)])
+    if not new:
+        return np.zeros(0,dtype=grid.dtype)
+    return np.unique(np.concatenate(new))
+
+class PSAppCalibrationSweep(object):
+    """ Adaptive calibration sweep from 'home' to 'cal_max', on the grid of 'cal_inc' steps the fixed sweep would use.  The motor and sensor are reached through callbacks (see 'run'), so the same sweep runs against the hardware or a simulation.
+    """
+    def __init__(self,home,cal_max,cal_inc,coarse=4,tol=0.5,passes=1,settle_tol=SETTLE_TOLERANCE,max_reads=SETTLE_MAX_READS):
+        """ Initialization function.  'coarse' is how many increments the first pass skips at a time, 'tol' the straight-line error (mmHg) worth going back for, and 'passes' how many times at most to go back.  A reading is taken as settled once it's within 'settle_tol' mmHg of the one before, or after 'max_reads' readings regardless.
+        """
+        self.home = home
+        self.grid = sweep_grid(home,cal_max,cal_inc)
+        self.coarse = max(1,coarse)
+        self.tol = tol
+        self.passes = passes
+        self.settle_tol = settle_tol
+        self.max_reads = max_reads
+        self.steps = list()
+        self.mmhg = list()
+        self.nmoves = 0
+        self.nreads = 0
+
+    def _record(self,pos,mmhg,report):
+        i = bisect.bisect(self.steps,pos)
+        self.steps.insert(i,pos)
+        self.mmhg.insert(i,mmhg)
+        if report:
+            report(pos,mmhg)
+
+    def _settle(self,reading,read):
+        (reading,nreads) = settle(reading,read,self.settle_tol,self.max_reads)
+        self.nreads += nreads
+        return reading
+
+    def run(self,move,read,go_home,report=None):
+        """ Do the sweep, starting with the motor at home.  'move(n)' moves up 'n' steps and returns a reading (in mmHg), 'read()' takes another reading without moving, and 'go_home()' goes back to home and returns a reading; each returns None if something went wrong, which stops the sweep.  'report(pos,mmhg)' (optional) is called with every settled reading, in the order they're taken; 'steps' and 'mmhg' hold them all, sorted by position.  True if the sweep got all the way through.
+        """
+        self.steps = list()
+        self.mmhg = list()
+        targets = self.grid[::self.coarse]
+        if (targets[-1] != self.grid[-1]):
+            targets = np.append(targets,self.grid[-1])
+        for p in range(self.passes + 1):
+            if (p == 0):
+                self.nreads += 1
+                reading = self._settle(read(),read)
+            else:
+                targets = refine_positions(self.steps,self.mmhg,self.grid,self.tol)
+                if not len(targets):
+                    break
+                self.nmoves += 1
+                reading = go_home()
+            if reading is None:
+                return False
+            if (p == 0):
+                self._record(int(self.home),reading,report)
+            pos = self.home
+            for target in targets:
+                if (target == self.home):
+                    continue
+                self.nmoves += 1
+                reading = self._settle(move(int(target - pos)),read)
+                if reading is None:
+                    return False
+                pos = target
+                self._record(int(target),reading,report)
+        return True
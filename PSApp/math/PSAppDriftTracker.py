@@ -0,0 +1,135 @@
+import threading
+import numpy as np
+from PSAppCalibrationModel import PSAppCalibrationModel
+
+# During playback, every waveform sample pairs a motor position with the pressure measured there, so
+# the calibration can be checked the whole time instead of only when it's run.  What gets tracked is
+# how far the measured pressure is from what the calibration says, as a piecewise-linear function of
+# position (a value at each of a few evenly spaced knots across the positions being played), fitted by
+# recursive least squares.  Each sample only touches the two knots either side of it, so the work per
+# sample is fixed, however long playback goes on.  Older samples are gradually forgotten, so the fit
+# follows the reservoir as it warms up or slowly leaks.
+#
+# Even a perfect calibration won't match exactly while the motor is moving (the pressure lags behind),
+# so drift is measured from where the fit settled after the first WARMUP samples, not from zero.
+DRIFT_KNOTS = 4
+# Samples for the weight of an old one to halve; at a sample per 20ms tick, 30 seconds
+HALF_LIFE = 1500
+WARMUP = 500
+# mmHg; anything more than this away from where it started counts as drift
+DRIFT_THRESHOLD = 2.0
+# Starting uncertainty of each knot (mmHg squared), and how far it's allowed to grow back to when
+# the samples stop telling us anything about it
+PRIOR_VARIANCE = 100.0
+# A knot doesn't count towards drift until it's seen about this many samples' worth
+MIN_WEIGHT = 20.0
+
+class PSAppDriftTracker(object):
+    """ Keeps track of how far the pressures coming back during playback are from 'model' (a PSAppCalibrationModel), between positions 'lo' and 'hi'.  'update' is called from the playback thread, the rest from anywhere.
+    """
+    def __init__(self,model,lo,hi,nknots=DRIFT_KNOTS,half_life=HALF_LIFE,warmup=WARMUP,threshold=DRIFT_THRESHOLD):
+        """ Initialization function.
+        """
+        self.model = model
+        self.knots = np.linspace(lo,max(hi,lo + 1),max(2,nknots))
+        self.forget = 0.5 ** (1.0 / half_life)
+        self.warmup = warmup
+        self.threshold = threshold
+        self.theta = np.zeros(len(self.knots))
+        self.P = PRIOR_VARIANCE * np.eye(len(self.knots))
+        self.weight = np.zeros(len(self.knots))
+        self.reference = None
+        self.nsamples = 0
+        self.flagged = False
+        self.lock = threading.Lock()
+
+    def _basis(self,pos):
+        """ Which pair of knots 'pos' sits between, and how far along (0 to 1) from the first; past either end, it's all on the end knot.
+        """
+        u = (pos - self.knots[0]) / (self.knots[1] - self.knots[0])
+        i = min(max(int(u),0),len(self.knots) - 2)
+        return (i,min(max(u - i,0.0),1.0))
+
+    def update(self,steps,mmhg):
+        """ Take in a batch of samples (positions 'steps' and measured pressures 'mmhg').  Returns the drift so far.
+        """
+        resid = np.asarray(mmhg,dtype=np.float64) - self.model.to_mmhg(steps)
+        lam = self.forget
+        limit = PRIOR_VARIANCE * len(self.knots)
+        with self.lock:
+            theta = self.theta
+            P = self.P
+            for (pos,r) in zip(steps,resid):
+                (i,u) = self._basis(pos)
+                Pphi = (1.0 - u) * P[:,i] + u * P[:,i + 1]
+                k = Pphi / (lam + (1.0 - u) * Pphi[i] + u * Pphi[i + 1])
+                theta += k * (r - (1.0 - u) * theta[i] - u * theta[i + 1])
+                P -= np.outer(k,Pphi)
+                # Only forget while there's still something to forget; knots that aren't being played
+                # would otherwise grow without bound
+                if (np.trace(P) < limit):
+                    P /= lam
+                self.weight *= lam
+                self.weight[i] += 1.0 - u
+                self.weight[i + 1] += u
+            self.nsamples += len(resid)
+            if (self.reference is None) and (self.nsamples >= self.warmup):
+                self.reference = theta.copy()
+            return self._drift()
+
+    def _drift(self):
+        if self.reference is None:
+            return 0.0
+        seen = self.weight >= MIN_WEIGHT
+        return float(np.max(np.abs(self.theta - self.reference)[seen])) if seen.any() else 0.0
+
+    def drift(self):
+        """ Worst change (mmHg) at any knot that's been played enough to say, since the end of the warm up.
+        """
+        with self.lock:
+            return self._drift()
+
+    def check(self):
+        """ True the first time the drift goes past the threshold; it has to come back under half the threshold before it'll come back True again.
+        """
+        d = self.drift()
+        if (not(self.flagged) and (d > self.threshold)):
+            self.flagged = True
+            return True
+        if (self.flagged and (d < 0.5 * self.threshold)):
+            self.flagged = False
+        return False
+
+    def correction(self,steps):
+        """ How much (mmHg) the pressure at 'steps' has moved since the end of the warm up; the end knots are held outside the range being played.
+        """
+        with self.lock:
+            change = np.zeros(len(self.knots)) if (self.reference is None) else (self.theta - self.reference)
+        return np.interp(steps,self.knots,change)
+
+    def corrected_table(self):
+        """ The calibration sweep with the drift added in, as ('x','y') lists for a pressure table.
+        """
+        steps = self.model.raw_steps
+        return ([int(s) for s in steps],(self.model.raw_mmhg + self.correction(steps)).tolist())
+
+    def corrected_model(self):
+        (x,y) = self.corrected_table()
+        return PSAppCalibrationModel(x,y)
+
+    def rebase(self,model):
+        """ 'model' (made from 'corrected_table') is the calibration now; from here on, drift is measured against it.
+        """
+        with self.lock:
+            self.model = model
+            if self.reference is not None:
+                self.theta[:] = self.reference
+            self.flagged = False
+
+    def restart_warmup(self):
+        """ Something changed how the pressure lags behind the motor (heart rate, pressure range), so let the fit settle again and measure drift from there.
+        """
+        with self.lock:
+            self.reference = None
+            self.nsamples = 0
+            self.flagged = False
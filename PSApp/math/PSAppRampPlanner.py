@@ -0,0 +1,116 @@
+import numpy as np
+import math, queue, threading
+from time import monotonic
+
+# Changing parameters in the middle of playback walks from the old values to the new ones a unit at a
+# time, uploading a new table for every step.  Each upload costs a second or so (the firmware only
+# switches tables at the end of a pulse), so a big change in blood pressure can take a long time.  The
+# plan works out every step up front; with a time budget, steps in the middle are skipped so the target
+# is reached in (about) that much time.
+RAMP_PARAMS = ["systolic","diastolic","heart_rate","respiration_rate"]
+
+def plan_ramp(start,goal):
+    """ Every intermediate set of parameters between 'start' and 'goal' (dictionaries keyed by RAMP_PARAMS), as a 2-D array with one row per step and one column per parameter, ending on 'goal'.  The parameter with the furthest to go moves one unit per step, and the others are spread out over the same number of steps (same pacing as the ramp has always had).
+    """
+    start = np.array([float(start[p]) for p in RAMP_PARAMS])
+    goal = np.array([float(goal[p]) for p in RAMP_PARAMS])
+    deltas = goal - start
+    nsteps = max(1,int(np.max(np.abs(deltas))))
+    steps = np.arange(nsteps)[:,None]
+    plan = np.tile(start,(nsteps,1))
+    moving = (deltas != 0)
+    # Every parameter moves on the first step; after that, one unit every 'stride' steps until it gets there
+    stride = np.maximum(1,(nsteps // np.maximum(np.abs(deltas),1)).astype(np.int64))
+    moved = np.minimum(np.abs(deltas),1 + (steps // stride))
+    plan[:,moving] += (np.sign(deltas) * moved)[:,moving]
+    return plan
+
+class PSAppRampPlan(object):
+    """ A ramp (from 'plan_ramp'), together with its position tables (one row of positions per step), and the bookkeeping for skipping steps to stay within 'budget' seconds.  Without a budget, every step gets played.
+    """
+    def __init__(self,params,positions,budget=None):
+        """ Initialization function.
+        """
+        self.params = params
+        self.positions = positions
+        self.budget = budget
+        self.start = None
+        self.nsteps_done = 0
+        self.time_spent = 0.0
+
+    def __len__(self):
+        return len(self.params)
+
+    def get_step_cost(self):
+        """ Average time per step so far, or None if there haven't been any yet.
+        """
+        return (self.time_spent / self.nsteps_done) if self.nsteps_done else None
+
+    def next_step(self,after):
+        """ Index of the step to play after step 'after' (-1 to start), or None once the last step has been reached.  Until we know what a step costs, nothing gets skipped; after that, the remaining steps are thinned out evenly to fit in whatever's left of the budget.  The last step is never skipped.
+        """
+        last = len(self.params) - 1
+        if (after >= last):
+            return None
+        if self.start is None:
+            self.start = monotonic()
+        step_cost = self.get_step_cost()
+        if (self.budget is None) or (step_cost is None):
+            return after + 1
+        remaining = last - after
+        allowed = math.floor((self.budget - (monotonic() - self.start)) / step_cost)
+        if (allowed >= remaining):
+            return after + 1
+        if (allowed <= 1):
+            return last
+        return min(last,after + math.ceil(remaining / allowed))
+
+    def record_step(self,seconds):
+        """ How long the step just played took, start to finish.
+        """
+        self.nsteps_done += 1
+        self.time_spent += seconds
+
+class PSAppRampProducer(threading.Thread):
+    """ Gets the steps of a plan ready ahead of time, on a thread of its own, so the next one is waiting as soon as the current one has been uploaded.  'prepare' turns a step index into whatever the uploader needs; the results come out of 'get' in order, followed by None once the plan is done.  If 'prepare' raises, that exception comes out of 'get' instead (raised again on the caller's thread), and nothing more is prepared.  At most 'depth' steps are prepared ahead, so the choice of which steps to skip stays up to date.
+    """
+    def __init__(self,plan,prepare,depth=2):
+        """ Initialization function.
+        """
+        super(PSAppRampProducer,self).__init__(daemon=True)
+        self.plan = plan
+        self.prepare = prepare
+        self.ready = queue.Queue(maxsize=depth)
+        self.stopped = False
+
+    def _put(self,item):
+        while not self.stopped:
+            try:
+                self.ready.put(item,timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self):
+        item = self.ready.get()
+        if isinstance(item,Exception):
+            raise item
+        return item
+
+    def run(self):
+        i = self.plan.next_step(-1)
+        while (i is not None) and not(self.stopped):
+            # Whoever's waiting in 'get' would never hear about it otherwise
+            try:
+                item = (i,self.prepare(i))
+            except Exception as e:
+                self._put(e)
+                return
+            if not self._put(item):
+                return
+            i = self.plan.next_step(i)
+        self._put(None)
+
+    def stop(self):
+        self.stopped = True
@@ -1,66 +1,70 @@
 import numpy as np
-from struct import unpack
-from math import floor, ceil
-from statistics import mean
-from copy import deepcopy
 
+# Shaping takes a recorded pulse, integrates it, takes the drift out of the integral and stretches the
+# result to fill 13 bits.  Everything is done on whole arrays, one row per pulse, so a library of pulses
+# can be shaped in a single call.  Integer pulses (which is what the table files hold) come out exactly
+# the same as they did from the old point-by-point version.
 def shape_pulse(pts):
-    lpts = len(pts)
+    """ Shape a pulse (a list or 1-D array of points), returning the shaped pulse as a list of integers.  Also takes a 2-D array with one pulse per row (all the same length), in which case the shaped pulses come back as a 2-D array of integers.
+    """
+    pts = np.asarray(pts)
+    if (pts.ndim == 1):
+        return _shape_pulses(pts[None,:])[0].tolist()
+    return _shape_pulses(pts)
 
-    # Create two 'zeros' arrays
-    si = [0] * lpts
-    nsi = [0] * lpts
+def _shape_pulses(pts):
+    npulses,lpts = pts.shape
+    rows = np.arange(npulses)
+    idx = np.arange(lpts)
 
-    # Mean removal
-    avg = floor(mean(pts))
+    # Mean removal; exact for integers, the same as floor(mean(pts))
+    if np.issubdtype(pts.dtype,np.integer):
+        pts = pts.astype(np.int64)
+        avg = pts.sum(axis=1,keepdims=True) // lpts
+    else:
+        pts = pts.astype(np.float64)
+        avg = np.floor(pts.mean(axis=1,keepdims=True))
 
     # Integrate
-    for i in range(1,lpts):
-        nsi[i] = nsi[(i - 1)] + (pts[(i - 1)] - avg)
+    nsi = np.zeros_like(pts)
+    np.cumsum(pts[:,:-1] - avg,axis=1,out=nsi[:,1:])
 
-    # Perform slope corrections
-    midpt = ceil(lpts/2.0)
+    # Perform slope corrections; the line goes from the lowest point near the front to the lowest point in
+    # the back half
+    midpt = int(np.ceil(lpts / 2.0))
     for j in range(2):
-        fmin = min(nsi[1:20])
-        findex = nsi[1:20].index(fmin)
-        findex += 1
-        bmin = min(nsi[midpt:lpts])
-        bindex = nsi[midpt:lpts].index(bmin)
-        bindex += midpt
+        findex = np.argmin(nsi[:,1:20],axis=1) + 1
+        bindex = np.argmin(nsi[:,midpt:],axis=1) + midpt
+        fmin = nsi[rows,findex]
+        bmin = nsi[rows,bindex]
         slope = (bmin - fmin) / (bindex - findex)
-        for i in range(lpts):
-            si[i] = nsi[i] - floor(i * slope) - nsi[findex]
-        nsi = deepcopy(si)
+        nsi = nsi - np.floor(idx * slope[:,None]).astype(nsi.dtype) - fmin[:,None]
 
     # Marry up the point where the integrated pulse starts to tail downward with the first point of the
-    # pulse.  Start at the back, where the integral is linear, and try to figure out where the slope
-    # begins to flatten out.
+    # pulse.  Start at the back, where the integral is linear, and figure out where the slope begins to
+    # flatten out (the last point that drops by less than 'threshold'; 0 if there isn't one).
     threshold = 500
-    rsi = deepcopy(nsi)
-    end = 0
-    i = len(rsi) - 1
-    while (i > 0):
-        if ((rsi[(i - 1)] - rsi[i]) < threshold):
-            end = i
-            break
-        i -= 1
+    flat = (nsi[:,:-1] - nsi[:,1:]) < threshold
+    end = np.where(flat.any(axis=1),lpts - 1 - np.argmax(flat[:,::-1],axis=1),0)
 
-    # Calculate the new slope
-    new_slope = (rsi[end] - rsi[0]) / (256 - end)
+    # Calculate the new slope, and walk the tail down from 'end' with it.  The subtraction is accumulated
+    # one step at a time, like it always was, so the rounding is the same.
+    new_slope = (nsi[rows,end] - nsi[:,0]) / (256 - end)
+    steps = np.empty((npulses,lpts))
+    steps[:,0] = nsi[rows,end]
+    steps[:,1:] = new_slope[:,None]
+    tail = np.subtract.accumulate(steps,axis=1)
+    offset = idx - end[:,None]
+    rsi = np.where(offset > 0,np.take_along_axis(tail,np.maximum(offset,0),axis=1),nsi)
 
-    # Adjust the points
-    for i in range((end + 1),len(rsi)):
-        rsi[i] = rsi[(i - 1)] - new_slope
-
-    # Now remove any offset and re-scale all of the points so that the minimum is at 0 and the maximum
-    # is at 8192 (13b)
-    rmin = min(rsi)
-    rindex = rsi.index(rmin)
-    for i in range(len(rsi)):
-        rsi[i] -= rsi[rindex]
-    rmax = max(rsi)
-    rscale = 8192.0 / rmax
-    for i in range(len(rsi)):
-        rsi[i] = round(rscale * rsi[i])
-
-    return rsi
+    # Now remove any offset and re-scale all of the points so that the maximum is at 8192 (13b).  The
+    # offset has only ever been taken off the points up to the minimum (the point-by-point version zeroed
+    # the minimum in place part way through), and that's kept so existing tables don't change.
+    rindex = np.argmin(rsi,axis=1)
+    rmin = rsi[rows,rindex]
+    rsi = np.where(idx < rindex[:,None],rsi - rmin[:,None],rsi)
+    rsi[rows,rindex] = 0.0
+    rmax = rsi.max(axis=1)
+    if np.any(rmax == 0):
+        raise ValueError("Pulse is flat; can't scale it.")
+    return np.rint((8192.0 / rmax)[:,None] * rsi).astype(np.int64)
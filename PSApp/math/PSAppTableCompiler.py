@@ -0,0 +1,110 @@
+import numpy as np
+import collections, hashlib, threading
+
+# Turning a pulse table into motor positions for a given systolic/diastolic pair.  The same pairs come up
+# over and over (every ramp walks through the same values, and going back and forth between two settings
+# is common), so finished tables are kept in a small LRU cache that's shared by every load.  The cache
+# key includes a hash of the pulse table and of the calibration, so a new table file or a recalibration
+# can never pick up a stale result.
+CACHE_SIZE = 512
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+def array_hash(*arrays):
+    """ Short digest of the contents of one or more arrays (or lists), for use in cache keys.
+    """
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a,dtype=np.float64)
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+def compile_table(table,systolic,diastolic,motor_locs,mmhg_readings,model=None):
+    """ Positions for 'table', stretched so that its minimum lands on 'diastolic' and its maximum on 'systolic' (in mmHg), and then looked up in the calibration ('mmhg_readings' against 'motor_locs', or 'model', a PSAppCalibrationModel, if there is one).  The first position is repeated at the end, since the firmware wraps around.  Without a model, same numbers as working it out point by point, all in one go.
+    """
+    return compile_tables(table,[systolic],[diastolic],motor_locs,mmhg_readings,model)[0].tolist()
+
+def compile_tables(table,systolic,diastolic,motor_locs,mmhg_readings,model=None):
+    """ 'compile_table' for a whole list of systolic/diastolic pairs at once; one row of positions per pair, as a 2-D array.
+    """
+    table = np.asarray(table,dtype=np.float64)
+    systolic = np.asarray(systolic,dtype=np.float64)[:,None]
+    diastolic = np.asarray(diastolic,dtype=np.float64)[:,None]
+    tmin = table.min()
+    table_span = table.max() - tmin
+    if (table_span == 0):
+        raise ValueError("Pulse table is flat; can't scale it to a pressure range.")
+    mmhg_vals = (table - tmin) / table_span * (systolic - diastolic) + diastolic
+    if model is None:
+        positions = np.rint(np.interp(mmhg_vals,mmhg_readings,motor_locs)).astype(np.int64)
+    else:
+        positions = model.positions(mmhg_vals)
+    return np.concatenate((positions,positions[:,:1]),axis=1)
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+class PSAppTableCompiler(object):
+    """ Compiles one pulse table against one calibration, for as many systolic/diastolic pairs as needed.  The hashes for the cache are worked out once, up front, so a cache hit costs a dictionary lookup and a copy.
+    """
+    def __init__(self,table,motor_locs,mmhg_readings,model=None):
+        """ Initialization function.  'motor_locs' and 'mmhg_readings' are the calibration ('pressure_table' from PSAppState); they're converted to arrays here, once.  If there's a 'model' ('cal_model' from PSAppState), positions come from that instead.
+        """
+        self.table = np.asarray(table,dtype=np.float64)
+        self.motor_locs = np.asarray(motor_locs,dtype=np.float64)
+        self.mmhg_readings = np.asarray(mmhg_readings,dtype=np.float64)
+        self.model = model
+        self.table_hash = array_hash(self.table)
+        if model is None:
+            self.cal_hash = array_hash(self.motor_locs,self.mmhg_readings)
+        else:
+            self.cal_hash = array_hash(model.x,model.y,[model.resolution])
+        self.hits = 0
+        self.misses = 0
+
+    def positions(self,systolic,diastolic):
+        """ Position table (a list, with the wrap-around point on the end) for this pressure range.
+        """
+        key = (float(systolic),float(diastolic),self.table_hash,self.cal_hash)
+        with _cache_lock:
+            positions = _cache.get(key)
+            if positions is not None:
+                _cache.move_to_end(key)
+        if positions is not None:
+            self.hits += 1
+            return list(positions)
+        self.misses += 1
+        positions = compile_table(self.table,systolic,diastolic,self.motor_locs,self.mmhg_readings,self.model)
+        with _cache_lock:
+            _cache[key] = tuple(positions)
+            while (len(_cache) > CACHE_SIZE):
+                _cache.popitem(last=False)
+        return positions
+
+    def positions_array(self,systolic,diastolic):
+        """ 'positions' for a whole list of pairs, as a 2-D array (one row per pair).  Anything that isn't in the cache is worked out in a single call, and then added to it.
+        """
+        keys = [(float(s),float(d),self.table_hash,self.cal_hash) for (s,d) in zip(systolic,diastolic)]
+        out = np.zeros((len(keys),len(self.table) + 1),dtype=np.int64)
+        missing = list()
+        with _cache_lock:
+            for (i,key) in enumerate(keys):
+                positions = _cache.get(key)
+                if positions is None:
+                    missing.append(i)
+                else:
+                    _cache.move_to_end(key)
+                    out[i] = positions
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            out[missing] = compile_tables(self.table,[keys[i][0] for i in missing],[keys[i][1] for i in missing],self.motor_locs,self.mmhg_readings,self.model)
+            with _cache_lock:
+                for i in missing:
+                    _cache[keys[i]] = tuple(out[i].tolist())
+                while (len(_cache) > CACHE_SIZE):
+                    _cache.popitem(last=False)
+        return out
@@ -0,0 +1,24 @@
+import os, sys
+import numpy as np
+import pytest
+
+# The app runs from 'PSApp' with flat imports (and 'math' on the path); do the same here, whatever
+# directory pytest is started from.  Workers only need a Qt event loop object, not a display.
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE,".."),os.path.join(HERE,"..","math")]
+os.environ.setdefault("QT_QPA_PLATFORM","offscreen")
+
+from PyQt5.QtCore import QCoreApplication
+
+@pytest.fixture(scope="session")
+def qapp():
+    return QCoreApplication.instance() or QCoreApplication(sys.argv)
+
+@pytest.fixture
+def cuff():
+    """ Pressure (mmHg) against motor position for a made-up cuff:  snug at home (1000), then going like the gas law, to about 200mmHg at 2000.
+    """
+    def true_mmhg(pos):
+        x = 60.0 * np.logaddexp(0.0,(np.asarray(pos,dtype=np.float64) - 1000.0) / 60.0)
+        return 760.0 * (4500.0 / (4500.0 - x) - 1.0)
+    return true_mmhg
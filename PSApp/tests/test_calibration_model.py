@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from PSAppCalibrationModel import PSAppCalibrationModel, find_outliers, isotonic_fit
+
+STEPS = np.arange(1000,2001,25)
+
+def noisy(cuff,noise,seed=0):
+    """ A fixed calibration sweep of 'cuff', from home (1000) to 2000 in 25s, with 'noise' (mmHg) on every reading.
+    """
+    return cuff(STEPS) + np.random.default_rng(seed).normal(0.0,noise,len(STEPS))
+
+def test_isotonic_fit():
+    (fit,blocks) = isotonic_fit([1.0,3.0,2.0,4.0,4.0,3.0,5.0])
+    assert np.all(np.diff(fit) >= 0)
+    assert fit.tolist() == [1.0,2.5,2.5,11.0 / 3,11.0 / 3,11.0 / 3,5.0]
+    assert blocks == [(0,1),(1,3),(3,6),(6,7)]
+    # Already in order:  nothing changes, one block per point
+    (fit,blocks) = isotonic_fit([1.0,2.0,3.0])
+    assert fit.tolist() == [1.0,2.0,3.0]
+    assert len(blocks) == 3
+
+def test_isotonic_fit_weighted():
+    (fit,blocks) = isotonic_fit([2.0,1.0],[3.0,1.0])
+    assert fit.tolist() == [1.75,1.75]
+
+def test_find_outliers():
+    y = np.linspace(0.0,100.0,41)
+    y[20] += 30.0
+    assert np.flatnonzero(find_outliers(y)).tolist() == [20]
+    assert not find_outliers(np.linspace(0.0,100.0,41)).any()
+
+def test_model_is_monotone_and_rejects_outliers(cuff):
+    mmhg = noisy(cuff,0.3)
+    mmhg[10] += 40.0
+    model = PSAppCalibrationModel(STEPS,mmhg)
+    assert np.flatnonzero(model.rejected).tolist() == [10]
+    assert np.all(np.diff(model.x) > 0)
+    assert np.all(np.diff(model.y) > 0)
+    assert model.check()
+    grid = np.arange(1000,2001)
+    assert np.max(np.abs(model.to_mmhg(grid) - cuff(grid))) < 3.0
+
+def test_clean_sweep_loses_nothing(cuff):
+    # Not even right past home, where the curve bends hardest
+    model = PSAppCalibrationModel(STEPS,cuff(STEPS))
+    assert not model.rejected.any()
+    grid = np.arange(1000,2001)
+    assert np.max(np.abs(model.to_mmhg(grid) - cuff(grid))) < 0.5
+
+def test_sharp_knee_is_kept():
+    # Slack up to 1300, then straight up; the reading on the corner is as good as any
+    mmhg = 5.0 + np.maximum(0.0,(STEPS - 1300) * 0.2)
+    model = PSAppCalibrationModel(STEPS,mmhg)
+    assert not model.rejected.any()
+    assert model.to_steps(10.0) == pytest.approx(1325.0)
+    assert model.to_steps(15.0) == pytest.approx(1350.0)
+    # A bad reading on the slope is still caught
+    mmhg[20] += 10.0
+    assert np.flatnonzero(find_outliers(mmhg,x=STEPS)).tolist() == [20]
+
+def test_ends_are_kept():
+    y = np.linspace(0.0,100.0,41)
+    y[0] += 30.0
+    y[-1] -= 30.0
+    assert not find_outliers(y).any()
+
+def test_model_inverse_lut(cuff):
+    model = PSAppCalibrationModel(STEPS,noisy(cuff,0.2,seed=1))
+    pressures = np.linspace(model.y[0],model.y[-1],500)
+    # Through the table and back again
+    assert np.max(np.abs(model.to_mmhg(model.to_steps(pressures)) - pressures)) < 0.01
+    # 'positions' is the rounded table, never more than a step from rounding 'to_steps'
+    assert np.max(np.abs(model.positions(pressures) - np.rint(model.to_steps(pressures)))) <= 1
+    assert model.positions(pressures).dtype == np.int64
+    # The ends are held outside the sweep
+    assert model.to_steps(model.y[0] - 50.0) == model.x[0]
+    assert model.to_steps(model.y[-1] + 50.0) == pytest.approx(model.x[-1])
+    assert model.positions(80.0) == model.positions([80.0])[0]
+
+def test_model_needs_a_curve():
+    with pytest.raises(ValueError):
+        PSAppCalibrationModel([1,2,3],[5.0,5.0])
+    with pytest.raises(ValueError):
+        PSAppCalibrationModel([1,2,3],[5.0,4.0,3.0])
+
+def test_outliers_on_uneven_spacing():
+    # Coarse at the ends, filled in where it bends; a straight line is still a straight line
+    x = np.array([0,40,80,90,100,110,120,160,200],dtype=np.float64)
+    assert not find_outliers(2.0 * x,x=x).any()
+    y = 2.0 * x
+    y[4] += 20.0
+    assert np.flatnonzero(find_outliers(y,x=x)).tolist() == [4]
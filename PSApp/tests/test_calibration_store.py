@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from PSAppCalibrationModel import PSAppCalibrationModel
+from PSAppCalibrationStore import PSAppCalibrationStore, drift, spot_check_positions
+
+STEPS = np.arange(1000,2001,25)
+
+def test_store_round_trip(tmp_path,cuff):
+    mmhg = cuff(STEPS) + np.random.default_rng(0).normal(0.0,0.2,len(STEPS))
+    model = PSAppCalibrationModel(STEPS,mmhg)
+    path = str(tmp_path / "cal" / "store.json")
+    store = PSAppCalibrationStore(path)
+    assert store.get("SN1","1.0",1000) is None
+    store.put("SN1","1.0",1000,2000,25,STEPS,mmhg,model.quality)
+    # Nothing gets saved without knowing which device it is
+    store.put(None,"1.0",1000,2000,25,STEPS,mmhg,model.quality)
+    store = PSAppCalibrationStore(path)
+    entry = store.get("SN1","1.0",1000)
+    assert entry["x"] == STEPS.tolist()
+    assert np.allclose(entry["y"],mmhg)
+    assert store.get("SN1","1.0",1000,cal_max=2000) is entry
+    assert store.get("SN1","1.0",1000,cal_max=2500) is None
+    assert store.get("SN1","1.1",1000) is None
+    assert store.get("SN1","1.0",1100) is None
+    assert np.allclose(PSAppCalibrationStore.model(entry).y,model.y)
+    store.remove("SN1","1.0",1000)
+    assert PSAppCalibrationStore(path).get("SN1","1.0",1000) is None
+
+def test_store_ignores_bad_file(tmp_path):
+    path = tmp_path / "store.json"
+    path.write_text("not json")
+    assert PSAppCalibrationStore(str(path)).entries == dict()
+
+def test_spot_check(cuff):
+    model = PSAppCalibrationModel(STEPS,cuff(STEPS))
+    positions = spot_check_positions(model,1000,2000)
+    assert len(positions) == 4
+    assert positions == sorted(positions)
+    assert (positions[0] >= 1000) and (positions[-1] == 2000)
+    readings = cuff(positions)
+    assert drift(model,positions,readings) < 0.5
+    assert drift(model,positions,readings + 5.0) == pytest.approx(5.0,abs=0.5)
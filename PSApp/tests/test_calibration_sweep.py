@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from PSAppCalibrationModel import PSAppCalibrationModel
+from PSAppCalibrationSweep import PSAppCalibrationSweep, settle, sweep_grid
+
+class Cuff(object):
+    """ 'cuff' with the motor in it:  readings come straight from the curve (plus 'noise'), as if every move had settled.
+    """
+    def __init__(self,cuff,noise=0.2,seed=0):
+        self.cuff = cuff
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.pos = 1000
+        self.nmoves = 0
+
+    def read(self):
+        return float(self.cuff(self.pos) + self.rng.normal(0.0,self.noise))
+
+    def move(self,n):
+        self.pos += n
+        self.nmoves += 1
+        return self.read()
+
+    def go_home(self):
+        self.pos = 1000
+        return self.read()
+
+def test_sweep_grid():
+    assert sweep_grid(1000,2000,25).tolist() == list(range(1000,2001,25))
+    # The last stop goes past cal_max rather than short of it
+    assert sweep_grid(1000,1010,25).tolist() == [1000,1025]
+
+def test_adaptive_sweep(cuff):
+    plant = Cuff(cuff)
+    reported = list()
+    s = PSAppCalibrationSweep(1000,2000,25)
+    assert s.run(plant.move,plant.read,plant.go_home,lambda pos,mmhg: reported.append(pos))
+    assert s.steps == sorted(reported)
+    assert (s.steps[0],s.steps[-1]) == (1000,2000)
+    assert set(s.steps) <= set(sweep_grid(1000,2000,25).tolist())
+    # Fewer stops than the fixed sweep, and still close to the curve all the way from home
+    assert len(s.steps) < len(sweep_grid(1000,2000,25))
+    model = PSAppCalibrationModel(s.steps,s.mmhg)
+    assert not model.rejected.any()
+    grid = np.arange(1000,2001)
+    assert np.max(np.abs(model.to_mmhg(grid) - cuff(grid))) < 1.0
+
+def test_sweep_stops_on_failed_read():
+    s = PSAppCalibrationSweep(1000,2000,25)
+    assert not s.run(lambda n: None,lambda: 10.0,lambda: 10.0)
+
+def test_settle():
+    readings = iter([10.0,10.2,10.3])
+    assert settle(12.0,lambda: next(readings)) == (10.2,2)
+    assert settle(None,lambda: 1.0) == (None,0)
+    assert settle(1.0,lambda: None) == (None,1)
@@ -0,0 +1,53 @@
+import pytest
+from PSAppCommInterface import PSAppCommInterface
+from PSAppEmulator import PSAppFirmwareEmulator
+from PSAppProtocol import *
+
+@pytest.fixture
+def link(qapp):
+    """ A comm interface talking to the emulated firmware; yields both.
+    """
+    emulator = PSAppFirmwareEmulator()
+    comm = PSAppCommInterface(emulator)
+    yield (emulator,comm)
+    comm.stop()
+    emulator.close()
+
+def test_version(link):
+    (emulator,comm) = link
+    assert comm.transaction(b'V',True).startswith(b'Version')
+
+def test_block_upload(link):
+    (emulator,comm) = link
+    table = [1100,1200,1300,1200]
+    comm.transaction(b'W')
+    assert comm.transaction(BLOCK_CMD+b'4',True,payload=pack_block_frame(table)) == b'OK: Block length = 4\n'
+    assert comm.transaction(b'E',True) == b'OK: Buffer length = 4\n'
+    comm.transaction(b'T',True)
+    assert emulator.get_playing_table() == table
+
+def test_batch_goes_in_one_frame(link):
+    (emulator,comm) = link
+    assert comm.transaction_batch([b'W',b'H1200',b'B80',b'C2000']) == ['','','','']
+    assert [cmd for (cmd,n) in emulator.log if (cmd == BATCH_CMD)] == [BATCH_CMD]
+
+def test_batch_sends_the_rest_one_by_one(link):
+    (emulator,comm) = link
+    responses = comm.transaction_batch([b'W',b'H1200',[b'V',True],b'C2000'])
+    assert responses[2].startswith(b'Version')
+    assert len(responses) == 4
+
+def test_transactions_come_back_in_order(link):
+    (emulator,comm) = link
+    futures = [comm.transaction_async(b'V',True) for i in range(5)]
+    assert [comm.wait_result(f,5.0)[:7] for f in futures] == [b'Version'] * 5
+
+def test_stats(link):
+    (emulator,comm) = link
+    for i in range(3):
+        comm.transaction(b'V',True)
+    stats = comm.stats()
+    assert stats["V"]["count"] == 3
+    assert stats["All"]["failures"] == 0
+    comm.reset_stats()
+    assert comm.stats()["All"]["count"] == 0
@@ -0,0 +1,71 @@
+import pytest
+from PSAppDataBroker import DROP_NEWEST, DROP_OLDEST, PSAppDataBroker
+from PSAppSampleParser import MALFORMED, PSAppSampleParser, parse_lines
+from PSAppSharedFunctions import convert_mpsi_to_mmhg
+
+GOOD = b'W,1200,40,1933\r\n'
+BAD = [b'W,1200,40\n',b'X,1,2,3\n',b'W,1,,3\n',b'W,1,2,3,4\n',b'W,-1,2,3\n',b'W,1,2,3 \n',b'W,1,2\r,3\n',b'\n',b'W,' + b'1' * 40 + b',2,3\n']
+
+# Parser
+
+@pytest.mark.parametrize("nrepeat",[1,20])
+def test_parse_lines(nrepeat):
+    # Once with few enough lines to go line by line, once with enough for the numpy path; same answer
+    chunk = (GOOD + b''.join(BAD) + b'R,5,6,7\n') * nrepeat
+    samples = parse_lines(chunk)
+    assert len(samples) == (len(BAD) + 2) * nrepeat
+    modes = samples["mode"].tolist()
+    assert modes == ([b'W'] + [MALFORMED] * len(BAD) + [b'R']) * nrepeat
+    assert (samples[0]["pos"],samples[0]["tms"],samples[0]["mpsi"]) == (1200,40,1933)
+    assert samples[0]["mmhg"] == pytest.approx(convert_mpsi_to_mmhg(1933))
+    assert (samples[-1]["pos"],samples[-1]["tms"],samples[-1]["mpsi"]) == (5,6,7)
+
+def test_parser_carries_partial_lines():
+    parser = PSAppSampleParser()
+    assert len(parser.feed(GOOD[:5])) == 0
+    samples = parser.feed(GOOD[5:] + GOOD[:3])
+    assert samples["pos"].tolist() == [1200]
+    assert parser.feed(GOOD[3:])["pos"].tolist() == [1200]
+    assert parser.get_malformed() == 0
+
+def test_parser_throws_away_endless_line():
+    parser = PSAppSampleParser(bufsize=64)
+    samples = parser.feed(b'1' * 100 + b'\n' + GOOD)
+    assert samples["mode"].tolist()[-1] == b'W'
+    assert parser.get_malformed() >= 1
+
+# Broker
+
+def test_broker_filters_by_mode():
+    broker = PSAppDataBroker()
+    waveform = broker.subscribe(b'W')
+    everything = broker.subscribe()
+    broker.publish_bytes(GOOD + b'R,5,6,7\n' + BAD[0])
+    assert waveform.get_batch(0)["mode"].tolist() == [b'W']
+    assert everything.get_batch(0)["mode"].tolist() == [b'W',b'R',MALFORMED]
+    assert broker.nmalformed == 1
+
+def test_subscription_get_one_at_a_time():
+    broker = PSAppDataBroker()
+    sub = broker.subscribe()
+    broker.publish_bytes(GOOD + b'R,5,6,7\n')
+    assert sub.get(0).mode == b'W'
+    assert sub.get(0).pos == 5
+    assert sub.get(0) is None
+
+@pytest.mark.parametrize("policy,kept",[(DROP_OLDEST,[2,3,4]),(DROP_NEWEST,[0,1,2])])
+def test_subscription_drop_policy(policy,kept):
+    broker = PSAppDataBroker()
+    sub = broker.subscribe(maxlen=3,policy=policy)
+    broker.publish_bytes(b''.join([b'W,%d,0,0\n' % i for i in range(5)]))
+    assert sub.get_depth() == 3
+    assert sub.get_dropped() == 2
+    assert sub.drain()["pos"].tolist() == kept
+
+def test_unsubscribe_closes():
+    broker = PSAppDataBroker()
+    sub = broker.subscribe()
+    broker.unsubscribe(sub)
+    broker.publish_bytes(GOOD)
+    # Closed, so no waiting around for samples that will never come
+    assert len(sub.get_batch(None)) == 0
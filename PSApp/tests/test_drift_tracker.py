@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from PSAppCalibrationModel import PSAppCalibrationModel
+from PSAppDriftTracker import PSAppDriftTracker
+
+def playback(tracker,cuff,offset,n,seed=0):
+    """ 'n' waveform samples at random positions, 'offset' (mmHg) off from 'cuff'.
+    """
+    rng = np.random.default_rng(seed)
+    pos = rng.integers(1100,1900,n)
+    tracker.update(pos,cuff(pos) + offset + rng.normal(0.0,0.2,n))
+
+@pytest.fixture
+def tracker(cuff):
+    steps = np.arange(1000,2001,25)
+    return PSAppDriftTracker(PSAppCalibrationModel(steps,cuff(steps)),1100,1900)
+
+def test_no_drift(tracker,cuff):
+    playback(tracker,cuff,0.0,3000)
+    assert tracker.drift() < 0.5
+    assert not tracker.check()
+
+def test_drift_after_warmup(tracker,cuff):
+    # A steady offset during warm up is where drift is measured from, not drift itself
+    playback(tracker,cuff,1.0,1000)
+    assert tracker.drift() < 0.5
+    assert not tracker.check()
+    playback(tracker,cuff,7.0,3000,seed=1)
+    assert tracker.drift() == pytest.approx(6.0,abs=1.0)
+    assert tracker.check()
+    # Only the first time
+    assert not tracker.check()
+    assert np.allclose(tracker.correction([1200,1800]),6.0,atol=1.0)
+    # Taking the correction on board starts over from there
+    tracker.rebase(tracker.corrected_model())
+    assert not tracker.check()
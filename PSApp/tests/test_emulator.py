@@ -0,0 +1,60 @@
+import pytest
+from PSAppEmulator import WF_IDLE, WF_LOAD, WF_PLAY_PT, WF_PLAY_WF, PSAppFirmwareEmulator
+from PSAppProtocol import BLOCK_CMD, PATCH_CMD, batch_body, pack_batch_frame, pack_block_frame, pack_patch_frame, patch_words
+
+def raw(emulator,cmd,payload):
+    """ One framed command, written straight to the emulator a step at a time; returns the echo and the response.
+    """
+    emulator.write(cmd + b'\n')
+    echo = emulator.readline()
+    emulator.write(b'\n' + payload)
+    return (echo,emulator.readline())
+
+@pytest.fixture
+def emulator():
+    e = PSAppFirmwareEmulator(speed=None)
+    e.timeout = 0.1
+    yield e
+    e.close()
+
+def test_block_frame(emulator):
+    (echo,response) = raw(emulator,b'K3',pack_block_frame([1100,1200,1300]))
+    assert echo == b'K3\n'
+    assert response == b'OK: Block length = 3\n'
+    assert emulator.log[-1] == (BLOCK_CMD,3)
+
+def test_block_frame_bad_crc(emulator):
+    frame = bytearray(pack_block_frame([1100,1200,1300]))
+    frame[-1] ^= 0xFF
+    (echo,response) = raw(emulator,b'K3',bytes(frame))
+    assert response == b'ERR: Block CRC mismatch\n'
+    # Nothing left over to confuse the next command
+    emulator.write(b'V\n')
+    assert emulator.readline() == b'V\n'
+
+def test_batch_frame(emulator):
+    cmds = [b'H1200',b'B80',b'C2000']
+    (echo,response) = raw(emulator,b'P%d' % len(batch_body(cmds)),pack_batch_frame(cmds))
+    assert response == b'OK: Batch length = 3\n'
+
+def test_batch_frame_stops_at_unbatchable(emulator):
+    cmds = [b'H1200',b'V',b'C2000']
+    (echo,response) = raw(emulator,b'P%d' % len(batch_body(cmds)),pack_batch_frame(cmds))
+    assert response == b'ERR: Batch stopped at = 1\n'
+
+@pytest.mark.parametrize('state',[WF_PLAY_PT,WF_PLAY_WF])
+def test_patch_frame_while_playing(emulator,state):
+    # Either playback state will do, same as 'wf_calc.xc'
+    emulator.wf_pts[emulator.pb_i] = [1100,1200,1300,1400]
+    emulator.wf_state = state
+    runs = [(1,[1250,1350])]
+    (echo,response) = raw(emulator,PATCH_CMD + b'%d' % len(patch_words(runs)),pack_patch_frame(runs))
+    assert response == b'OK: Patch length = 2\n'
+    assert emulator.wf_state == WF_LOAD
+    assert emulator.wf_pts[emulator.load_i] == [1100,1250,1350,1400]
+
+def test_patch_frame_needs_playback(emulator):
+    assert emulator.wf_state == WF_IDLE
+    runs = [(1,[1250,1350])]
+    (echo,response) = raw(emulator,PATCH_CMD + b'%d' % len(patch_words(runs)),pack_patch_frame(runs))
+    assert response == b'ERR: Patch needs playback\n'
@@ -0,0 +1,196 @@
+import pytest
+from time import monotonic
+from PSAppCommStats import new_tally
+from PSAppProtocol import *
+from PSAppSharedFunctions import PSCommException
+
+BUSY = b'ERR: Busy.\n'
+
+def drive(steps,lines):
+    """ Run a handshake generator against a scripted firmware:  every read takes the next of 'lines' (b'' once they run out).  Returns what came back, everything written, and how many reads were asked for.
+    """
+    lines = list(lines)
+    writes = list()
+    nreads = 0
+    line = None
+    try:
+        while True:
+            out = steps.send(line)
+            line = None
+            if isinstance(out,HandshakeRead):
+                nreads += 1
+                line = lines.pop(0) if lines else b''
+            elif not isinstance(out,HandshakeWait):
+                writes.append(out)
+    except StopIteration as e:
+        return (e.value,writes,nreads)
+# Frames
+
+def test_crc16_ccitt_check_value():
+    # CRC-16/CCITT-FALSE of "123456789"; the firmware's 'crc16_update' has to come to the same thing
+    assert crc16_ccitt(b'123456789') == 0x29B1
+
+def test_block_frame_round_trip():
+    values = [1,-1,32767,-32768,0,1234]
+    frame = pack_block_frame(values)
+    assert len(frame) == block_frame_length(len(values))
+    assert unpack_block_frame(frame) == values
+
+def test_block_frame_errors():
+    frame = bytearray(pack_block_frame([10,20,30]))
+    with pytest.raises(PSCommException,match="length"):
+        unpack_block_frame(bytes(frame[:-1]))
+    frame[3] ^= 0x01
+    with pytest.raises(PSCommException,match="CRC"):
+        unpack_block_frame(bytes(frame))
+    with pytest.raises(PSCommException):
+        pack_block_frame([1] * (MAX_BLOCK_LENGTH + 1))
+
+def test_batch_frame_round_trip():
+    cmds = [b'W',b'H1966',b'B218',b'C2000']
+    frame = pack_batch_frame(cmds)
+    assert len(frame) == batch_frame_length(len(batch_body(cmds)))
+    assert unpack_batch_frame(frame) == cmds
+    assert [batch_param(c) for c in cmds] == [0,1966,218,2000]
+    assert batch_param(b'Y-12') == -12
+
+def test_patch_frame_round_trip():
+    runs = [(0,[5,6]),(100,[7]),(255,[8,9,10])]
+    frame = pack_patch_frame(runs)
+    assert len(frame) == block_frame_length(len(patch_words(runs)))
+    assert unpack_patch_frame(frame) == runs
+    with pytest.raises(PSCommException,match="malformed"):
+        unpack_patch_frame(pack_block_frame([0,2,5,0]))
+
+def test_diff_runs():
+    old = list(range(20))
+    new = list(old)
+    new[3] = 100
+    new[5] = 101
+    new[15] = 102
+    # 3 and 5 are close enough to go as one run
+    assert diff_runs(old,new) == [(3,[100,4,101]),(15,[102])]
+    assert diff_runs(old,old) == []
+
+# Handshake
+
+def test_handshake_echo_and_response():
+    tally = new_tally()
+    (ret,writes,nreads) = drive(handshake(b'V',True,tally=tally),[b'V\n',b'Version: 1\n'])
+    assert ret == b'Version: 1\n'
+    assert writes == [b'V\n',b'\n']
+    assert (tally["sends"],tally["busy"],tally["mismatches"]) == (1,0,0)
+
+def test_handshake_payload_follows_go_ahead():
+    (ret,writes,nreads) = drive(handshake(b'K2',True,payload=b'frame'),[b'K2\n',b'OK: Block length = 2\n'])
+    assert writes == [b'K2\n',b'\n',b'frame']
+    assert ret == b'OK: Block length = 2\n'
+
+def test_handshake_busy_then_retry():
+    tally = new_tally()
+    # Both bytes of 'V\n' are answered as busy; the next try goes through
+    (ret,writes,nreads) = drive(handshake(b'V',True,tally=tally),[BUSY,BUSY,b'V\n',b'Version: 1\n'])
+    assert ret == b'Version: 1\n'
+    assert writes == [b'V\n',b'V\n',b'\n']
+    assert tally["busy"] == 1
+
+def test_handshake_keeps_line_after_busy():
+    tally = new_tally()
+    # The firmware stops being busy partway through the send; the echo turns up among the busy
+    # responses, and has to be taken as the echo rather than thrown away
+    (ret,writes,nreads) = drive(handshake(b'VX',True,tally=tally),[BUSY,b'VX\n',b'Version: 1\n'])
+    assert ret == b'Version: 1\n'
+    assert writes == [b'VX\n',b'\n']
+    assert (tally["sends"],tally["busy"],tally["mismatches"]) == (1,1,0)
+
+def test_handshake_stray_line_after_busy():
+    tally = new_tally()
+    (ret,writes,nreads) = drive(handshake(b'V',True,tally=tally),[BUSY,b'OK: Data ready\n',b'V\n',b'Version: 1\n'])
+    assert ret == b'Version: 1\n'
+    assert writes == [b'V\n',b'\n']
+    assert tally["mismatches"] == 1
+
+def test_handshake_stray_line_before_echo():
+    tally = new_tally()
+    (ret,writes,nreads) = drive(handshake(b'V',True,tally=tally),[b'OK: Data ready\n',b'V\n',b'Version: 1\n'])
+    assert ret == b'Version: 1\n'
+    assert writes == [b'V\n',b'\n']
+    assert (tally["sends"],tally["mismatches"]) == (1,1)
+
+def test_handshake_mismatch_cancels_and_resends():
+    tally = new_tally()
+    (ret,writes,nreads) = drive(handshake(b'V',True,tally=tally),[b'W\n',b'',b'V\n',b'Version: 1\n'])
+    assert ret == b'Version: 1\n'
+    assert writes == [b'V\n',b'!',b'V\n',b'\n']
+    assert (tally["sends"],tally["mismatches"]) == (2,1)
+
+def test_handshake_partial_line():
+    tally = new_tally()
+    # A read that runs out partway through a line hands back the start of it; that's not a mismatch
+    (ret,writes,nreads) = drive(handshake(b'H100',True,tally=tally),[b'H1',b'00\n',b'OK',b'\n'])
+    assert ret == b'OK\n'
+    assert writes == [b'H100\n',b'\n']
+    assert tally["mismatches"] == 0
+
+def test_handshake_no_echo_fails():
+    tally = new_tally()
+    with pytest.raises(PSCommException,match="handshake failed"):
+        drive(handshake(b'V',True,tally=tally,timeout=0.1),[])
+    assert tally["handshake_failures"] == 1
+    assert tally["sends"] >= 2
+
+def test_handshake_no_response_fails():
+    tally = new_tally()
+    with pytest.raises(PSCommException,match="never returned"):
+        drive(handshake(b'V',True,tally=tally),[b'V\n'])
+    assert tally["response_failures"] == 1
+
+def test_handshake_expired_deadline_sends_nothing():
+    tally = new_tally()
+    with pytest.raises(PSCommException):
+        drive(handshake(b'V',deadline=monotonic() - 1.0,tally=tally),[b'V\n'])
+    assert tally["sends"] == 0
+
+def test_handshake_busy_retries_until_deadline():
+    tally = new_tally()
+    lines = [BUSY,BUSY] * 20 + [b'V\n']
+    (ret,writes,nreads) = drive(handshake(b'V',tally=tally,deadline=monotonic() + 10.0),lines)
+    # Without a deadline, ten busy responses would have been the end of it
+    assert tally["busy"] == 20
+    assert writes[-1] == b'\n'
+
+def test_handshake_busy_retries_capped():
+    tally = new_tally()
+    # Firmware that's still busy after MAX_BUSY_RETRIES is stuck, not moving; give up well before the deadline
+    lines = [BUSY,BUSY] * (MAX_BUSY_RETRIES + 10) + [b'V\n']
+    with pytest.raises(PSCommException,match="handshake failed"):
+        drive(handshake(b'V',tally=tally,deadline=monotonic() + 10.0),lines)
+    assert tally["busy"] == MAX_BUSY_RETRIES
+    assert tally["handshake_failures"] == 1
+
+def test_handshake_feeds_estimator():
+    estimator = PSAppTimeoutEstimator()
+    drive(handshake(b'V',True,estimator=estimator),[b'V\n',b'Version: 1\n'])
+    estimates = estimator.get_estimates()
+    assert estimates[(ECHO,"V")]["samples"] == 1
+    assert estimates[(ECHO,None)]["samples"] == 1
+    assert estimates[(RESPONSE,"V")]["samples"] == 1
+
+# Timeouts
+
+def test_estimator_timeouts():
+    estimator = PSAppTimeoutEstimator()
+    assert estimator.timeout(ECHO,b'V',0.5) == 0.5
+    for i in range(20):
+        estimator.sample(ECHO,b'V',0.001)
+    # Never below the floor, never above the ceiling
+    assert estimator.timeout(ECHO,b'V',0.5) == MIN_TIMEOUT
+    assert estimator.timeout(ECHO,b'V',MIN_TIMEOUT / 2) == MIN_TIMEOUT / 2
+    # An echo that hasn't been seen goes by all the others; a response doesn't
+    assert estimator.timeout(ECHO,b'Z',0.5) == MIN_TIMEOUT
+    assert estimator.timeout(RESPONSE,b'Z',0.5) == 0.5
+    for i in range(20):
+        estimator.sample(RESPONSE,b'Z',1.0)
+    assert 1.0 <= estimator.timeout(RESPONSE,b'Z',5.0) < 5.0
+    estimator.reset()
+    assert estimator.get_estimates() == dict()
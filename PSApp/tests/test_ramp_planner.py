@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from PSAppRampPlanner import RAMP_PARAMS, PSAppRampPlan, PSAppRampProducer, plan_ramp
+
+def params(*values):
+    return dict(zip(RAMP_PARAMS,values))
+
+def test_plan_ramp():
+    plan = plan_ramp(params(120,80,60,12),params(110,80,64,12))
+    assert len(plan) == 10
+    assert plan[-1].tolist() == [110,80,64,12]
+    # One unit at a time at most, and never past the goal
+    assert np.all(np.abs(np.diff(plan,axis=0)) <= 1)
+    assert np.all(plan[:,2] <= 64)
+    # Nowhere to go is still one step
+    assert plan_ramp(params(120,80,60,12),params(120,80,60,12)).tolist() == [[120,80,60,12]]
+
+def test_plan_skips_steps_to_fit_budget():
+    plan = PSAppRampPlan(plan_ramp(params(140,80,60,12),params(100,80,60,12)),None,budget=0.0)
+    assert plan.next_step(-1) == 0
+    plan.record_step(1.0)
+    # No time left at all; straight to the last step
+    assert plan.next_step(0) == len(plan) - 1
+    assert plan.next_step(len(plan) - 1) is None
+
+def test_ramp_producer_in_order():
+    plan = PSAppRampPlan(plan_ramp(params(120,80,60,12),params(115,80,60,12)),None)
+    producer = PSAppRampProducer(plan,lambda i: i * 10)
+    producer.start()
+    items = list(iter(producer.get,None))
+    assert items == [(i,i * 10) for i in range(5)]
+
+def test_ramp_producer_passes_on_exceptions():
+    def prepare(i):
+        if (i == 2):
+            raise ValueError("bad step")
+        return i
+    plan = PSAppRampPlan(plan_ramp(params(120,80,60,12),params(115,80,60,12)),None)
+    producer = PSAppRampProducer(plan,prepare)
+    producer.start()
+    assert producer.get() == (0,0)
+    assert producer.get() == (1,1)
+    with pytest.raises(ValueError,match="bad step"):
+        producer.get()
+    producer.join(1.0)
+    assert not producer.is_alive()
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from PSAppTableCompiler import PSAppTableCompiler, clear_cache, compile_table
+
+PULSE = np.sin(np.linspace(0.0,2 * np.pi,50,endpoint=False))
+
+@pytest.fixture
+def calibration(cuff):
+    steps = np.arange(1000,2001,25)
+    return (steps,cuff(steps))
+
+def test_compiler_matches_point_by_point(calibration):
+    (steps,mmhg) = calibration
+    positions = compile_table(PULSE,120,80,steps,mmhg)
+    assert len(positions) == len(PULSE) + 1
+    assert positions[0] == positions[-1]
+    by_point = [int(np.rint(np.interp((v - PULSE.min()) / np.ptp(PULSE) * 40 + 80,mmhg,steps))) for v in PULSE]
+    assert positions[:-1] == by_point
+
+def test_compiler_cache(calibration):
+    clear_cache()
+    (steps,mmhg) = calibration
+    compiler = PSAppTableCompiler(PULSE,steps,mmhg)
+    first = compiler.positions(120,80)
+    assert compiler.positions(120,80) == first
+    assert (compiler.hits,compiler.misses) == (1,1)
+    # A different calibration doesn't pick up the cached tables
+    other = PSAppTableCompiler(PULSE,steps,mmhg + 1.0)
+    other.positions(120,80)
+    assert other.misses == 1
+    with pytest.raises(ValueError):
+        compile_table(np.ones(10),120,80,steps,mmhg)
+
+def test_compiler_many_pairs_at_once(calibration):
+    clear_cache()
+    (steps,mmhg) = calibration
+    compiler = PSAppTableCompiler(PULSE,steps,mmhg)
+    first = compiler.positions(120,80)
+    rows = compiler.positions_array([120,130],[80,85])
+    assert rows[0].tolist() == first
+    assert rows[1].tolist() == compile_table(PULSE,130,85,steps,mmhg)
+    assert (compiler.hits,compiler.misses) == (1,2)
+    assert compiler.positions(130,85) == rows[1].tolist()
@@ -6,6 +6,8 @@ import math
 import sys
 import struct
 import pickle
+from waveform_io import load_float_waveform
+from waveform_compiler import decimate, slew_stats, TICK
 
 play=True
 psi=False
@@ -19,10 +21,7 @@ plt.ion()
 pressure=Pressure()
 lsteps=500
 hsteps=2650
-(steps0,psi0,mmHg0)=pressure.calibrate_curve(lsteps, hsteps, 25)
-steps=np.array(steps0)
-psis=np.array(psi0)
-mmHgs=np.array(mmHg0)
+cal=pressure.cached_calibration_model(lsteps, hsteps, 25)
 
 atmospheric=14.0
 
@@ -30,35 +29,17 @@ runs=1;
 
 
 #f=open("ideal.bin", "rb")
-f=open("integrated80_120.bin", "rb")
-#f=open("integrated90_140.bin", "rb")
-#f=open("integrated50_100.bin", "rb")
-s=f.read()
-l=len(s)/4
-f.close()
-v0=struct.unpack("%df" % l, s)
+v0=load_float_waveform("integrated80_120.bin").astype(np.float64)
+#v0=load_float_waveform("integrated90_140.bin").astype(np.float64)
+#v0=load_float_waveform("integrated50_100.bin").astype(np.float64)
 print(v0)
 
-ys=[]
-ys0=[]
-i=0
-t=0;
-dt=20e-3
-ts=[]
+# one motor position every 10 samples (20ms), filtered so nothing aliases
+ys0=cal.positions(decimate(v0, 10))
+ys=np.tile(ys0, runs).tolist()
+ts=(np.arange(len(ys0))*TICK).tolist()
 ps=[]
 mms=[]
-while(i <(len(v0))):
-    x=v0[i]
-    s=round(np.interp(x, mmHgs, steps))
-    #print(s)
-    i=i+10
-    ts.append(t)
-    t=t+dt
-    ys0.append(s)
-
-for i in range(runs):
-    for y in ys0:
-        ys.append(y)
 print(len(ys))
 
 
@@ -66,13 +47,8 @@ print(len(ys))
 #sys.exit(0)
 
 
-maxstep=0
-for i in range(len(ys)-1):
-    ds=abs(ys[i+1]-ys[i])
-    if(abs(ds)>maxstep):
-        maxstep=abs(ds)
-
-print("Maxstep = %d, length = %d" % (maxstep, len(ys)))
+stats=slew_stats(ys)
+print("Maxstep = %d, length = %d" % (stats["maxstep"], stats["length"]))
     
     
 
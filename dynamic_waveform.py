@@ -9,6 +9,8 @@ import sys
 import struct
 import pickle
 import keyboard
+from waveform_io import load_text
+from waveform_compiler import decimate, slew_stats
 
 play=True
 psi=False
@@ -26,10 +28,7 @@ plt.ion()
 pressure=Pressure()
 lsteps=50
 hsteps=1500
-(steps0,psi0,mmHg0)=pressure.calibrate_curve(lsteps, hsteps, 25)
-steps=np.array(steps0)
-psis=np.array(psi0)
-mmHgs=np.array(mmHg0)
+cal=pressure.cached_calibration_model(lsteps, hsteps, 25)
 
 atmospheric=14.5
 
@@ -48,55 +47,20 @@ atmospheric=14.5
 #v0=struct.unpack("%df" % l, s)
 #print(v0)
 
-f=open('TestPulses.dat', 'rb')
-a=f.readlines()
-f.close()
-values=[]
-for l in a:
-    x=float(l)
-    values.append(x)
+values=load_text('TestPulses.dat')
 
 v=values[:-20]
-minb=50000
-maxb=-50000
-for b in v:
-    if(b>maxb):
-        maxb=b
-    if(b<minb):
-        minb=b
+minb=float(v.min())
+maxb=float(v.max())
 print(minb, maxb)
 span=maxb-minb
 
 runs=1
-v0=[]
-for i in range(runs):
-    for b in v:
-        x=(b-minb)/span*(systolic-diastolic)+diastolic
-        v0.append(x)
-
-
+v0=np.tile((v-minb)/span*(systolic-diastolic)+diastolic, runs)
 
-
-ys=[]
-ys0=[]
-i=0
-t=0;
-dt=20e-3
-ts=[]
-ps=[]
-mms=[]
-while(i <(len(v0))):
-    x=v0[i]
-    s=round(np.interp(x, mmHgs, steps))
-    #print(s)
-    i=i+25
-    ts.append(t)
-    t=t+dt
-    ys0.append(s)
-
-for i in range(runs):
-    for y in ys0:
-        ys.append(y)
+# one motor position every 25 samples (20ms), filtered so nothing aliases
+ys0=cal.positions(decimate(v0, 25))
+ys=np.tile(ys0, runs).tolist()
 print(len(ys))
 
 
@@ -104,13 +68,8 @@ print(len(ys))
 #sys.exit(0)
 
 
-maxstep=0
-for i in range(len(ys)-1):
-    ds=abs(ys[i+1]-ys[i])
-    if(abs(ds)>maxstep):
-        maxstep=abs(ds)
-
-print("Maxstep = %d, length = %d" % (maxstep, len(ys)))
+stats=slew_stats(ys)
+print("Maxstep = %d, length = %d" % (stats["maxstep"], stats["length"]))
     
     
 fig, ax=plt.subplots()
@@ -152,9 +111,9 @@ p=[]
 pressure.start_reading()
 i=0
 mean=pressure.meansteps
-meanMMHg=np.interp(mean, steps, mmHgs) # MMHg at the mean steps
-stepsUp=np.interp(meanMMHg+0.5, mmHgs, steps)
-stepsDown=np.interp(meanMMHg-0.5, mmHgs, steps)
+meanMMHg=cal.to_mmhg(mean) # MMHg at the mean steps
+stepsUp=cal.to_steps(meanMMHg+0.5)
+stepsDown=cal.to_steps(meanMMHg-0.5)
 slope=stepsUp-stepsDown # steps to change by 1 mmHg
 
 sei=0 # span error integral
@@ -1,6 +1,16 @@
 import serial
 import time
 import random
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PSApp', 'math'))
+from PSAppCalibrationModel import PSAppCalibrationModel
+from PSAppCalibrationSweep import PSAppCalibrationSweep, settle
+from PSAppCalibrationStore import PSAppCalibrationStore, SPOT_CHECK_TOLERANCE, drift, spot_check_positions
+from serial.tools.list_ports import comports
+
+# Where cached_calibration_model keeps calibrations between runs
+CALIBRATION_STORE=os.path.join(os.path.expanduser("~"), ".psapp_calibrations.json")
 
 class Pressure:
     def __init__(self):
@@ -68,6 +78,68 @@ class Pressure:
             #print(pos)
         return (s, p, mmHg)
 
+    # Calibrate curve as a PSAppCalibrationModel: bad readings dropped, a curve that only goes up, and
+    # quick conversions both ways (to_mmhg, to_steps, positions)
+    def calibration_model(self, low, high, inc, pause=0.01):
+        (s, p, mmHg)=self.do_calibrate_curve(low, high, inc, pause)
+        return PSAppCalibrationModel(s, mmHg)
+
+    # Same thing, but a coarse pass first and then only the increments where the curve bends (see
+    # PSAppCalibrationSweep), reading each one again until the pressure stops changing instead of pausing
+    def adaptive_calibration_model(self, low, high, inc):
+        def read():
+            return self.quick_read()[1]
+        def move(n):
+            self.inc(n)
+            return read()
+        def go_home():
+            self.home(low)
+            return read()
+        self.home(low)
+        sweep=PSAppCalibrationSweep(low, high, inc)
+        sweep.run(move, read, go_home, lambda pos, mm: print("Pressure @ %d steps = %f mmHg" % (pos, mm)))
+        print("%d points, %d moves, %d reads" % (len(sweep.steps), sweep.nmoves, sweep.nreads))
+        return PSAppCalibrationModel(sweep.steps, sweep.mmhg)
+
+    # USB serial number of the port we're on, or None if it doesn't have one
+    def serial_number(self):
+        for lpi in comports():
+            if(lpi.device==self.ser.port):
+                return lpi.serial_number
+        return None
+
+    # Calibration saved from an earlier run (see PSAppCalibrationStore), if there is one for this device
+    # and 'low', and it still holds up at a few points; otherwise a new adaptive calibration, which gets
+    # saved for next time.  The scripts' firmware doesn't report a version, so 'firmware' is whatever
+    # the caller says it is.
+    def cached_calibration_model(self, low, high, inc, firmware="finger", path=CALIBRATION_STORE):
+        store=PSAppCalibrationStore(path)
+        serial=self.serial_number()
+        entry=store.get(serial, firmware, low, high)
+        if(entry):
+            print("Checking calibration from %s" % PSAppCalibrationStore.describe(entry))
+            cal=PSAppCalibrationStore.model(entry)
+            read=lambda: self.quick_read()[1]
+            self.home(low)
+            pos=low
+            s=[]
+            mmHg=[]
+            for p in spot_check_positions(cal, low, high):
+                if(p!=pos):
+                    self.inc(p-pos)
+                    pos=p
+                s.append(p)
+                mmHg.append(settle(read(), read)[0])
+            off=drift(cal, s, mmHg)
+            if(off<=SPOT_CHECK_TOLERANCE):
+                print("Calibration still good (within %f mmHg)" % off)
+                self.home(low)
+                return cal
+            print("Calibration is off by %f mmHg; calibrating again" % off)
+        cal=self.adaptive_calibration_model(low, high, inc)
+        store.put(serial, firmware, low, high, inc, cal.raw_steps, cal.raw_mmhg, cal.quality)
+        return cal
+
     def start_calibrate_curve(self, low, inc):
         self.calib_s=[]
         self.calib_p=[]
@@ -6,6 +6,8 @@ import math
 import sys
 import struct
 import pickle
+from waveform_io import load_float_waveform
+from waveform_compiler import decimate, slew_stats, TICK
 
 play=True
 psi=False
@@ -41,73 +43,26 @@ def psi_to_steps(psi):
     return s
 
 #f=open("ideal.bin", "rb")
-f=open("integrated.bin", "rb")
-s=f.read()
-l=len(s)/4
-f.close()
-v0=struct.unpack("%df" % l, s)
+v0=load_float_waveform("integrated.bin").astype(np.float64)
 print(v0)
 
-ys=[]
-ys0=[]
-i=0
-t=0;
-dt=20e-3
-ts=[]
-ps=[]
-mms=[]
-mins=10000
-maxs=-10000
-maxp=-10000
-minp=10000
-maxbp=-10000
-minbp=10000
-while(i <(len(v0))):
-    x=v0[i]
-    mms.append(x)
-    if(x>maxbp):
-        maxbp=x
-    if(x<minbp):
-        minbp=x
-
-    psi0=pressure.mmHg2psi(x)
-    ps.append(psi0)
-    if(psi0>maxp):
-        maxp=psi0
-    if(psi0<minp):
-        minp=psi0
-        
-    s=int(psi_to_steps(psi0))
-
-    if(s>maxs):
-        maxs=s
-    if(s<mins):
-        mins=s
-    #print(s)
-    i=i+10
-    ts.append(t)
-    t=t+dt
-    ys0.append(s)
-
-for i in range(runs):
-    for y in ys0:
-        ys.append(y)
+# one motor position every 10 samples (20ms), filtered so nothing aliases
+mms=decimate(v0, 10)
+ps=pressure.mmHg2psi(mms)
+ys0=psi_to_steps(ps).astype(np.int64) # truncated, like int()
+ys=np.tile(ys0, runs).tolist()
+ts=(np.arange(len(ys0))*TICK).tolist()
 print(len(ys))
-print("Min/max steps = ",mins,maxs)
-print("Min/max psi = ",minp,maxp)
-print("Min/max mmHg = ",minbp,maxbp)
+print("Min/max steps = ",ys0.min(),ys0.max())
+print("Min/max psi = ",ps.min(),ps.max())
+print("Min/max mmHg = ",mms.min(),mms.max())
 
 #print(v)
 #sys.exit(0)
 
 
-maxstep=0
-for i in range(len(ys)-1):
-    ds=abs(ys[i+1]-ys[i])
-    if(abs(ds)>maxstep):
-        maxstep=abs(ds)
-
-print("Maxstep = %d, length = %d" % (maxstep, len(ys)))
+stats=slew_stats(ys)
+print("Maxstep = %d, length = %d" % (stats["maxstep"], stats["length"]))
     
     
 
@@ -7,6 +7,8 @@ import sys
 import struct
 import pickle
 import re
+from waveform_io import load_text, load_pulse_table
+from waveform_compiler import resample_rate, compile_steps
 
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
@@ -22,6 +24,7 @@ from kivy.clock import Clock
 USE_PULSE_TABLE=True
 SAVE_FILE=False
 SAVEFILE_NAME="data.dat"
+RESAMPLE_ANTIALIAS=False # low-pass before speeding a recording up; see waveform_compiler.resample
 
 default_bgnd=[0.7,0.7,0.7,1]
 
@@ -162,24 +165,12 @@ class UIApp(App):
 
     def read_pulse_table(self):
         print("Reading pulse table\n")
-        f=open('pulse256.dat', 'rb')
-        a=f.read()
-        f.close()
-        self.pulse256=struct.unpack("256h", a)
+        self.pulse256=load_pulse_table('pulse256.dat')
         print(self.pulse256)        
 
     def resample_HR(self, values, heartrate):
-        out=[]
-        ratio=heartrate/self.baselineHR
-        index=range(len(values))
-        index0=[]
-        x=0
-        while(x<(len(values)-1)):
-            index0.append(x)
-            v=np.interp(x, index, values)
-            out.append(v)
-            x=x+ratio # advance more slowly in time
-        return out
+        # cached per waveform and heart rate, so replaying at the same rate costs nothing
+        return resample_rate(values, self.baselineHR, heartrate, RESAMPLE_ANTIALIAS)
 
     def default_graph_waveform(self):
         self.graph = Graph(xlabel='t (s) or steps', ylabel='BP (mmHg)', x_ticks_minor=5,
@@ -268,7 +259,7 @@ class UIApp(App):
                 break
             else:
                 s, t, pos = R
-                p0=np.interp(pos, self.steps, self.mmHgs)
+                p0=self.cal.to_mmhg(pos)
                 
                 p1=self.pressure.psi2mmHg(int(s)*self.pressure.pressure_multiplier)
                 t1=float(t)*self.pressure.temp_multiplier
@@ -297,10 +288,7 @@ class UIApp(App):
         cd=float(self.textinputCalibDelay.text)
         print("play calibrate %d,%d, %d" % (h,cm,ci))
         print("Sys %f Dia %f" % (systolic, diastolic))
-        (steps0, psi0, mmHg0)=self.pressure.calibrate_curve(h, cm, ci)
-        self.steps=np.array(steps0)
-        self.psis=np.array(psi0)
-        self.mmHgs=np.array(mmHg0)
+        self.cal=self.pressure.calibration_model(h, cm, ci)
         # Now branch on whether using pulse_table (single pulse with cyclic indexing),
         # OR - whole waveform repeated. 
         if(USE_PULSE_TABLE):
@@ -316,13 +304,7 @@ class UIApp(App):
                 x=(float(b)-minb)/span*(systolic-diastolic)+diastolic
                 v0.append(x)
             # and now calibrate to the right number of steps
-            ys0=[]
-            i=0
-            while(i <(len(v0))):
-                x=v0[i]
-                s=round(np.interp(x, self.mmHgs, self.steps))
-                ys0.append(s)
-                i=i+1
+            ys0=self.cal.positions(v0).tolist()
             ys0.append(ys0[0]) # append the first value at the end for wrap-around
             print(ys0)
             self.pressure.write_table(ys0)
@@ -336,13 +318,7 @@ class UIApp(App):
 
         else: # single recorded waveform sequence, possibly repeated
             print("PLAYING WAVEFORM")
-            f=open('TestPulses.dat', 'rb')
-            a=f.readlines()
-            f.close()
-            values=[]
-            for l in a:
-                x=float(l)
-                values.append(x)
+            values=load_text('TestPulses.dat')
        
           
             print("Baseline %f, heartrate %f" % (self.baselineHR, heartrate)) 
@@ -366,26 +342,11 @@ class UIApp(App):
                 for b in v:
                     x=(b-minb)/span*(systolic-diastolic)+diastolic
                     v0.append(x)
-            ys=[]   
-            ys0=[]
-            i=0
-            t=0;
-            dt=20e-3
-            ts=[]
-            ps=[]
-            mms=[]
-            while(i <(len(v0))):
-                x=v0[i]
-                s=round(np.interp(x, self.mmHgs, self.steps))
-                i=i+10
-                ts.append(t)
-                t=t+dt
-                ys0.append(s)
-
-            for i in range(runs):
-                for y in ys0:
-                    ys.append(y)
+            # one motor position every 10 samples (20ms), filtered so nothing aliases
+            (ys0, stats)=compile_steps(v0, self.cal, 10)
+            ys=np.tile(ys0, runs).tolist()
             print(len(ys))
+            print("Maxstep = %d, length = %d" % (stats["maxstep"], stats["length"]))
             print(ys)
             self.pressure.write_waveform(ys)
             self.pressure.play_waveform(-1, cm, h)
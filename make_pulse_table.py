@@ -1,10 +1,6 @@
-import struct
-f=open('pulse256.dat', 'rb')
+from waveform_io import load_pulse_table
 
-a=f.read()
-f.close()
-
-w=struct.unpack("256h", a)
+w=load_pulse_table('pulse256.dat')
 
 print(w)
 
@@ -21,6 +21,9 @@
 #define WF_END_LOAD		2
 #define WF_PLAY_PT		3
 #define WF_PLAY_WF		4
+// Start a load from a copy of the table that's playing, rather than from nothing; answered on the same
+// channel with 1 if that's possible right now (i.e. we're playing), 0 otherwise.
+#define WF_PATCH		5
 
 // Honeywell MPR pressure sensor
 //#define PRESS_SENSE_I2C_ADDR	0x18
@@ -99,6 +102,18 @@
 #define HR_ID			2
 #define RR_ID			3
 #define CALMAX_ID		4
+// Same as HR_ID/RR_ID, but applied to the table that's playing right now
+#define HR_LIVE_ID		5
+#define RR_LIVE_ID		6
+
+// Binary block transfers
+#define MAX_BLOCK_LENGTH	1024
+#define MAX_BATCH_LENGTH	2048
+#define BLOCK_ERR_TIMEOUT	-1
+#define BLOCK_ERR_LENGTH	-2
+#define BLOCK_ERR_CRC		-3
+// How long the line has to stay quiet before the rest of a bad frame is given up on (10ms)
+#define FRAME_QUIET_TIME	1000000
 
 // Other parameters
 #define FULL_SCALE		8192
@@ -0,0 +1,116 @@
+import collections
+import hashlib
+import numpy as np
+
+# Turning recorded waveforms into what gets played.  Everything works on whole arrays; the scripts and
+# the Kivy UI used to do this a point at a time.
+
+# Resampled waveforms are kept for the last few (waveform, rate) pairs, since the same recording gets
+# played at the same heart rate over and over.
+CACHE_SIZE=32
+_cache=collections.OrderedDict()
+
+def clear_cache():
+    _cache.clear()
+
+def waveform_hash(values):
+    values=np.ascontiguousarray(values, dtype=np.float64)
+    return hashlib.sha1(values.tobytes()).hexdigest()
+
+# Windowed-sinc (Blackman) low-pass FIR with unity gain at DC; 'cutoff' is in cycles per sample (0.5
+# is Nyquist).
+def lowpass_taps(cutoff, ntaps):
+    n=np.arange(ntaps)-(ntaps-1)/2.0
+    h=2.0*cutoff*np.sinc(2.0*cutoff*n)*np.blackman(ntaps)
+    return h/h.sum()
+
+# Low-pass filter 'values', with no delay (the filter is centred) and the ends mirrored so they don't
+# droop.  By default the filter is long enough for a transition band of about 'cutoff'/2, so it's
+# fully cut off by 1.25*'cutoff'.
+def lowpass(values, cutoff, ntaps=None):
+    values=np.asarray(values, dtype=np.float64)
+    if(ntaps is None):
+        ntaps=2*int(np.ceil(5.5/cutoff))+1
+    half=min(ntaps//2, len(values)-1)
+    if(half<1):
+        return values.copy()
+    h=lowpass_taps(cutoff, 2*half+1)
+    padded=np.pad(values, half, mode='reflect')
+    return np.convolve(padded, h, mode='valid')
+
+# The fractional indices a waveform of 'n' points is read at when it's played 'ratio' times faster:
+# 0, ratio, 2*ratio, ... up to (but not including) the last point.  They're added up one step at a
+# time, the same way the old loop did it, so the points land in exactly the same places.
+def resample_grid(n, ratio):
+    if(ratio<=0):
+        raise ValueError("Resampling ratio must be positive, not %r" % ratio)
+    if(n<2):
+        return np.zeros(0)
+    steps=np.full(int((n-1)/ratio)+3, float(ratio))
+    steps[0]=0.0
+    x=np.add.accumulate(steps)
+    return x[x<(n-1)]
+
+# 'values' played 'ratio' times faster (ratio>1 speeds it up), by linear interpolation.  With
+# 'antialias', speeding up first filters out anything that would be above Nyquist at the new rate;
+# worth it for big changes in rate, where plain interpolation skips over the sharp parts of the pulse.
+def resample(values, ratio, antialias=False):
+    values=np.asarray(values, dtype=np.float64)
+    x=resample_grid(len(values), ratio)
+    if(antialias and (ratio>1.0)):
+        values=lowpass(values, 0.4/ratio)
+    return np.interp(x, np.arange(len(values)), values)
+
+# 'values', recorded at a heart rate of 'baseline', resampled to play at 'rate'.  Results are cached;
+# the array that comes back is shared, so it's read only.
+def resample_rate(values, baseline, rate, antialias=False):
+    ratio=rate/baseline
+    key=(waveform_hash(values), float(ratio), bool(antialias))
+    out=_cache.get(key)
+    if(out is not None):
+        _cache.move_to_end(key)
+        return out
+    out=resample(values, ratio, antialias)
+    out.flags.writeable=False
+    _cache[key]=out
+    while(len(_cache)>CACHE_SIZE):
+        _cache.popitem(last=False)
+    return out
+
+# The firmware plays a step sequence one value per tick.
+TICK=20e-3
+
+# Every 'factor'th point of 'values', starting with the first, like the scripts' 'i=i+factor' loops.
+# With 'antialias' (the default), anything too fast to survive that is filtered out first, so it
+# can't fold back down into the delivered pressure as a slower wobble.
+def decimate(values, factor, antialias=True):
+    values=np.asarray(values, dtype=np.float64)
+    factor=int(factor)
+    if(factor<1):
+        raise ValueError("Decimation factor must be at least 1, not %r" % factor)
+    if(antialias and (factor>1)):
+        values=lowpass(values, 0.4/factor)
+    return values[::factor]
+
+# How hard a step sequence works the motor: the biggest jump between consecutive ticks ('maxstep',
+# what the scripts have always printed), the average jump, the fastest the motor has to move (steps
+# per second) and the range of positions.
+def slew_stats(ys, tick=TICK):
+    ys=np.asarray(ys, dtype=np.int64)
+    ds=np.abs(np.diff(ys))
+    stats={"length":len(ys), "maxstep":0, "meanstep":0.0, "max_rate":0.0, "min":None, "max":None}
+    if(len(ys)):
+        stats["min"]=int(ys.min())
+        stats["max"]=int(ys.max())
+    if(len(ds)):
+        stats["maxstep"]=int(ds.max())
+        stats["meanstep"]=float(ds.mean())
+        stats["max_rate"]=stats["maxstep"]/tick
+    return stats
+
+# The whole stage: a waveform in mmHg, sampled 'factor' times per tick, to one motor position per
+# tick through the calibration 'cal' (a PSAppCalibrationModel, see finger.calibration_model), along
+# with its slew stats.
+def compile_steps(mmhg, cal, factor, antialias=True, tick=TICK):
+    ys=cal.positions(decimate(mmhg, factor, antialias))
+    return (ys, slew_stats(ys, tick))
@@ -1,30 +1,16 @@
-import struct
+from waveform_io import load_text, save_raw, FLOAT_WAVEFORM
 
 
 
 low=50
 high=100
 
-f=open('TestPulses.dat', 'rb')
-a=f.readlines()
-f.close()
-values=[]
-for l in a:
-    x=float(l)
-    values.append(x)
+values=load_text('TestPulses.dat')
 
 v=values[:-20]
 
-minb=50000
-maxb=-50000
-for b in v:
-    if(b>maxb):
-        maxb=b
-        #print("maxb, ", maxb)
-    
-    if(b<minb):
-        minb=b
-        #print("minb, ", minb)
+minb=float(v.min())
+maxb=float(v.max())
 
 print(minb, maxb)
 span=maxb-minb
@@ -37,11 +23,7 @@ for i in range(runs):
         #print(x)
         mmhg.append(x)
 
-f=open("integrated%d_%d.bin" % (low,high), "wb")
-for x in mmhg:
-    s=struct.pack("f", x)
-    f.write(s)
-f.close()
+save_raw("integrated%d_%d.bin" % (low,high), mmhg, FLOAT_WAVEFORM)
     
 
 
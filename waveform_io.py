@@ -0,0 +1,76 @@
+import os
+import glob
+import numpy as np
+
+# Loading waveforms and pulse tables, shared by the scripts and the Kivy UI.
+#
+# Text files (like TestPulses.dat, one float per line) are parsed once with NumPy and the result is
+# saved next to them as a hidden .npy sidecar, named after the source's size and modification time.
+# Later loads memory-map the sidecar instead of parsing the text again; editing or replacing the
+# source changes its size/mtime, so a stale sidecar is never used (and gets cleaned up).
+#
+# Binary files (float32 waveforms like ideal.bin, int16 pulse tables like pulse256.dat) are raw
+# little-endian arrays and are read straight in with np.fromfile, or mapped with np.memmap.
+
+FLOAT_WAVEFORM='<f4'
+PULSE_TABLE='<i2'
+PULSE_TABLE_LENGTH=256
+
+def sidecar_path(path):
+    st=os.stat(path)
+    (head, tail)=os.path.split(path)
+    return os.path.join(head, ".%s.%d-%d.npy" % (tail, st.st_size, st.st_mtime_ns))
+
+def _stale_sidecars(path, keep):
+    (head, tail)=os.path.split(path)
+    return [p for p in glob.glob(os.path.join(glob.escape(head), ".%s.*-*.npy" % glob.escape(tail))) if(p!=keep)]
+
+def parse_text(path):
+    with open(path, 'rb') as f:
+        return np.array(f.read().split(), dtype=np.float64)
+
+# One value per line, as float64.  With 'cache', the parsed values are kept in a sidecar (see above)
+# and memory-mapped (read only) on every load after the first.
+def load_text(path, cache=True):
+    if(not cache):
+        return parse_text(path)
+    side=sidecar_path(path)
+    try:
+        return np.load(side, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    values=parse_text(path)
+    # Write it under a temporary name first, so a half-written sidecar can never be picked up.  If the
+    # directory isn't writable, carry on without one.
+    tmp="%s.%d.tmp" % (side, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            np.save(f, values)
+        os.replace(tmp, side)
+        for old in _stale_sidecars(path, side):
+            os.remove(old)
+    except OSError:
+        if(os.path.exists(tmp)):
+            os.remove(tmp)
+    return values
+
+# Raw binary array of 'dtype' (e.g. FLOAT_WAVEFORM or PULSE_TABLE).  With 'mmap', the file is mapped
+# rather than read; worth it for long waveforms, but it keeps the file open for as long as the array
+# is around.
+def load_raw(path, dtype, mmap=False):
+    if(mmap and os.path.getsize(path)>0):
+        return np.memmap(path, dtype=dtype, mode='r')
+    return np.fromfile(path, dtype=dtype)
+
+def save_raw(path, values, dtype):
+    np.asarray(values).astype(dtype).tofile(path)
+
+def load_float_waveform(path, mmap=False):
+    return load_raw(path, FLOAT_WAVEFORM, mmap)
+
+# A pulse table for the firmware: exactly 256 signed 16-bit points.
+def load_pulse_table(path='pulse256.dat'):
+    table=load_raw(path, PULSE_TABLE)
+    if(len(table)!=PULSE_TABLE_LENGTH):
+        raise ValueError("%s has %d points; a pulse table needs %d" % (path, len(table), PULSE_TABLE_LENGTH))
+    return table